@@ -1,39 +1,79 @@
-from datetime import datetime, timedelta
+import logging
+from datetime import UTC, date, datetime, timedelta
 from enum import Enum
+from functools import partial
 from typing import Annotated, Type
 
 import sentry_sdk
 from fastapi import Depends, FastAPI, HTTPException, Request, status
-from fastapi.responses import HTMLResponse, JSONResponse, Response, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, join
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select
 
 import models
 import utils
-from models import Base, Game, Match, MatchPlayers, MatchResult, Token, User, UserInDB
-
+from models import Base, Game, Match, MatchPlayers, MatchResult, Token, User
+from sentry_sdk.integrations.fastapi import FastApiIntegration
+from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
+from sentry_sdk.integrations.starlette import StarletteIntegration
+from utils.config import env_str
+
+startup_timer = utils.StartupTimer()  # Times each phase of starting this worker, from the process starting
+startup_timer.mark("imports")
+sampler = utils.TraceSampler()  # Decides which requests are traced and profiled, by route, errors and load
+sentry_transport = utils.StubTransport() if utils.TraceSampler.STUB_TRANSPORT else None  # None sends to Sentry
 sentry_sdk.init(
     dsn="https://eebca21dd9c9418cbfe83e7b8a0976de@o317122.ingest.sentry.io/4504873492480000",
     send_default_pii=True,
-    traces_sample_rate=1.0,
-    _experiments={
-        "profiles_sample_rate": 1.0,
-    },
+    sample_rate=utils.TraceSampler.ERROR_RATE,
+    traces_sampler=sampler.traces_sampler,
+    profiles_sampler=sampler.profiles_sampler,
+    transport=sentry_transport,
+    auto_enabling_integrations=utils.TraceSampler.AUTO_INTEGRATIONS,
+    integrations=[StarletteIntegration(), FastApiIntegration(), SqlalchemyIntegration()],
 )  # Sets up error monitoring - helps with tracking errors
+startup_timer.mark("sentry")
 
 templates = Jinja2Templates(directory="templates")  # Sets the template directory for Jinja2 templates
 app = FastAPI()  # Sets the FastAPI app
 app.mount("/static", StaticFiles(directory="static"), name="static")  # Sets the static directory (for CSS/JS)
+sampler.routes = app.routes  # Lets the sampler tell which route a request is for
 
-db = utils.Database("data.db")  # Create an instance of the database object
+db = utils.Database(env_str("DB_PATH", "data.db"))  # Create an instance of the database object (DTS_DB_PATH)
+logger = logging.getLogger("uvicorn.error")  # Logs through uvicorn's handler, so messages appear with its own
 
 Auth = utils.Auth  # Alias Auth to the utils.Auth class without instance creation
+Leaderboard = utils.Leaderboard  # Alias Leaderboard to the utils.Leaderboard class without instance creation
+Ratings = utils.Ratings  # Alias Ratings to the utils.Ratings class without instance creation
+Stats = utils.Stats  # Alias Stats to the utils.Stats class without instance creation
+MatchDetails = utils.MatchDetails  # Alias MatchDetails to the utils.MatchDetails class without instance creation
 Session = Annotated[AsyncSession, Depends(db.get_session)]  # Annotation for dependency injection
+# Set DTS_SHARED_CACHE to a file path to share cached pages and table versions between workers (see utils.shared_cache)
+# (its pruning is a scheduled job below, so it never runs inside a request)
+shared_cache = utils.SharedCache(prune_every=0) if utils.SharedCache.enabled() else None
+page_cache = utils.ResponseCache(shared=shared_cache)  # Rendered pages and query results, keyed on table versions
+login_limiter = utils.LoginLimiter()  # Rejects bursts of login attempts before any password is checked
+events = utils.Broadcaster()  # Live leaderboard and match events, streamed to browsers from /events
+purger = utils.Purger()  # Deletes what deleted records leave behind, in the background (see utils.purge)
+scheduler = utils.Scheduler()  # Runs the maintenance jobs in the background (DTS_SCHEDULER, see schedule_jobs)
+metrics = utils.Metrics()  # Per-route request latency and SQL totals, served at /metrics
+metrics.listeners.append(sampler.observe)  # Raises the sample rate of routes that fail or are slow
+# Added even with metrics turned off (DTS_METRICS=0), so the sampler still hears about failing and slow requests
+app.add_middleware(utils.MetricsMiddleware, metrics=metrics)
+if utils.SlowQueryLog.enabled():
+    app.add_middleware(utils.SlowQueryMiddleware)  # Lets the slow query log see which route ran a statement
+startup_timer.mark("app")
 
 
 # Enum classes
@@ -44,6 +84,7 @@ class Endpoint(Enum):
 
     GAMES = "games"
     MATCH = "match"
+    MATCHES = "matches"
     NEW_MATCH = "new_match"
     LOGIN = "login"
     REGISTER = "register"
@@ -60,17 +101,16 @@ class Roles(Enum):
     TEACHER = "teacher"
 
 
-async def get_user(session, token: str) -> UserInDB:
+async def get_user(session, token: str) -> utils.UserRow:
     """
     Asynchronous function to validate credentials.
-    On successful validation, returns Pydantic model.
+    On successful validation, returns the user's row (a named tuple).
 
     :param session:
     :param token:
     :return:
     """
-    data = utils.get_authdata(token)
-    user = await Auth.get_user_object(session, username=data.username)
+    user = await Auth.get_user_from_token(session, token)  # cached, so usually neither decodes nor queries
     if user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -80,7 +120,87 @@ async def get_user(session, token: str) -> UserInDB:
     return user
 
 
+async def stage_new_match(session: AsyncSession, game_id: int, won_id: int, lost_id: int, played_at: datetime) -> None:
+    """
+    Updates the read models (leaderboard, ratings and user stats) for a new match.
+    Passed to Database.insert as its before_commit hook, so it runs in the same transaction as the match insert.
+    :param session:
+    :param game_id:
+    :param won_id:
+    :param lost_id:
+    :param played_at:
+    :return:
+    """
+    await Leaderboard.record_win(session, won_id)
+    await Ratings.record_result(session, game_id, won_id, lost_id)
+    await Stats.record_match(session, won_id, lost_id, played_at)
+
+
+async def stage_changed_match(session: AsyncSession, match_id: int, game_ids: set[int], deleted: bool) -> None:
+    """
+    Corrects the read models for an edited or deleted match.
+    Passed to Database.update/remove_record as their before_commit hook, so it runs in the same transaction.
+    :param session:
+    :param match_id:
+    :param game_ids: Games whose ratings need replaying (the match's game before and after the change)
+    :param deleted: Whether the match was deleted rather than edited
+    :return:
+    """
+    if deleted:
+        await Leaderboard.forget_match(session, match_id)
+    else:
+        await Leaderboard.refresh_match(session, match_id)
+    # Replaying a game's whole history would hold the write lock for the rest of this request, so it's left to the
+    # scheduled ratings job - unless there is no scheduler to run it
+    if utils.Scheduler.ENABLED:
+        await Ratings.mark_stale(session, game_ids)
+    else:
+        await Ratings.recompute(session, game_ids)
+    await Stats.refresh_match(session, match_id)
+
+
+async def announce_match(session: AsyncSession, match_id: int) -> None:
+    """
+    Tells every /events subscriber about a newly committed match and its winner's new win count - the two lookups here
+    are shared by all subscribers
+    :param session:
+    :param match_id:
+    :return:
+    """
+    detail = await MatchDetails.get(session, match_id)  # also warms the match page cache for everyone clicking through
+    if detail is None or detail.winner_id is None:
+        return None
+    wins = await Leaderboard.wins(session, detail.winner_id)
+    events.publish(
+        "match",
+        {
+            "id": detail.id,
+            "game": detail.game,
+            "winner": detail.winner,
+            "loser": detail.loser,
+            "played_at": detail.played_at,
+        },
+    )
+    events.publish("leaderboard", {"user": detail.winner, "wins": wins})
+
+
 # Identify values where necessary for role and endpoint
+def forget_cached(model: Type[Base], identifier: int) -> None:
+    """
+    Drops cached copies of a record that has just been edited or deleted
+    :param model:
+    :param identifier:
+    :return:
+    """
+    # Cached match details check their game's and players' row versions, so only the match's own entry is dropped here
+    if model is User:
+        Auth.forget_user(identifier)
+    elif model is Match:
+        MatchDetails.forget(identifier)
+        # The leaderboard may have changed in ways that aren't worth working out for each subscriber - they reload it
+        events.publish("refresh", {"match": identifier})
+
+
 def classify_endpoint(to_classify: Endpoint | str) -> tuple[Type[Base] | None, Endpoint | int]:
     """
     Abstracts endpoint classification away from route function
@@ -98,7 +218,7 @@ def classify_endpoint(to_classify: Endpoint | str) -> tuple[Type[Base] | None, E
             return models.Game, subject
         case Endpoint.LOGIN | Endpoint.REGISTER:
             return models.User, subject
-        case Endpoint.MATCH | Endpoint.NEW_MATCH:
+        case Endpoint.MATCH | Endpoint.MATCHES | Endpoint.NEW_MATCH:
             return models.Match, subject
         case _:
             return None, status.HTTP_404_NOT_FOUND
@@ -135,7 +255,138 @@ async def startup():
     __init__ method, but __init__ cannot be async, and the engine needs to be awaited (even to synchronously create
     metadata).
     """
-    await db.connect()
+    with startup_timer.phase("database"):
+        await db.connect()
+    # Counts each request's SQL statements (only requests are counted, so the startup work below isn't)
+    if utils.Metrics.ENABLED:
+        for engine in db.engines():
+            utils.Metrics.instrument(engine.sync_engine)
+    logger.info("Database storage settings: %s", await db.storage_settings())
+    # Seeds the leaderboard read model for databases that predate it
+    with startup_timer.phase("read_models"):
+        async with db.LocalSession() as session:
+            if await Leaderboard.needs_seeding(session):
+                await Leaderboard.rebuild(session)
+    # Starts the background jobs - the purge, database maintenance and re-warming the caches
+    if utils.Scheduler.ENABLED:
+        schedule_jobs()
+        scheduler.start(db)
+    # Does the first requests' one-off work now, before this worker accepts traffic (DTS_WARM_UP)
+    if utils.StartupTimer.WARM_UP:
+        with startup_timer.phase("warm_up"):
+            await warm_up()
+    logger.info("Worker %s", startup_timer.ready())
+
+
+async def warm_up() -> None:
+    """
+    Compiles every template, prepares the hot read statements, and renders the public pages so their queries run and
+    their results are cached
+    :return:
+    """
+    utils.precompile_templates(templates.env)
+    async with db.LocalSession() as session:
+        await utils.prepare_statements(
+            session,
+            [
+                db.columns(User, *utils.USER_COLUMNS).where(User.username == ""),
+                Leaderboard.ranking(),
+                db.games_statement(),
+                db.game_plays_statement(),
+                MatchDetails.statement(0),
+            ],
+        )
+    await warm_pages()
+
+
+async def warm_pages() -> None:
+    """
+    Renders the public pages, so they're cached for the next visitor
+    :return:
+    """
+    for path in ("/", "/leaderboard"):
+        await utils.request_page(app, path)
+
+
+def schedule_jobs() -> None:
+    """
+    Adds the background jobs to the scheduler. Jobs that write to the database or the shared cache are exclusive - one
+    worker runs each of their runs - while re-warming this worker's own page cache isn't.
+    :return:
+    """
+    maintenance = utils.Maintenance
+    # Clears up after deleted records in small batches, away from the requests that deleted them
+    scheduler.add(utils.Job("purge", partial(purger.run_once, db), interval=purger.INTERVAL, jitter=5))
+    # Replays the ratings of games whose history an edit or delete changed
+    scheduler.add(utils.Job("ratings", partial(Ratings.refresh_stale, db), interval=Ratings.REFRESH_INTERVAL, jitter=1))
+    scheduler.add(utils.Job("analyze", partial(maintenance.analyze, db), cron=maintenance.ANALYZE_CRON, jitter=60))
+    scheduler.add(
+        utils.Job("optimize", partial(maintenance.optimize, db), interval=maintenance.OPTIMIZE_INTERVAL, jitter=60)
+    )
+    scheduler.add(
+        utils.Job(
+            "incremental_vacuum",
+            partial(maintenance.incremental_vacuum, db),
+            interval=maintenance.VACUUM_INTERVAL,
+            jitter=30,
+        )
+    )
+    # Renders the busiest pages again after writes have made the cached copies stale, before a visitor has to wait
+    # for it - one worker does it for all of them when the cache is shared
+    scheduler.add(
+        utils.Job(
+            "warm_pages",
+            warm_pages,
+            interval=maintenance.PREWARM_INTERVAL,
+            jitter=5,
+            exclusive=shared_cache is not None,
+            timeout=30,
+        )
+    )
+    if shared_cache is not None:
+
+        async def prune_shared_cache() -> None:
+            shared_cache.prune()  # a couple of indexed deletes
+
+        scheduler.add(utils.Job("prune_shared_cache", prune_shared_cache, interval=60))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """
+    Deprecated (emits warning) method of invoking code on ASGI shutdown, the counterpart of startup().
+    """
+    await scheduler.stop()
+    Auth.hashing_pool.shutdown()
+    if shared_cache is not None:
+        shared_cache.close()
+    await db.disconnect()
+
+
+@app.exception_handler(utils.HashingPoolFull)
+async def hashing_pool_full(request: Request, exc: utils.HashingPoolFull):
+    """
+    Turns a saturated hashing pool into a fast 503, so clients back off instead of queueing behind Argon2
+    :param request:
+    :param exc:
+    :return:
+    """
+    return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "1"})
+
+
+@app.exception_handler(utils.RateLimited)
+async def rate_limited(request: Request, exc: utils.RateLimited):
+    """
+    Turns a rejected login attempt into a 429 saying when to try again - nothing has been hashed or queried by then
+    :param request:
+    :param exc:
+    :return:
+    """
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": exc.message},
+        headers={"Retry-After": login_limiter.retry_after(exc)},
+    )
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -147,62 +398,57 @@ async def home(request: Request, session: Session):
     :return:
     """
     token = request.cookies.get("access_token")  # Get the access token from the cookie
-    # These start as None to avoid errors
+    # This starts as None to avoid errors
     user = None
-    user_total_plays = None
-    user_total_wins = None
     if token:
         try:
             user = await get_user(session, token)  # tries to get user
-            # gets user stats
-            user_total_plays = (
-                await session.execute(
-                    select(func.count(MatchPlayers.match_id))
-                    .join(Match, Match.id == MatchPlayers.match_id)
-                    .where(MatchPlayers.player_id == user.id)
-                )
-            ).scalar_one_or_none()
-            user_total_wins = (
-                await session.execute(select(func.count(MatchResult.won_id)).where(MatchResult.won_id == user.id))
-            ).scalar_one_or_none()
         except HTTPException:
             pass  # ignored since this is index page
 
-    # Gets match count per game
-    game_plays = (
-        await session.execute(
-            select(Game.name, func.count(Match.game_id).label("matches"))
-            .select_from(join(Match, Game, Match.game_id == Game.id))
-            .group_by(Game.name)
-            .order_by(func.count(Match.game_id).desc())
+    async def count_game_plays():
+        # Gets match count per game
+        return (await session.execute(db.game_plays_statement())).all()
+
+    async def render() -> Response:
+        # gets user stats - one row by primary key from the read model maintained by match writes
+        user_stats = await Stats.get(session, user.id) if user else None
+        # The match counts are the same for every user, so they're cached until a game or match changes
+        game_plays = await page_cache.fragment(page_cache.key("game_plays", ("games", "matches")), count_game_plays)
+        # Returns it all to the template - request is a required context variable
+        return templates.TemplateResponse(
+            "index.html",
+            {
+                "request": request,
+                "game_plays": game_plays,
+                "user_stats": user_stats,
+                "user": user,
+            },
         )
-    ).all()
-    # Returns it all to the template - request is a required context variable
-    return templates.TemplateResponse(
-        "index.html",
-        {
-            "request": request,
-            "game_plays": game_plays,
-            "user_total_plays": user_total_plays,
-            "user_total_wins": user_total_wins,
-            "user": user,
-        },
-    )
+
+    # The page is personal, so only its ETag is cached (by user and data versions), letting the browser revalidate
+    key = page_cache.key("index.html", ("games", "matches", "user_stats", "users"), user.id if user else None)
+    return await page_cache.respond(request, key, render, cache_body=False)
 
 
 @app.post("/token", response_model=Token)
 async def authenticate(
+    request: Request,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     session: Session,
 ):
     """
     Route for authentication - adapted from FastAPI docs
     Adapted from https://fastapi.tiangolo.com/tutorial/security/oauth2-jwt/
+    :param request:
     :param form_data:
     :param session:
     :return:
     """
-    user = await Auth.authenticate_user(session, form_data.username, form_data.password)
+    # Checks the client's and the username's login rates first, so a rejected attempt costs no lookup or hashing
+    # (behind a proxy, run uvicorn with --proxy-headers so the client address is the real one)
+    with login_limiter.attempt(request.client.host if request.client else None, form_data.username):
+        user = await Auth.authenticate_user(session, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -233,7 +479,7 @@ async def register(request: Request, session: Session):
     new_user = User(
         email=form.get("email"),
         username=form.get("username"),
-        password=Auth.get_password_hash(form.get("password")),
+        password=await Auth.hash_password(form.get("password")),
         role=form.get("role"),
         first_name=form.get("first_name"),
         last_name=form.get("last_name"),
@@ -284,38 +530,163 @@ async def match(request: Request, session: Session, match_id: int):
     if match_id is None:
         # If there is no match ID, return a 404
         return Response(status_code=status.HTTP_404_NOT_FOUND)
-    # Query for the match including related data
-    row_stmt = (
-        select(Match)
-        .filter_by(id=match_id)
-        .options(
-            joinedload(Match.players).joinedload(MatchPlayers.player),
-            joinedload(Match.results).joinedload(MatchResult.won),
-        )
-    )
-    # Execute the query and get the first result
-    row = (await session.execute(row_stmt)).unique().scalar_one_or_none()
-    if row is None:
-        # If there is no match, return a 404
-        return Response(status_code=status.HTTP_404_NOT_FOUND)
-    # Get the game from the match
-    try:
-        game = await db.retrieve(session, models.Game, row.game_id)
-    except NoResultFound:
-        # If there is no game (if it's deleted), return a 404
+    # Gets the match with its game, players and result - one query, or none if the match was viewed recently
+    detail = await MatchDetails.get(session, match_id)
+    if detail is None:
+        # If there is no match (or its game is deleted), return a 410 if it was deleted, otherwise a 404
+        if await db.has_existed(session, Match, match_id):
+            return Response(status_code=status.HTTP_410_GONE)
         return Response(status_code=status.HTTP_404_NOT_FOUND)
-    # Get all games for the dropdown
     return templates.TemplateResponse(
         "match.html",
         {
             "request": request,
-            "match": row.__dict__,
-            "game_name": game.name,
+            "match": detail,
+            "game_name": detail.game,
             "editing_stick": True if user.role == Roles.TEACHER.value else False,
         },
     )
 
 
+@app.get("/events", response_class=StreamingResponse)
+async def event_stream():
+    """
+    Server-sent events for live pages - "match" for each new match, "leaderboard" with the winner's new win count,
+    and "refresh" when a match is edited or deleted
+    :return:
+    """
+    try:
+        events.check_capacity()
+    except utils.BroadcasterFull:
+        # If too many clients are connected, return a 503 - browsers retry the EventSource by themselves
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, headers={"Retry-After": "5"})
+    # Proxies mustn't buffer the stream, or events would arrive in bursts
+    return StreamingResponse(
+        events.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Prometheus metrics - per-route request latency histograms, SQL statement counts, SQL time and rows, the
+    Sentry sampler's effective rate, password hashing latency, the user, match and page caches' hits and misses, the
+    login limiter's rejections, the startup timings, the background jobs' runs, the event streams' clients, the purge's
+    progress and (if enabled) the write batches
+    :return:
+    """
+    # If metrics are turned off, return a 404 like any unknown page
+    if not utils.Metrics.ENABLED:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+    sections = (
+        metrics.render(),
+        sampler.render(),
+        Auth.hashing_pool.render(),
+        Auth.user_cache.render("user", "authenticated users by token"),
+        MatchDetails.cache.render("match", "match details by match id"),
+        login_limiter.render(),
+        startup_timer.render(),
+        scheduler.render(),
+        page_cache.render(),
+        events.render(),
+        purger.render(),
+        db.write_batcher.render() if db.write_batcher is not None else "",
+    )
+    return PlainTextResponse(
+        "".join(sections),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+@app.get("/slow_queries", response_class=HTMLResponse)
+async def slow_queries(request: Request, session: Session):
+    """
+    Slow query log - the most recent statements over DTS_SLOW_QUERY_MS, with their query plans (teachers only)
+    :param session:
+    :param request:
+    :return:
+    """
+    token = request.cookies.get("access_token")  # Gets the access token from the cookie
+    if not token:
+        # If there is no access token, redirect to auth_needed
+        return RedirectResponse(url="/auth_needed")
+    # Gets the user from the token - no error handling necessary
+    user = await get_user(session, token)
+    # If the user is not a teacher, return a 403 Forbidden
+    if user.role != Roles.TEACHER.value:
+        return Response(status_code=status.HTTP_403_FORBIDDEN)
+    # If the log is turned off, return a 404 like any unknown page
+    if db.slow_queries is None:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+    return templates.TemplateResponse(
+        "slow_queries.html",
+        {"request": request, "threshold_ms": utils.SlowQueryLog.THRESHOLD_MS, "entries": db.slow_queries.recent()},
+    )
+
+
+@app.post("/match/import", response_class=JSONResponse)
+async def import_matches(
+    request: Request, session: Session, token: Annotated[str, Depends(utils.oauth2_scheme)], format: str | None = None
+):
+    """
+    Bulk match import - takes a CSV (with a game,winner,loser[,played_at] header) or JSON Lines body and streams it
+    into the database in chunks, reporting rows that couldn't be imported
+    :param format: "csv" or "jsonl" - defaults to what the Content-Type says
+    :param token:
+    :param session:
+    :param request:
+    :return:
+    """
+    # Gets the user from the token - no error handling necessary
+    user = await get_user(session, token)
+    # If the user is not a teacher nor student leader, return a 403 Forbidden
+    if user.role != Roles.TEACHER.value and user.role != Roles.LEADER.value:
+        return Response(status_code=status.HTTP_403_FORBIDDEN)
+    # Works out the format from the query string, falling back to the content type
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "jsonl" if "json" in content_type else "csv"
+    importer = utils.MatchImporter(db, user.id)
+    try:
+        # The body is parsed as it arrives rather than read into memory first
+        report = await importer.run(utils.parse_records(request.stream(), format))
+    except utils.ImportFormatError as e:
+        # If the upload can't be read at all, return a 400 with what was imported before the problem
+        return JSONResponse(
+            content={"detail": e.message, "imported": importer.imported}, status_code=status.HTTP_400_BAD_REQUEST
+        )
+    return JSONResponse(content=report)
+
+
+@app.get("/export/{dataset}", response_class=StreamingResponse)
+async def export(request: Request, session: Session, dataset: str, format: str = "ndjson"):
+    """
+    Data export - streams matches, games or the leaderboard as NDJSON or CSV without loading them into memory
+    :param format: "ndjson" or "csv"
+    :param dataset: "matches", "games" or "leaderboard"
+    :param session:
+    :param request:
+    :return:
+    """
+    token = request.cookies.get("access_token")  # Gets the access token from the cookie
+    if not token:
+        # If there is no access token, redirect to auth_needed
+        return RedirectResponse(url="/auth_needed")
+    # Checks the token is valid - no error handling necessary
+    await get_user(session, token)
+    # If the dataset or format isn't known, return a 404
+    if dataset not in utils.Exporter.DATASETS or format not in utils.Exporter.MEDIA_TYPES:
+        return Response(status_code=status.HTTP_404_NOT_FOUND)
+    # The rows are read and encoded batch by batch as the response is sent
+    return StreamingResponse(
+        utils.Exporter.stream(db, dataset, format),
+        media_type=utils.Exporter.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{dataset}.{format}"'},
+    )
+
+
 @app.get("/leaderboard", response_class=HTMLResponse)
 async def get_leaderboard(request: Request, session: Session):
     """
@@ -324,20 +695,18 @@ async def get_leaderboard(request: Request, session: Session):
     :param request:
     :return:
     """
-    # Queries the database for data needed
-    leaderboard = await db.dump_by_field_descending(session, MatchResult.won_id, "wins")
-    leaderboard_data = []  # Empty list to store data
-    # Iterates through the leaderboard data and gets the username for each user
-    for user_won_id, wins in leaderboard:
-        select_statement = select(User.username).where(User.id == user_won_id)
-        result = await session.execute(select_statement)
-        username = result.scalars().first()
-        leaderboard_data.append({"user": username, "wins": wins})
-    # Returns the data to the template
-    return templates.TemplateResponse(
-        "leaderboard.html",
-        {"request": request, "data": leaderboard_data},
-    )
+
+    async def render() -> Response:
+        # Reads the leaderboard (usernames included) in one query from the read model maintained by match writes
+        leaderboard_data = await Leaderboard.top(session)
+        # Returns the data to the template
+        return templates.TemplateResponse(
+            "leaderboard.html",
+            {"request": request, "data": leaderboard_data},
+        )
+
+    # Served from the cache (or as a 304) until the leaderboard or a username changes
+    return await page_cache.respond(request, page_cache.key("leaderboard.html", ("leaderboard", "users")), render)
 
 
 @app.get("/{endpoint}", response_class=HTMLResponse)
@@ -370,31 +739,76 @@ async def records_list(request: Request, session: Session, endpoint: str):
     if model is None:
         return Response(status_code=status.HTTP_404_NOT_FOUND)
 
-    # Creates the context dictionary
-    context: dict = {
-        "request": request,
-    }
-    # Gets the data from the database where applicable
-    match endpoint_type:
-        case Endpoint.GAMES:
-            # Gets all games
-            context["games"] = await db.dump_all(session, model)
-            if user.role == Roles.TEACHER.value:  # If the user is a teacher, they can edit games
-                context["editing_stick"] = True
-        case Endpoint.NEW_MATCH:
-            # If the user is not a teacher/leader, redirect to auth_needed (instead of returning 403, so the user sees a
-            # cleaner page)
-            if user.role != Roles.TEACHER.value and user.role != Roles.LEADER.value:
-                return RedirectResponse(url="/auth_needed", status_code=status.HTTP_303_SEE_OTHER)
-            # Gets all games for the dropdown
-            context["games"] = await db.dump_all(session, models.Game)
-        case _:
-            pass
-    # Returns the template
-    return templates.TemplateResponse(
-        f"{endpoint_type.value}.html",
-        context,
-    )
+    async def render() -> Response:
+        # Creates the context dictionary
+        context: dict = {
+            "request": request,
+        }
+        # Listings are paginated by keyset - the cursor (from the previous page's link) says where the page starts
+        cursor = request.query_params.get("cursor")
+        page = None
+        # Gets the data from the database where applicable
+        try:
+            match endpoint_type:
+                case Endpoint.GAMES:
+                    # Gets a page of games
+                    page = await db.paginate(session, db.games_statement(), [Game.id], cursor)
+                    context["games"] = page.items
+                    if user.role == Roles.TEACHER.value:  # If the user is a teacher, they can edit games
+                        context["editing_stick"] = True
+                case Endpoint.MATCHES:
+                    # Gets a page of matches, applying whichever filters were given
+                    filters = {
+                        name: request.query_params.get(name) or None for name in ("game", "player", "from", "to")
+                    }
+                    context["filters"] = filters
+                    game = player = None
+                    if filters["game"]:
+                        game = await db.retrieve_by_field(session, Game, Game.name, filters["game"])
+                    if filters["player"]:
+                        player = await db.retrieve_by_field(session, User, User.username, filters["player"])
+                    # If the game or player doesn't exist, there are no matches to show
+                    if (filters["game"] and game is None) or (filters["player"] and player is None):
+                        context["matches"] = []
+                    else:
+                        page = await db.list_matches(
+                            session,
+                            cursor,
+                            game_id=game.id if game else None,
+                            player_id=player.id if player else None,
+                            played_from=date.fromisoformat(filters["from"]) if filters["from"] else None,
+                            played_to=date.fromisoformat(filters["to"]) if filters["to"] else None,
+                        )
+                        context["matches"] = page.items
+                case Endpoint.NEW_MATCH:
+                    # If the user is not a teacher/leader, redirect to auth_needed (instead of returning 403, so the
+                    # user sees a cleaner page)
+                    if user.role != Roles.TEACHER.value and user.role != Roles.LEADER.value:
+                        return RedirectResponse(url="/auth_needed", status_code=status.HTTP_303_SEE_OTHER)
+                    # Gets a page of games for the dropdown
+                    page = await db.paginate(session, db.games_statement(), [Game.id], cursor)
+                    context["games"] = page.items
+                case _:
+                    pass
+        except ValueError:
+            # If the cursor or a date filter is malformed, return a 400 Bad Request
+            return Response(status_code=status.HTTP_400_BAD_REQUEST)
+        # Links to the next page (keeping any filters) if there is one
+        if page is not None and page.next_cursor is not None:
+            context["next_url"] = str(request.url.include_query_params(cursor=page.next_cursor))
+        # Returns the template
+        return templates.TemplateResponse(
+            f"{endpoint_type.value}.html",
+            context,
+        )
+
+    # The games list only depends on the games table, the user's role and the page, so it's cached on those (and
+    # answered with a 304 if the browser's copy is still current)
+    if endpoint_type == Endpoint.GAMES:
+        return await page_cache.respond(
+            request, page_cache.key("games.html", ("games",), user.role, request.url.query), render
+        )
+    return await render()
 
 
 @app.post("/{endpoint}", response_class=JSONResponse)
@@ -431,7 +845,7 @@ async def new_record(
             winner = await db.retrieve_by_field(session, User, User.username, form.get("winner"))
             loser = await db.retrieve_by_field(session, User, User.username, form.get("loser"))
             # If the user specifies time/date, parse it
-            played_at = None
+            played_at = datetime.now(tz=UTC)
             if form.get("played_at"):
                 played_at = datetime.strptime(form.get("played_at"), "%Y-%m-%dT%H:%M")
             # Creates the model instance with form data
@@ -450,13 +864,25 @@ async def new_record(
         case _:
             # If the endpoint isn't identified, return a 404
             return Response(status_code=status.HTTP_404_NOT_FOUND)
-    # Tries to insert the model instance into the database
+    # A new match's read models are updated in the same transaction as the match itself
+    before_commit = None
+    if endpoint_type == Endpoint.MATCH:
+        before_commit = partial(
+            stage_new_match, game_id=int(form.get("game")), won_id=winner.id, lost_id=loser.id, played_at=played_at
+        )
+
+    # Tries to insert the model instance into the database - through the group commit queue if it's enabled
     try:
-        new_record_id = await db.insert(session, model_instance)
+        if db.write_batcher is not None:
+            new_record_id = await db.write_batcher.insert(model_instance, before_commit)
+        else:
+            new_record_id = await db.insert(session, model_instance, before_commit)
     except IntegrityError:
         # If there is a conflicting entry, return a 409 Conflict
         return Response(status_code=status.HTTP_409_CONFLICT)
     if endpoint_type == Endpoint.MATCH:
+        # Pushes the new match and leaderboard change to live subscribers
+        await announce_match(session, new_record_id)
         # If the endpoint is a match, return a redirect to the new match's page
         return JSONResponse(
             content={"redirectUrl": f"/{endpoint_type.value}/{new_record_id}"},
@@ -496,9 +922,20 @@ async def update_record(
     # If the model is None (which occurs when the endpoint isn't classified), return a 404
     if model is None:
         return Response(status_code=status.HTTP_404_NOT_FOUND)
+    # Edited matches have their read models corrected in the same transaction - ratings only need replaying when
+    # the match moves to another game or another point in history
+    before_commit = None
+    if model is Match:
+        game_ids = set()
+        if "game_id" in req_data or "played_at" in req_data:
+            game_ids.update(await session.scalars(select(Match.game_id).where(Match.id == identifier)))
+            if "game_id" in req_data:
+                game_ids.add(int(req_data["game_id"]))
+        before_commit = partial(stage_changed_match, match_id=identifier, game_ids=game_ids, deleted=False)
+
     # Tries to update the record
     try:
-        await db.update(session, model, identifier, req_data)
+        await db.update(session, model, identifier, req_data, before_commit)
     except IntegrityError:
         # If there is a conflicting entry, return a 409 Conflict
         return Response(status_code=status.HTTP_409_CONFLICT)
@@ -508,6 +945,8 @@ async def update_record(
             return Response(status_code=status.HTTP_410_GONE)
         else:
             return Response(status_code=status.HTTP_404_NOT_FOUND)
+    # Edited users mustn't be served stale from the token cache, and cached match pages mustn't show stale details
+    forget_cached(model, identifier)
     # If successful, return a 204 No Content
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -541,7 +980,15 @@ async def delete_record(
     if model is None:
         # If the model is None (which occurs when the endpoint isn't classified), return a 404
         return Response(status_code=status.HTTP_404_NOT_FOUND)
+    # Deleted matches have their read models corrected in the same transaction
+    before_commit = None
+    if model is Match:
+        game_ids = set(await session.scalars(select(Match.game_id).where(Match.id == identifier)))
+        before_commit = partial(stage_changed_match, match_id=identifier, game_ids=game_ids, deleted=True)
+
     # Remove the record
-    await db.remove_record(session, model, identifier)
+    await db.remove_record(session, model, identifier, before_commit)
+    # Deleted users mustn't stay authenticated through the token cache, and deleted matches mustn't stay viewable
+    forget_cached(model, identifier)
     # Return a 204 No Content
     return Response(status_code=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,316 @@
+"""
+Endpoint load test.
+Starts the app on a throwaway database - in process through httpx's ASGI transport, or as a local uvicorn worker -
+registers some users, then runs a mix of requests (logins, the home page, the leaderboard, match pages, and creating,
+editing and deleting matches) from concurrent clients for a fixed time. Reports p50/p95/p99 latency and requests per
+second for each kind of request and overall, and saves them as JSON named after the commit, so runs can be compared.
+
+Run from the project root: python -m benchmarks.endpoints [--mode asgi|uvicorn] [--duration 20] [--concurrency 16]
+                                                          [--compare benchmarks/results/endpoints-asgi-<commit>.json]
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime
+from typing import AsyncIterator, Optional
+
+import httpx
+
+PASSWORD = "benchmark"
+# Relative weights of each kind of request
+MIX = {
+    "login": 2,
+    "home": 25,
+    "leaderboard": 20,
+    "match": 25,
+    "create_match": 15,
+    "edit_match": 8,
+    "delete_match": 5,
+}
+
+
+def percentile(latencies: list[float], percent: float) -> float:
+    """
+    Nearest-rank percentile
+    :param latencies: Sorted
+    :param percent:
+    :return:
+    """
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1, max(0, round(percent / 100 * len(latencies)) - 1))]
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def current_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class LoadTest(object):
+    """
+    Seeds the app through its routes and runs the request mix against it.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, seed: int):
+        """
+        Load test initialization
+        :param client: Pointed at the app
+        :param seed: For the random choice of requests and their arguments
+        """
+        self.client: httpx.AsyncClient = client
+        self.random: random.Random = random.Random(seed)
+        self.token: Optional[str] = None  # the teacher's, used for every request
+        self.students: list[str] = []
+        self.game_ids: list[int] = []
+        self.match_ids: list[int] = []
+        self.latencies: dict[str, list[float]] = {name: [] for name in MIX}
+        self.errors: dict[str, int] = {name: 0 for name in MIX}
+
+    async def register(self, username: str, role: str) -> None:
+        response = await self.client.post(
+            "/register",
+            data={
+                "email": f"{username}@example.com",
+                "username": username,
+                "password": PASSWORD,
+                "role": role,
+                "first_name": "Benchmark",
+                "last_name": username,
+                "year_level": 12,
+                "house": "benchmark",
+            },
+        )
+        assert response.status_code == 303, f"registering {username}: {response.status_code}"
+
+    async def setup(self, students: int, games: int, matches: int) -> None:
+        """
+        Registers a teacher and students, and adds games and matches
+        :param students:
+        :param games:
+        :param matches:
+        :return:
+        """
+        await self.register("teacher", "teacher")
+        response = await self.client.post("/token", data={"username": "teacher", "password": PASSWORD})
+        assert response.status_code == 200, f"logging in: {response.status_code}"
+        self.token = response.cookies["access_token"]
+        self.students = [f"student{number}" for number in range(students)]
+        for username in self.students:
+            await self.register(username, "student")
+        for number in range(games):
+            response = await self.client.post(
+                "/games", data={"name": f"game{number}", "description": "benchmark"}, headers=self.auth()
+            )
+            assert response.status_code == 303, f"adding a game: {response.status_code}"
+        self.game_ids = list(range(1, games + 1))
+        for _ in range(matches):
+            await self.create_match()
+
+    def auth(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    def pick_match(self) -> int:
+        return self.random.choice(self.match_ids)
+
+    async def login(self) -> httpx.Response:
+        response = await self.client.post(
+            "/token", data={"username": self.random.choice(self.students), "password": PASSWORD}
+        )
+        # Pages are still requested as the teacher
+        self.client.cookies.set("access_token", self.token)
+        return response
+
+    async def home(self) -> httpx.Response:
+        return await self.client.get("/")
+
+    async def leaderboard(self) -> httpx.Response:
+        return await self.client.get("/leaderboard")
+
+    async def match(self) -> httpx.Response:
+        return await self.client.get(f"/match/{self.pick_match()}")
+
+    async def create_match(self) -> httpx.Response:
+        winner, loser = self.random.sample(self.students, 2)
+        response = await self.client.post(
+            "/match",
+            data={"game": self.random.choice(self.game_ids), "winner": winner, "loser": loser},
+            headers=self.auth(),
+        )
+        if response.status_code == 303:
+            self.match_ids.append(int(response.json()["redirectUrl"].rsplit("/", 1)[1]))
+        return response
+
+    async def edit_match(self) -> httpx.Response:
+        return await self.client.patch(
+            f"/match/{self.pick_match()}", json={"game_id": self.random.choice(self.game_ids)}, headers=self.auth()
+        )
+
+    async def delete_match(self) -> httpx.Response:
+        # Always leaves some matches to look at and edit
+        if len(self.match_ids) <= 10:
+            await self.create_match()
+        match_id = self.match_ids.pop(self.random.randrange(len(self.match_ids)))
+        return await self.client.delete(f"/match/{match_id}", headers=self.auth())
+
+    async def worker(self, deadline: float) -> None:
+        names = list(MIX)
+        weights = list(MIX.values())
+        while time.perf_counter() < deadline:
+            name = self.random.choices(names, weights)[0]
+            request: Callable[[], Awaitable[httpx.Response]] = getattr(self, name)
+            started = time.perf_counter()
+            response = await request()
+            self.latencies[name].append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                self.errors[name] += 1
+
+    async def run(self, duration: float, concurrency: int) -> dict:
+        """
+        Runs the mix from concurrent clients
+        :param duration: Seconds
+        :param concurrency: Number of clients
+        :return: The results
+        """
+        self.client.cookies.set("access_token", self.token)
+        started = time.perf_counter()
+        await asyncio.gather(*(self.worker(started + duration) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        everything = [latency for latencies in self.latencies.values() for latency in latencies]
+        return {
+            **summarize(everything, sum(self.errors.values()), elapsed),
+            "operations": {
+                name: summarize(self.latencies[name], self.errors[name], elapsed)
+                for name in MIX
+                if self.latencies[name]
+            },
+        }
+
+
+@asynccontextmanager
+async def in_process() -> AsyncIterator[httpx.AsyncClient]:
+    # Imported here, after DTS_DB_PATH points at the throwaway database
+    application = importlib.import_module("app").app
+    await application.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=application), base_url="http://benchmark") as c:
+            yield c
+    finally:
+        await application.router.shutdown()
+
+
+@asynccontextmanager
+async def uvicorn_worker() -> AsyncIterator[httpx.AsyncClient]:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--log-level", "warning"]
+    )
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+            # Waits for the worker to start accepting requests
+            for _ in range(300):
+                try:
+                    await client.get("/auth_needed")
+                    break
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError("uvicorn didn't start")
+            yield client
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def compare(results: dict, baseline: dict) -> None:
+    print(f"\ncompared with {baseline['commit']} ({baseline['mode']}):")
+    rows = [("overall", results, baseline)]
+    for name, operation in results["operations"].items():
+        if name in baseline["operations"]:
+            rows.append((name, operation, baseline["operations"][name]))
+    for name, new, old in rows:
+        changes = ", ".join(
+            f"{metric} {(new[metric] - old[metric]) / old[metric] * 100:+.1f}%"
+            for metric in ("rps", "p50_ms", "p95_ms", "p99_ms")
+            if old[metric]
+        )
+        print(f"  {name:<14} {changes}")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mode", default="asgi", choices=["asgi", "uvicorn"])
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--games", type=int, default=5)
+    parser.add_argument("--matches", type=int, default=200, help="matches added before the run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/endpoints-<mode>-<commit>.json)")
+    parser.add_argument("--compare", help="earlier results file to compare with")
+    args = parser.parse_args()
+    commit = current_commit()
+    with tempfile.TemporaryDirectory() as directory:
+        # Both the in-process app and the uvicorn worker read these
+        os.environ["DTS_DB_PATH"] = os.path.join(directory, "benchmark.db")
+        os.environ.setdefault("DTS_SENTRY_STUB", "true")  # nothing is sent to Sentry
+        # Every login comes from one address, which the login limiter would soon reject - this measures their cost
+        os.environ.setdefault("DTS_LOGIN_RATE_LIMIT", "false")
+        server = in_process if args.mode == "asgi" else uvicorn_worker
+        async with server() as client:
+            load_test = LoadTest(client, args.seed)
+            await load_test.setup(args.students, args.games, args.matches)
+            results = await load_test.run(args.duration, args.concurrency)
+    results = {
+        "commit": commit,
+        "mode": args.mode,
+        "started_at": datetime.now(tz=UTC).isoformat(),
+        "duration": args.duration,
+        "concurrency": args.concurrency,
+        **results,
+    }
+    print(f"{'request':<14} {'count':>7} {'errors':>6} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, summary in [*results["operations"].items(), ("overall", results)]:
+        print(
+            f"{name:<14} {summary['requests']:>7} {summary['errors']:>6} {summary['rps']:>8.1f} "
+            f"{summary['p50_ms']:>8.2f} {summary['p95_ms']:>8.2f} {summary['p99_ms']:>8.2f}"
+        )
+    output = args.output or os.path.join("benchmarks", "results", f"endpoints-{args.mode}-{commit}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"saved to {output}")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,73 @@
+"""
+Benchmark for the streaming exports (utils.Exporter).
+Fills throwaway databases with increasing numbers of matches, streams the matches export from each and reports the
+throughput and the peak Python memory allocated while streaming - which should stay flat as the row count grows.
+
+Run from the project root: python -m benchmarks.exports [--rows 10000 100000 1000000] [--format ndjson]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import utils
+
+
+async def fill(db: utils.Database, path: str, rows: int) -> None:
+    await db.connect()  # creates the tables
+    # Filled through the sqlite3 module directly, since only the export is being measured
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO users (id, email, username, password, role, first_name, last_name, house, created_at) "
+        "VALUES (?, ?, ?, '-', 'student', 'Player', ?, 'benchmark', '2024-01-01 00:00:00')",
+        [(number, f"player{number}@example.com", f"player{number}", str(number)) for number in range(1, 101)],
+    )
+    connection.execute("INSERT INTO games (id, name, description) VALUES (1, 'benchmark', 'benchmark')")
+    connection.executemany(
+        "INSERT INTO matches (id, game_id, creator_id, played_at, created_at) "
+        "VALUES (?, 1, 1, '2024-01-01 00:00:00', '2024-01-01 00:00:00')",
+        ((match_id,) for match_id in range(1, rows + 1)),
+    )
+    connection.executemany(
+        "INSERT INTO matchresults (match_id, won_id, lost_id) VALUES (?, ?, ?)",
+        ((match_id, 1 + match_id % 100, 1 + (match_id + 1) % 100) for match_id in range(1, rows + 1)),
+    )
+    connection.commit()
+    connection.close()
+
+
+async def measure(rows: int, format: str) -> tuple[float, int, int]:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        db = utils.Database(path)
+        await fill(db, path, rows)
+        size = 0
+        tracemalloc.start()
+        started = time.perf_counter()
+        async for chunk in utils.Exporter.stream(db, "matches", format):
+            size += len(chunk)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        await db.disconnect()
+    return elapsed, size, peak
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--format", default="ndjson", choices=list(utils.Exporter.MEDIA_TYPES))
+    args = parser.parse_args()
+    for rows in args.rows:
+        elapsed, size, peak = await measure(rows, args.format)
+        print(
+            f"{rows:>10,} rows: {rows / elapsed:,.0f} rows/s, {size / 2**20:,.1f} MiB written, "
+            f"peak {peak / 2**20:,.2f} MiB allocated"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Benchmark for projection queries (Database.project) against full ORM entity loads.
+Fills a throwaway database, then times the three hot reads both ways - the user lookup done to authenticate a request,
+the games dropdown and the leaderboard - and reports the time per call and the peak memory allocated by one call.
+Each call uses a new session, like a request does, so single-row reads are dominated by the session and the round trip
+to SQLite's thread; the savings grow with the number of rows.
+
+Run from the project root: python -m benchmarks.projections [--users 2000] [--games 200] [--repeat 200]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Awaitable, Callable
+
+from sqlalchemy import select
+
+import utils
+from models import Game, LeaderboardEntry, User, UserInDB
+
+
+async def fill(db: utils.Database, users: int, games: int) -> None:
+    async with db.LocalSession() as session:
+        session.add_all(
+            User(
+                email=f"player{number}@example.com",
+                username=f"player{number}",
+                password="-",
+                role="student",
+                first_name="Player",
+                last_name=str(number),
+                year_level=12,
+                house="benchmark",
+            )
+            for number in range(users)
+        )
+        session.add_all(Game(name=f"game{number}", description="benchmark") for number in range(games))
+        await session.flush()
+        session.add_all(LeaderboardEntry(user_id=number + 1, wins=number % 50) for number in range(users))
+        await session.commit()
+
+
+# The ORM versions, as these reads were done before projections
+async def user_entity(session, username: str) -> UserInDB:
+    data = await utils.Database.retrieve_by_field(session, User, User.username, username)
+    data_dict = data.__dict__
+    data_dict.pop("_sa_instance_state", None)
+    return UserInDB(**data_dict)
+
+
+async def games_entities(session) -> list:
+    return list(await utils.Database.dump_all(session, Game))
+
+
+async def games_projection(session) -> list:
+    return await utils.Database.project(session, utils.Database.games_statement())
+
+
+async def leaderboard_entities(session) -> list:
+    statement = (
+        select(LeaderboardEntry, User)
+        .join(User, User.id == LeaderboardEntry.user_id)
+        .where(LeaderboardEntry.wins > 0)
+        .order_by(LeaderboardEntry.wins.desc(), LeaderboardEntry.user_id)
+    )
+    return list((await session.execute(statement)).all())
+
+
+async def measure(db: utils.Database, read: Callable[..., Awaitable], repeat: int, *args) -> tuple[float, int]:
+    """
+    Times a read, each call in a new session like a request, and measures the peak memory one call allocates
+    :return: Seconds per call and peak bytes
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        async with db.LocalSession() as session:
+            await read(session, *args)
+    elapsed = (time.perf_counter() - started) / repeat
+    async with db.LocalSession() as session:
+        tracemalloc.start()
+        await read(session, *args)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--games", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        db = utils.Database(os.path.join(directory, "benchmark.db"))
+        await db.connect()
+        await fill(db, args.users, args.games)
+        cases = [
+            ("auth user lookup", (user_entity, "player1"), (utils.Auth.get_user_object, "player1")),
+            ("games dropdown", (games_entities,), (games_projection,)),
+            ("leaderboard", (leaderboard_entities,), (utils.Leaderboard.top,)),
+        ]
+        for name, (entity_read, *entity_args), (projection_read, *projection_args) in cases:
+            entity_time, entity_peak = await measure(db, entity_read, args.repeat, *entity_args)
+            projection_time, projection_peak = await measure(db, projection_read, args.repeat, *projection_args)
+            print(
+                f"{name}: ORM {entity_time * 1000:.3f} ms, {entity_peak / 1024:,.0f} KiB - projection "
+                f"{projection_time * 1000:.3f} ms, {projection_peak / 1024:,.0f} KiB "
+                f"({entity_time / projection_time:.1f}x faster, {entity_peak / projection_peak:.1f}x less memory)"
+            )
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
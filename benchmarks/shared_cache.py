@@ -0,0 +1,118 @@
+"""
+Benchmark for the shared cross-worker cache (utils.shared_cache) against the uncached path.
+Fills a throwaway database, then times getting the leaderboard three ways - querying it (the uncached path), from this
+process's LRU, and from the shared SQLite cache (as a worker that didn't produce the entry would) - and reading a table
+version from the shared counters file. Finally another process bumps a version, and this one measures how long it takes
+to see the change.
+
+Run from the project root: python -m benchmarks.shared_cache [--users 2000] [--repeat 2000] [--bumps 50]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from collections.abc import Awaitable, Callable
+
+import utils
+from benchmarks.projections import fill
+
+
+def per_call(function: Callable, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - started) / repeat
+
+
+async def per_call_async(function: Callable[[], Awaitable], repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await function()
+    return (time.perf_counter() - started) / repeat
+
+
+def bump_later(path: str, delay: float, bumped_at) -> None:
+    # Runs in another process, like a worker committing a write
+    counters = utils.SharedCounters(path)
+    time.sleep(delay)
+    bumped_at.value = time.perf_counter()
+    counters.add(["leaderboard"])
+
+
+def invalidation_delays(path: str, bumps: int) -> list[float]:
+    """
+    Has another process bump a version, and polls for it here
+    :param path: Counters file
+    :param bumps: How many times to measure
+    :return: Seconds from each bump to seeing it
+    """
+    counters = utils.SharedCounters(path)
+    context = multiprocessing.get_context("spawn")
+    delays = []
+    for _ in range(bumps):
+        before = counters.get("leaderboard")
+        bumped_at = context.Value("d", 0.0)
+        process = context.Process(target=bump_later, args=(path, 0.05, bumped_at))
+        process.start()
+        while counters.get("leaderboard") == before:
+            os.sched_yield()  # lets the other process run on a machine with one core
+        seen_at = time.perf_counter()
+        process.join()
+        delays.append(seen_at - bumped_at.value)
+    counters.close()
+    return delays
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--bumps", type=int, default=50)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        db = utils.Database(os.path.join(directory, "benchmark.db"))
+        await db.connect()
+        await fill(db, args.users, 10)
+        versions_path = os.path.join(directory, "cache.db.versions")
+        utils.data_versions.share(versions_path)
+        shared = utils.SharedCache(os.path.join(directory, "cache.db"))
+        local = utils.ResponseCache()
+        # An LRU that keeps nothing, so every lookup goes to the shared cache like another worker's first one would
+        other_worker = utils.ResponseCache(maxsize=0, shared=shared)
+
+        async def query() -> list:
+            async with db.LocalSession() as session:
+                return await utils.Leaderboard.top(session)
+
+        def key() -> tuple:
+            return local.key("leaderboard", ("leaderboard", "users"))
+
+        rows = await query()
+        local.store(key(), rows)
+        other_worker.store(key(), rows)
+
+        uncached = await per_call_async(query, args.repeat // 10 or 1)
+        local_hit = await per_call_async(lambda: local.fragment(key(), query), args.repeat)
+        shared_hit = await per_call_async(lambda: other_worker.fragment(key(), query), args.repeat)
+        version_read = per_call(lambda: utils.data_versions.get("leaderboard", "users"), args.repeat)
+        assert local.entries.misses == 0 and shared.misses == 0, "the cached paths shouldn't have queried"
+
+        print(f"leaderboard of {len(rows)} rows:")
+        print(f"  uncached query      {uncached * 1000:8.3f} ms")
+        print(f"  process LRU hit     {local_hit * 1000:8.3f} ms ({uncached / local_hit:,.0f}x faster)")
+        print(f"  shared cache hit    {shared_hit * 1000:8.3f} ms ({uncached / shared_hit:,.0f}x faster)")
+        print(f"  shared version read {version_read * 1e6:8.3f} us (two tables)")
+
+        delays = sorted(invalidation_delays(versions_path, args.bumps))
+        print(
+            f"invalidation seen by another process after {args.bumps} bumps: "
+            f"median {delays[len(delays) // 2] * 1e6:.1f} us, max {delays[-1] * 1e6:.1f} us"
+        )
+        shared.close()
+        await db.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
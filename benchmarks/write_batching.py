@@ -0,0 +1,90 @@
+"""
+Benchmark for group commit (utils.WriteBatcher) against one transaction per insert.
+Inserts matches (with their players, result and leaderboard update, like the /match route does) from many concurrent
+tasks into a throwaway database and reports matches per second for each mode.
+
+Run from the project root:
+    python -m benchmarks.write_batching [--matches 2000] [--concurrency 64] [--profile production]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from functools import partial
+
+import utils
+from models import Game, Match, MatchPlayers, MatchResult, User
+
+
+def new_match(game_id: int, winner_id: int, loser_id: int) -> Match:
+    return Match(
+        game_id=game_id,
+        creator_id=winner_id,
+        players={MatchPlayers(player_id=winner_id), MatchPlayers(player_id=loser_id)},
+        results=MatchResult(won_id=winner_id, lost_id=loser_id),
+    )
+
+
+async def setup(db: utils.Database) -> None:
+    async with db.LocalSession() as session:
+        for number in (1, 2):
+            session.add(
+                User(
+                    email=f"player{number}@example.com",
+                    username=f"player{number}",
+                    password="-",
+                    role="student",
+                    first_name="Player",
+                    last_name=str(number),
+                    house="benchmark",
+                )
+            )
+        session.add(Game(name="benchmark", description="benchmark"))
+        await session.commit()
+
+
+async def insert_directly(db: utils.Database, count: int) -> None:
+    async with db.LocalSession() as session:
+        for i in range(count):
+            hook = partial(utils.Leaderboard.record_win, user_id=1 + i % 2)
+            await db.insert(session, new_match(1, 1 + i % 2, 2 - i % 2), hook)
+
+
+async def insert_batched(db: utils.Database, count: int) -> None:
+    for i in range(count):
+        hook = partial(utils.Leaderboard.record_win, user_id=1 + i % 2)
+        await db.write_batcher.insert(new_match(1, 1 + i % 2, 2 - i % 2), hook)
+
+
+async def measure(batched: bool, matches: int, concurrency: int, profile: str) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        utils.WriteBatcher.ENABLED = batched
+        db = utils.Database(os.path.join(directory, "benchmark.db"), profile)
+        await db.connect()
+        await setup(db)
+        worker = insert_batched if batched else insert_directly
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(db, matches // concurrency) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        if batched:
+            print(
+                f"  {db.write_batcher.batches} batches, {db.write_batcher.inserts / db.write_batcher.batches:.1f} avg"
+            )
+        await db.disconnect()
+    return (matches // concurrency) * concurrency / elapsed
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--matches", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--profile", default="production", choices=list(utils.PROFILES))
+    args = parser.parse_args()
+    for batched in (False, True):
+        rate = await measure(batched, args.matches, args.concurrency, args.profile)
+        print(f"{'group commit' if batched else 'per-insert commit'}: {rate:,.0f} matches/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
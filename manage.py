@@ -0,0 +1,201 @@
+"""
+Management commands, run from the project root, e.g. `python manage.py rebuild-leaderboard`.
+These are for maintenance work that doesn't belong in a request, like recomputing read models from the source tables.
+"""
+import argparse
+import asyncio
+import time
+from datetime import date
+
+import utils
+
+
+async def rebuild_leaderboard(db: utils.Database, args: argparse.Namespace) -> None:
+    """
+    Recomputes the leaderboard read model from matchresults
+    :param db:
+    :param args:
+    :return:
+    """
+    async with db.LocalSession() as session:
+        await utils.Leaderboard.rebuild(session)
+        print(f"Leaderboard rebuilt with {len(await utils.Leaderboard.top(session))} ranked users")
+
+
+async def recompute_ratings(db: utils.Database, args: argparse.Namespace) -> None:
+    """
+    Replays the match history to recompute every rating, optionally with different rating parameters
+    :param db:
+    :param args:
+    :return:
+    """
+    async with db.LocalSession() as session:
+        started = time.perf_counter()
+        replayed = await utils.Ratings.recompute(
+            session, initial=args.initial, k_factor=args.k_factor, scale=args.scale
+        )
+        await session.commit()
+        print(f"Ratings recomputed from {replayed} matches in {time.perf_counter() - started:.2f}s")
+
+
+async def check_stats(db: utils.Database, args: argparse.Namespace) -> None:
+    """
+    Compares the user stats read model with the source tables, rebuilding it if asked to
+    :param db:
+    :param args:
+    :return:
+    """
+    async with db.LocalSession() as session:
+        mismatches = await utils.Stats.check(session)
+        for row in mismatches:
+            print(
+                f"user {row.id}: plays {row.plays} (expected {row.expected_plays}), wins {row.wins} "
+                f"(expected {row.expected_wins}), losses {row.losses} (expected {row.expected_losses}), "
+                f"last played {row.last_played_at} (expected {row.expected_last_played_at})"
+            )
+        if not mismatches:
+            print("User stats are consistent")
+        elif args.rebuild:
+            await utils.Stats.rebuild(session)
+            print(f"User stats rebuilt ({len(mismatches)} users were wrong)")
+        else:
+            raise SystemExit(1)
+
+
+async def migrate(db: utils.Database, args: argparse.Namespace) -> None:
+    """
+    Reports the schema upgrade done on connecting (Database.connect applies any pending migrations)
+    :param db:
+    :param args:
+    :return:
+    """
+    before, after = db.schema_versions
+    if before == after:
+        print(f"Schema is up to date (version {after})")
+    else:
+        print(f"Schema upgraded from version {before} to {after}")
+
+
+async def check_indexes(db: utils.Database, args: argparse.Namespace) -> None:
+    """
+    Checks the hot queries' plans use the indexes they're expected to, exiting with status 1 if any don't
+    :param db:
+    :param args:
+    :return:
+    """
+    async with db.engine.connect() as connection:
+        results = await connection.run_sync(utils.check_query_plans)
+    failed = False
+    for name, (plan, problems) in results.items():
+        print(f"{'FAIL' if problems else 'ok'}: {name}")
+        if problems or args.verbose:
+            for line in plan:
+                print(f"    {line}")
+        if problems:
+            print(f"    problems: {', '.join(sorted(problems))}")
+            failed = True
+    if failed:
+        raise SystemExit(1)
+
+
+async def generate(db: utils.Database, args: argparse.Namespace) -> None:
+    """
+    Fills an empty database with reproducible synthetic users, games and matches, then builds the read models
+    :param db:
+    :param args:
+    :return:
+    """
+    generator = utils.SyntheticData(
+        users=args.users,
+        games=args.games,
+        matches=args.matches,
+        seed=args.seed,
+        activity_skew=args.activity_skew,
+        games_per_term=args.games_per_term,
+        terms=args.terms,
+        term_weeks=args.term_weeks,
+        first_term=date.fromisoformat(args.first_term),
+        played_at_spread=args.played_at_spread,
+        hashes=args.hashes,
+    )
+    started = time.perf_counter()
+    try:
+        # The inserts are plain sqlite3 calls, so they run off the event loop
+        await asyncio.to_thread(generator.write, args.database)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    seconds = time.perf_counter() - started
+    print(f"Wrote {args.users} users, {args.games} games and {args.matches} matches in {seconds:.1f}s")
+    # The inserts bypassed the sessions that track writes, so anything cached from these tables is marked stale here
+    utils.data_versions.bump(("users", "games", "matches", "matchplayers", "matchresults"))
+    started = time.perf_counter()
+    async with db.LocalSession() as session:
+        await utils.Leaderboard.rebuild(session)
+        await utils.Ratings.recompute(session)
+        await session.commit()
+        await utils.Stats.rebuild(session)
+        await session.commit()
+    # Gives the query planner statistics for the new data (on the writer, as reads may be on read-only connections)
+    await utils.Maintenance.analyze(db)
+    seconds = time.perf_counter() - started
+    print(f"Read models built in {seconds:.1f}s - users log in as user<n> with password<n % {args.hashes}>")
+
+
+async def run(args: argparse.Namespace) -> None:
+    """
+    Connects to the database and runs the chosen command
+    :param args:
+    :return:
+    """
+    db = utils.Database(args.database)
+    await db.connect()
+    try:
+        await args.handler(db, args)
+    finally:
+        await db.disconnect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="DTSCodingDB management commands")
+    parser.add_argument("--database", default="data.db", help="SQLite database file (default: data.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild-leaderboard", help="recompute the leaderboard from matchresults")
+    rebuild.set_defaults(handler=rebuild_leaderboard)
+
+    ratings = commands.add_parser("recompute-ratings", help="replay the match history to recompute ratings")
+    ratings.add_argument("--initial", type=float, help=f"starting rating (default: {utils.Ratings.INITIAL_RATING})")
+    ratings.add_argument("--k-factor", type=float, help=f"maximum change per match (default: {utils.Ratings.K_FACTOR})")
+    ratings.add_argument("--scale", type=float, help=f"Elo scale (default: {utils.Ratings.SCALE})")
+    ratings.set_defaults(handler=recompute_ratings)
+
+    stats = commands.add_parser("check-stats", help="compare user stats with the source tables")
+    stats.add_argument("--rebuild", action="store_true", help="rebuild the user stats if they're inconsistent")
+    stats.set_defaults(handler=check_stats)
+
+    schema = commands.add_parser("migrate", help="bring the database schema up to date")
+    schema.set_defaults(handler=migrate)
+
+    indexes = commands.add_parser("check-indexes", help="check the busiest queries use their indexes")
+    indexes.add_argument("--verbose", action="store_true", help="print every query plan, not just failing ones")
+    indexes.set_defaults(handler=check_indexes)
+
+    synthetic = commands.add_parser("generate", help="fill an empty database with synthetic data for scaling tests")
+    synthetic.add_argument("--users", type=int, default=10000)
+    synthetic.add_argument("--games", type=int, default=100)
+    synthetic.add_argument("--matches", type=int, default=1000000)
+    synthetic.add_argument("--seed", type=int, default=0, help="the same seed and options give the same data")
+    synthetic.add_argument("--activity-skew", type=float, default=1.0, help="Zipf exponent of player activity")
+    synthetic.add_argument("--games-per-term", type=int, default=20, help="games in play each term")
+    synthetic.add_argument("--terms", type=int, default=8, help="terms the matches are spread over")
+    synthetic.add_argument("--term-weeks", type=int, default=10)
+    synthetic.add_argument("--first-term", default="2022-02-01", help="start of the first term (YYYY-MM-DD)")
+    synthetic.add_argument("--played-at-spread", type=float, default=2.0, help="spread of match times of day, hours")
+    synthetic.add_argument("--hashes", type=int, default=1, help="distinct passwords (Argon2 hashes) to use")
+    synthetic.set_defaults(handler=generate)
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
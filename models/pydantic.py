@@ -30,6 +30,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: str | None = None
+    expires: datetime | None = None
 
 
 class UserInDB(PydanticUser):
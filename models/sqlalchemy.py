@@ -18,7 +18,7 @@
 from datetime import UTC, datetime
 from typing import Set
 
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index, UniqueConstraint, text
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
@@ -34,6 +34,8 @@ class Base(AsyncAttrs, DeclarativeBase):
 
 class Game(Base):
     __tablename__: str = "games"
+    # AUTOINCREMENT, so a deleted game's id (whose matches may not be purged yet) is never handed out again
+    __table_args__ = {"sqlite_autoincrement": True}
 
     match: Mapped[Set["Match"]] = relationship()
     name: Mapped[str] = mapped_column(nullable=False, unique=True)
@@ -42,6 +44,7 @@ class Game(Base):
 
 class User(Base):
     __tablename__: str = "users"
+    __table_args__ = {"sqlite_autoincrement": True}  # as for games - ids of deleted users aren't reused
 
     email: Mapped[str] = mapped_column(unique=True, nullable=False)
     username: Mapped[str] = mapped_column(unique=True, nullable=False)
@@ -60,6 +63,12 @@ class User(Base):
 
 class Match(Base):
     __tablename__: str = "matches"
+    # SQLite indexes end in the rowid (id) implicitly, so these also serve ORDER BY played_at, id
+    __table_args__ = (
+        Index("ix_matches_game_id_played_at", "game_id", "played_at"),
+        Index("ix_matches_played_at", "played_at"),
+        {"sqlite_autoincrement": True},  # as for games - ids of deleted matches aren't reused
+    )
 
     game_id: Mapped[int] = mapped_column(ForeignKey("games.id"), nullable=False)
     played_at: Mapped[datetime] = mapped_column(default=datetime.now(tz=UTC))
@@ -72,6 +81,10 @@ class Match(Base):
 
 class MatchPlayers(Base):
     __tablename__: str = "matchplayers"
+    __table_args__ = (
+        Index("ix_matchplayers_player_id_match_id", "player_id", "match_id"),
+        Index("ix_matchplayers_match_id_player_id", "match_id", "player_id"),
+    )
 
     match: Mapped["Match"] = relationship(back_populates="players")
     match_id: Mapped[int] = mapped_column(ForeignKey("matches.id"), nullable=False)
@@ -81,6 +94,10 @@ class MatchPlayers(Base):
 
 class MatchResult(Base):
     __tablename__: str = "matchresults"
+    __table_args__ = (
+        Index("ix_matchresults_won_id_match_id", "won_id", "match_id"),
+        Index("ix_matchresults_lost_id_match_id", "lost_id", "match_id"),
+    )
 
     match: Mapped["Match"] = relationship(back_populates="results")
     match_id: Mapped[int] = mapped_column(ForeignKey("matches.id"), unique=True, nullable=False)
@@ -89,3 +106,95 @@ class MatchResult(Base):
     lost_id: Mapped[str] = mapped_column(ForeignKey("users.id"), nullable=False)
     won: Mapped["User"] = relationship("User", foreign_keys=[won_id])
     lost: Mapped["User"] = relationship("User", foreign_keys=[lost_id])
+
+
+class LeaderboardEntry(Base):
+    """
+    Read model of win counts per user, maintained alongside match writes (see utils.Leaderboard) so the leaderboard
+    page doesn't have to aggregate matchresults on every view.
+    """
+
+    __tablename__: str = "leaderboard"
+    __table_args__ = (Index("ix_leaderboard_wins_user_id", "wins", "user_id"),)
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), unique=True, nullable=False)
+    wins: Mapped[int] = mapped_column(nullable=False, default=0)
+
+
+class Rating(Base):
+    """
+    Elo rating of a user for a game, maintained alongside match writes (see utils.Ratings).
+    """
+
+    __tablename__: str = "ratings"
+    __table_args__ = (
+        UniqueConstraint("user_id", "game_id"),
+        Index("ix_ratings_game_id_rating", "game_id", "rating"),
+    )
+
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    game_id: Mapped[int] = mapped_column(ForeignKey("games.id"), nullable=False)
+    rating: Mapped[float] = mapped_column(nullable=False)
+    matches: Mapped[int] = mapped_column(nullable=False, default=0)
+
+
+class UserStats(Base):
+    """
+    Read model of each user's match totals, maintained alongside match writes (see utils.Stats) so the home page reads
+    one row instead of counting matchplayers and matchresults. The id is the user's id, so a user's row is fetched by
+    primary key.
+    """
+
+    __tablename__: str = "user_stats"
+
+    id: Mapped[int] = mapped_column(ForeignKey("users.id"), primary_key=True, autoincrement=False)
+    plays: Mapped[int] = mapped_column(nullable=False, default=0)
+    wins: Mapped[int] = mapped_column(nullable=False, default=0)
+    losses: Mapped[int] = mapped_column(nullable=False, default=0)
+    last_played_at: Mapped[datetime] = mapped_column(nullable=True)
+
+
+class Tombstone(Base):
+    """
+    Record of a deleted row, kept for good: it answers whether an id was ever deleted (410 Gone rather than 404) with
+    one lookup, and until purged_at is set it's the background purge's note that the row's dependents (a match's players
+    and result, a game's matches, a user's read model rows) still need deleting (see utils.Purger).
+    """
+
+    __tablename__: str = "tombstones"
+    __table_args__ = (
+        UniqueConstraint("table_name", "row_id"),
+        # Only the tombstones still waiting to be purged, so finding them stays cheap however many have been
+        Index("ix_tombstones_pending", "deleted_at", sqlite_where=text("purged_at IS NULL")),
+    )
+
+    table_name: Mapped[str] = mapped_column(nullable=False)
+    row_id: Mapped[int] = mapped_column(nullable=False)
+    deleted_at: Mapped[datetime] = mapped_column(nullable=False)
+    purged_at: Mapped[datetime] = mapped_column(nullable=True)
+
+
+class JobLease(Base):
+    """
+    Claim on a scheduled job's current run, so only one worker process runs it (see utils.Scheduler). A worker may take
+    the lease once it has expired, or renew it if it already holds it.
+    """
+
+    __tablename__: str = "job_leases"
+
+    name: Mapped[str] = mapped_column(unique=True, nullable=False)
+    owner: Mapped[str] = mapped_column(nullable=False)
+    expires_at: Mapped[float] = mapped_column(nullable=False)  # Unix time
+
+
+class StaleRating(Base):
+    """
+    A game whose ratings need replaying because its history changed (an edited or deleted match) - the replay runs in
+    the background rather than in the request (see utils.Ratings.refresh_stale). requests counts the changes, so the
+    replay can tell whether another one came in while it ran.
+    """
+
+    __tablename__: str = "stale_ratings"
+
+    game_id: Mapped[int] = mapped_column(ForeignKey("games.id"), unique=True, nullable=False)
+    requests: Mapped[int] = mapped_column(nullable=False, default=1)
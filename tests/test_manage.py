@@ -0,0 +1,69 @@
+"""
+Tests for the management commands, run as the command line runs them - a fresh process per command, so each picks up
+its own environment (e.g. DTS_DB_PROFILE).
+
+Run from the project root: python -m unittest discover tests
+"""
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import closing
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class GenerateTest(unittest.TestCase):
+    """
+    `manage.py generate` under each storage profile.
+    """
+
+    def generate(self, profile: str) -> Path:
+        """
+        Runs generate into a new database with the given storage profile
+        :param profile:
+        :return: The database file
+        """
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        database = Path(directory.name) / "generated.db"
+        command = [sys.executable, "manage.py", "--database", str(database), "generate"]
+        command += ["--users", "50", "--games", "3", "--matches", "200"]
+        result = subprocess.run(
+            command, cwd=ROOT, env={**os.environ, "DTS_DB_PROFILE": profile}, capture_output=True, text=True
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return database
+
+    @staticmethod
+    def count(connection: sqlite3.Connection, table: str) -> int:
+        return connection.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+
+    def check(self, database: Path) -> None:
+        """
+        Checks the generated rows, the read models built from them and the planner statistics are all there
+        :param database:
+        :return:
+        """
+        with closing(sqlite3.connect(database)) as connection:
+            self.assertEqual(self.count(connection, "users"), 50)
+            self.assertEqual(self.count(connection, "games"), 3)
+            self.assertEqual(self.count(connection, "matches"), 200)
+            self.assertEqual(self.count(connection, "user_stats"), 50)
+            self.assertGreater(self.count(connection, "leaderboard"), 0)
+            self.assertGreater(self.count(connection, "ratings"), 0)
+            self.assertGreater(self.count(connection, "sqlite_stat1"), 0)  # ANALYZE ran
+
+    def test_default_profile(self):
+        self.check(self.generate("default"))
+
+    def test_production_profile(self):
+        # Reads use read-only connections here, so the writes after the data is generated must reach the writer
+        self.check(self.generate("production"))
+
+
+if __name__ == "__main__":
+    unittest.main()
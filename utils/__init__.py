@@ -7,5 +7,29 @@
 F401: module imported but unused
 """
 
+from .storage import *  # noqa F401
+from .migrations import *  # noqa F401
+from .slow_queries import *  # noqa F401
 from .db_utils import *  # noqa F401
+from .cache import *  # noqa F401
+from .shared_cache import *  # noqa F401
+from .versions import *  # noqa F401
+from .response_cache import *  # noqa F401
+from .hashing import *  # noqa F401
 from .auth import *  # noqa F401
+from .rate_limit import *  # noqa F401
+from .leaderboard import *  # noqa F401
+from .ratings import *  # noqa F401
+from .stats import *  # noqa F401
+from .match_details import *  # noqa F401
+from .purge import *  # noqa F401
+from .broadcast import *  # noqa F401
+from .importer import *  # noqa F401
+from .exporter import *  # noqa F401
+from .synthetic import *  # noqa F401
+from .query_plans import *  # noqa F401
+from .metrics import *  # noqa F401
+from .sampling import *  # noqa F401
+from .startup import *  # noqa F401
+from .maintenance import *  # noqa F401
+from .scheduler import *  # noqa F401
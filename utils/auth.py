@@ -6,19 +6,35 @@
  - Places most code into a class
 """
 
+import time
 from datetime import UTC, datetime, timedelta
 from typing import Optional, Tuple
 
 from fastapi import HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-
 from models import User
-from models.pydantic import TokenData, UserInDB
-from utils import Database
+from models.pydantic import TokenData
+from utils import Database, projection_type
+from utils.cache import TTLCache
+from utils.hashing import HashingPool, hash_password, pwd_context, verify_and_update
+from utils.versions import data_versions, row_key
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# What's read of a user to authenticate them - everything but the derived relationships
+USER_COLUMNS = (
+    "id",
+    "email",
+    "username",
+    "password",
+    "role",
+    "first_name",
+    "last_name",
+    "year_level",
+    "house",
+    "created_at",
+)
+UserRow = projection_type("UserRow", USER_COLUMNS)
 
 
 def get_authdata(token: str):
@@ -27,7 +43,7 @@ def get_authdata(token: str):
         username: str = payload.get("sub")
         if username is None:
             raise Auth.credentials_exception
-        token_data = TokenData(username=username)
+        token_data = TokenData(username=username, expires=payload.get("exp"))
     except JWTError:
         raise Auth.credentials_exception
     # fastapi dependency injection doesn't support what i'm trying to do well enough, so this is a nasty workaround
@@ -47,7 +63,16 @@ class Auth(object):
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+    pwd_context = pwd_context
+    hashing_pool = HashingPool()  # Argon2 runs here rather than on the event loop
+
+    # Resolved users by token, so authenticated requests can skip the JWT decode and the user query.
+    # Entries never outlive their token, and the app evicts a user's entries when their row is edited or deleted.
+    # Each entry also records the version of the user's own row, so a user changed through another worker isn't served
+    # stale - while writes to other users (a registration, someone else's password rehash) leave it alone.
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 60  # seconds
+    user_cache = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
 
     @classmethod
     def verify_password(cls, plain_password, hashed_password):
@@ -57,21 +82,58 @@ def verify_password(cls, plain_password, hashed_password):
     def get_password_hash(cls, password):
         return cls.pwd_context.hash(password)
 
+    @classmethod
+    async def hash_password(cls, password: str) -> str:
+        return await cls.hashing_pool.run("hash", hash_password, password)
+
+    @classmethod
+    async def check_password(cls, plain_password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+        return await cls.hashing_pool.run("verify", verify_and_update, plain_password, hashed_password)
+
     @staticmethod
-    async def get_user_object(session, username: str):
-        data = await Database.retrieve_by_field(session, User, User.username, username)
-        if data:
-            data_dict = data.__dict__
-            data_dict.pop("_sa_instance_state", None)  # remove unwanted SQLAlchemy fields
-            return UserInDB(**data_dict)
+    async def get_user_object(session, username: str) -> Optional[UserRow]:
+        # A projection rather than an ORM object copied into a Pydantic model - this runs on every uncached request
+        statement = Database.columns(User, *USER_COLUMNS).where(User.username == username)
+        return await Database.project_one(session, statement, "UserRow")
+
+    @classmethod
+    async def get_user_from_token(cls, session, token: str):
+        cached = cls.user_cache.get(token)
+        if cached is not None:
+            if cached[0] == data_versions.get(row_key("users", cached[1].id)):
+                return cached[1]
+            cls.user_cache.reject(token)
+        # Read before the query - the row's version can only be read once the id is known, so if any user changed
+        # while the query ran, the row just read may predate the version and isn't cached
+        table_version = data_versions.get("users")
+        data = get_authdata(token)
+        user = await cls.get_user_object(session, username=data.username)
+        if user is not None:
+            version = data_versions.get(row_key("users", user.id))
+            if data_versions.get("users") == table_version:
+                ttl = cls.USER_CACHE_TTL
+                if data.expires is not None:
+                    ttl = min(ttl, data.expires.timestamp() - time.time())
+                cls.user_cache.set(token, (version, user), ttl)
+        return user
+
+    @classmethod
+    def forget_user(cls, user_id: int) -> None:
+        cls.user_cache.evict(lambda entry: entry[1].id == user_id)
 
     @classmethod
     async def authenticate_user(cls, session, username: str, password: str):
         user = await cls.get_user_object(session, username)
         if not user:
             return False
-        if not cls.verify_password(password, user.password):
+        verified, new_hash = await cls.check_password(password, user.password)
+        if not verified:
             return False
+        if new_hash is not None:
+            # The stored hash used outdated pwd_context parameters - replace it now that the plain password is known
+            await Database.update(session, User, user.id, {"password": new_hash})
+            user = user._replace(password=new_hash)
+            cls.forget_user(user.id)
         return user
 
     @classmethod
@@ -0,0 +1,150 @@
+"""
+Server-sent events.
+
+The Broadcaster fans events out to every subscribed client from one place: an event is serialized once when it's
+published and the same bytes are queued for each client, so a change costs whatever queries the publisher ran to
+describe it once, however many clients are listening. Each client has a small bounded queue - a client that falls
+behind far enough to fill it is dropped (its stream ends, and browsers reconnect by themselves) rather than letting
+events pile up in memory.
+
+Events are per process: with several workers, a client only hears about the changes made through its own worker.
+"""
+import asyncio
+import json
+from collections.abc import AsyncIterator
+from typing import Optional
+
+from utils.config import env_float, env_int
+
+
+class BroadcasterFull(Exception):
+    """
+    Raised when a client subscribes while the broadcaster already has as many clients as it's allowed.
+    """
+
+    def __init__(self, message: str) -> None:
+        """
+        Initialization logic for BroadcasterFull object
+        :param message:
+        """
+        self.message = message
+
+
+class Subscriber(object):
+    """
+    One connected client's queue of encoded events.
+    """
+
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self, queue_size: int):
+        self.queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(queue_size)
+        self.dropped: bool = False
+
+
+class Broadcaster(object):
+    """
+    In-process fan-out of events to server-sent event streams.
+    """
+
+    QUEUE_SIZE = env_int("SSE_QUEUE_SIZE", 64)  # events a client may fall behind by before it's dropped
+    MAX_CLIENTS = env_int("SSE_MAX_CLIENTS", 5000)
+    HEARTBEAT = env_float("SSE_HEARTBEAT", 15)  # seconds between keep-alive comments on an idle stream
+
+    def __init__(self, queue_size: int = QUEUE_SIZE, max_clients: int = MAX_CLIENTS, heartbeat: float = HEARTBEAT):
+        """
+        Broadcaster initialization
+        :param queue_size:
+        :param max_clients:
+        :param heartbeat:
+        """
+        self.queue_size: int = queue_size
+        self.max_clients: int = max_clients
+        self.heartbeat: float = heartbeat
+        self.subscribers: set[Subscriber] = set()
+        self.published: int = 0
+        self.dropped: int = 0
+
+    @staticmethod
+    def encode(event: str, data: dict) -> bytes:
+        return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+
+    def publish(self, event: str, data: dict) -> None:
+        """
+        Queues an event for every client, dropping clients whose queue is full
+        :param event: Event name (what the browser's EventSource listens for)
+        :param data: JSON-serializable payload
+        :return:
+        """
+        message = self.encode(event, data)
+        self.published += 1
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.drop(subscriber)
+
+    def drop(self, subscriber: Subscriber) -> None:
+        # Replaces whatever is queued with the end-of-stream marker, so the client's stream ends straight away
+        self.subscribers.discard(subscriber)
+        subscriber.dropped = True
+        self.dropped += 1
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def check_capacity(self) -> None:
+        """
+        Checks another client can subscribe, before its response starts
+        :return:
+        """
+        if len(self.subscribers) >= self.max_clients:
+            raise BroadcasterFull(f"{len(self.subscribers)} clients are already subscribed")
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """
+        Subscribes a client and yields its event stream, which ends when the client is dropped (or when the response
+        is cancelled because the client disconnected). The client is only registered once the stream starts, so one
+        that disconnects before then never is.
+        :return:
+        """
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        try:
+            # Tells the browser how long to wait before reconnecting if the stream ends
+            yield b"retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    # Keeps proxies from closing an idle connection
+                    yield b": keep-alive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def stats(self) -> dict:
+        return {"clients": len(self.subscribers), "published": self.published, "dropped": self.dropped}
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the event streams' counts in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_sse"
+        lines = [
+            f"# HELP {name}_clients Clients connected to the event stream.",
+            f"# TYPE {name}_clients gauge",
+            f"{name}_clients {len(self.subscribers)}",
+            f"# HELP {name}_published_total Events published to the connected clients.",
+            f"# TYPE {name}_published_total counter",
+            f"{name}_published_total {self.published}",
+            f"# HELP {name}_dropped_total Clients dropped for falling too far behind.",
+            f"# TYPE {name}_dropped_total counter",
+            f"{name}_dropped_total {self.dropped}",
+        ]
+        return "\n".join(lines) + "\n"
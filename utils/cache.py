@@ -0,0 +1,132 @@
+"""
+In-process caching utilities
+"""
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any, Optional
+
+
+class TTLCache(object):
+    """
+    Bounded least-recently-used cache whose entries also expire after a time-to-live.
+    This runs on the event loop thread only, so there's no locking. Hits and misses are counted for monitoring.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        Cache initialization
+        :param maxsize: The maximum number of entries - the least recently used entry is dropped past this
+        :param ttl: Default lifetime of an entry, in seconds
+        """
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Gets a live entry, marking it as recently used
+        :param key:
+        :param default: Returned (and counted as a miss) if there is no live entry
+        :return:
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Adds or replaces an entry, evicting the least recently used entries if the cache is full
+        :param key:
+        :param value:
+        :param ttl: Optional lifetime for this entry, in seconds (defaults to the cache's ttl)
+        :return:
+        """
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        """
+        Removes an entry if it exists
+        :param key:
+        :return:
+        """
+        self._entries.pop(key, None)
+
+    def reject(self, key: Hashable) -> None:
+        """
+        Removes an entry that get() has just returned but turned out to be out of date, counting the lookup as a miss
+        :param key:
+        :return:
+        """
+        self._entries.pop(key, None)
+        self.hits -= 1
+        self.misses += 1
+
+    def evict(self, predicate: Callable[[Any], bool]) -> int:
+        """
+        Removes every entry whose value matches the predicate - for invalidating by something other than the key
+        :param predicate:
+        :return: The number of entries removed
+        """
+        stale = [key for key, (_, value) in self._entries.items() if predicate(value)]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def clear(self) -> None:
+        """
+        Removes every entry
+        :return:
+        """
+        self._entries.clear()
+
+    def render(self, name: str, description: str, prefix: str = "dts") -> str:
+        """
+        Renders the cache's size and hit/miss counters in the Prometheus text exposition format
+        :param name: The cache's name in the metric names, e.g. "user" for dts_user_cache_hits_total
+        :param description: What the cache holds, for the help text
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_{name}_cache"
+        lines = [
+            f"# HELP {name}_hits_total Lookups answered from the cache of {description}.",
+            f"# TYPE {name}_hits_total counter",
+            f"{name}_hits_total {self.hits}",
+            f"# HELP {name}_misses_total Lookups the cache of {description} couldn't answer.",
+            f"# TYPE {name}_misses_total counter",
+            f"{name}_misses_total {self.misses}",
+            f"# HELP {name}_entries Entries in the cache of {description}.",
+            f"# TYPE {name}_entries gauge",
+            f"{name}_entries {len(self._entries)}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def stats(self) -> dict:
+        """
+        Reports the cache's size and hit/miss counters
+        :return:
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
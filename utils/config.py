@@ -0,0 +1,53 @@
+"""
+Environment-based configuration helpers.
+Settings are read once, where they're used (usually as class constants), and fall back to the given default when the
+variable isn't set. Every variable the app reads is prefixed with DTS_ to keep them together.
+"""
+import os
+
+PREFIX = "DTS_"
+
+
+def env_str(name: str, default: str) -> str:
+    """
+    Reads a string setting
+    :param name: Variable name without the prefix
+    :param default:
+    :return:
+    """
+    return os.environ.get(PREFIX + name, default)
+
+
+def env_int(name: str, default: int) -> int:
+    """
+    Reads an integer setting
+    :param name: Variable name without the prefix
+    :param default:
+    :return:
+    """
+    value = os.environ.get(PREFIX + name)
+    return default if value is None or value == "" else int(value)
+
+
+def env_float(name: str, default: float) -> float:
+    """
+    Reads a float setting
+    :param name: Variable name without the prefix
+    :param default:
+    :return:
+    """
+    value = os.environ.get(PREFIX + name)
+    return default if value is None or value == "" else float(value)
+
+
+def env_bool(name: str, default: bool) -> bool:
+    """
+    Reads a boolean setting - 1/true/yes/on (any case) are true, anything else set is false
+    :param name: Variable name without the prefix
+    :param default:
+    :return:
+    """
+    value = os.environ.get(PREFIX + name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
@@ -1,16 +1,93 @@
 """
 Database utilities
 """
-from typing import Optional, Sequence, Type
-from collections.abc import AsyncGenerator
+import asyncio
+import base64
+import json
+from collections import namedtuple
+from datetime import UTC, date, datetime, timedelta
+from functools import lru_cache
+from typing import Any, Optional, Sequence, Type
+from collections.abc import AsyncGenerator, Awaitable, Callable
 
-from sqlalchemy import update, select, delete, func
-from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy import Row, Select, update, select, delete, exists, func, text, tuple_
+from sqlalchemy.exc import IntegrityError, NoResultFound, SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import aliased
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
-from models import Base
+from models import Base, Game, Match, MatchPlayers, MatchResult, Tombstone, User
+from utils.config import env_bool, env_int
+from utils.migrations import SchemaManager
+from utils.shared_cache import SharedCache
+from utils.slow_queries import SlowQueryLog
+from utils.storage import RoutingSession, StorageProfile, apply_pragmas, enable_savepoints, get_profile
+from utils.versions import data_versions, row_key, written_tables
 
 type base_type = Type[Base]  # type alias for a base type
+type commit_hook = Callable[[AsyncSession], Awaitable[None]]  # type alias for work staged before a commit
+
+
+@lru_cache(maxsize=None)
+def projection_type(name: str, fields: tuple[str, ...]) -> type:
+    """
+    Named tuple class for rows of the given columns - created once per name and column list
+    :param name: Class name
+    :param fields: Column names, in order
+    :return:
+    """
+    projection = namedtuple(name, fields, rename=True)
+    # The class isn't a module attribute pickle could find - this is how to recreate it instead (see SharedCache.dumps)
+    projection._class_reduce = (projection_type, (name, fields))
+    return projection
+
+
+class Page(object):
+    """
+    One page of a keyset-paginated listing.
+    """
+
+    def __init__(self, items: Sequence[tuple], next_cursor: Optional[str]):
+        """
+        Page initialization
+        :param items: Named tuples (see Database.project)
+        :param next_cursor: Opaque cursor for the following page, or None if this is the last page
+        """
+        self.items: Sequence[tuple] = items
+        self.next_cursor: Optional[str] = next_cursor
+
+
+def encode_cursor(values: Sequence[Any]) -> str:
+    """
+    Encodes the sort key of the last row on a page as an opaque, URL-safe cursor
+    :param values:
+    :return:
+    """
+    plain = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(plain).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, columns: Sequence) -> list[Any]:
+    """
+    Decodes a cursor made by encode_cursor for the same sort columns
+    :param cursor:
+    :param columns:
+    :return:
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError("cursor doesn't match the sort order")
+        # Only scalars can be compared with a column - a list or object would fail in the query, not here (bool is an
+        # int to isinstance, so it's ruled out by name)
+        if any(value is not None and type(value) not in (int, float, str) for value in values):
+            raise ValueError("cursor values must be numbers, strings or null")
+        return [
+            datetime.fromisoformat(value) if column.type.python_type is datetime else value
+            for column, value in zip(columns, values)
+        ]
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {e}") from None
 
 
 class Database(object):
@@ -20,14 +97,22 @@ class Database(object):
      with object terms, where it sounds more natural.
     """
 
-    def __init__(self, db_name: str):
+    PAGE_SIZE = env_int("PAGE_SIZE", 50)  # default rows per page for paginated listings
+
+    def __init__(self, db_name: str, profile: Optional[str] = None):
         """
         Database initialization - call connect() to 'connect' to the database
         :param db_name:
+        :param profile: Optional storage profile name (see utils.storage - defaults to the DTS_DB_PROFILE setting)
         """
         self._db_name: str = db_name
-        self.engine: Optional[AsyncEngine] = None
+        self.profile: StorageProfile = get_profile(profile)
+        self.engine: Optional[AsyncEngine] = None  # the writer when the profile splits reads and writes
+        self.read_engine: Optional[AsyncEngine] = None  # same as engine unless the profile splits
         self.LocalSession: Optional[async_sessionmaker] = None
+        self.write_batcher: Optional[WriteBatcher] = None  # set by connect() when write batching is enabled
+        self.schema_versions: tuple[int, int] = (0, 0)  # schema version before and after connect()'s upgrade
+        self.slow_queries: Optional[SlowQueryLog] = None  # set by connect() when DTS_SLOW_QUERY_MS is set
         # self.sessions: List = []
 
     async def connect(self) -> None:
@@ -42,13 +127,83 @@ async def connect(self) -> None:
          :return:
         """
         # Sets the engine and sessionmaker variables here - asmall way of making sure this method is called first
-        self.engine: AsyncEngine = create_async_engine(f"sqlite+aiosqlite:///{self._db_name}")
-        self.LocalSession: async_sessionmaker = async_sessionmaker(self.engine)
-        # Creates the tables if they don't exist
-        async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+        url = f"sqlite+aiosqlite:///{self._db_name}"
+        if self.profile.split:
+            # A single writer connection, and a pool of read-only connections that sessions route reads to
+            self.engine: AsyncEngine = create_async_engine(
+                url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0
+            )
+            self.read_engine: AsyncEngine = create_async_engine(
+                url, poolclass=AsyncAdaptedQueuePool, pool_size=self.profile.readers, max_overflow=0
+            )
+            apply_pragmas(self.read_engine.sync_engine, self.profile.read_pragmas)
+            self.LocalSession: async_sessionmaker = async_sessionmaker(
+                sync_session_class=RoutingSession,
+                info={"writer": self.engine.sync_engine, "reader": self.read_engine.sync_engine},
+            )
+        else:
+            self.engine: AsyncEngine = create_async_engine(url)
+            self.read_engine: AsyncEngine = self.engine
+            self.LocalSession: async_sessionmaker = async_sessionmaker(self.engine)
+        apply_pragmas(self.engine.sync_engine, self.profile.pragmas)
+        # Creates the tables if they don't exist, or upgrades them if they're from an older version
+        self.schema_versions = await SchemaManager.upgrade(self.engine)
+        if WriteBatcher.ENABLED:
+            self.write_batcher = WriteBatcher(url, self.profile)
+        # With several workers, the table versions bumped by every write are kept where all of them can see them
+        if SharedCache.enabled():
+            data_versions.share(SharedCache.versions_path())
+            # The versions outlive the process, and the database may have been replaced or restored since they were
+            # last bumped - so nothing cached before this point is trusted
+            data_versions.bump(Base.metadata.tables)
+        # Logs slow statements from here on (so the schema upgrade above isn't logged)
+        if SlowQueryLog.enabled():
+            self.slow_queries = SlowQueryLog()
+            for engine in self.engines():
+                self.slow_queries.attach(engine.sync_engine)
         return None
 
+    async def disconnect(self) -> None:
+        """
+        Closes every pooled connection
+        :return:
+        """
+        if self.write_batcher is not None:
+            await self.write_batcher.close()
+        if self.read_engine is not None and self.read_engine is not self.engine:
+            await self.read_engine.dispose()
+        if self.engine is not None:
+            await self.engine.dispose()
+        return None
+
+    def engines(self) -> list[AsyncEngine]:
+        """
+        Lists every engine connect() created (writer, readers and the write batcher's), e.g. to attach event hooks
+        :return:
+        """
+        engines = [self.engine]
+        if self.read_engine is not self.engine:
+            engines.append(self.read_engine)
+        if self.write_batcher is not None:
+            engines.append(self.write_batcher.engine)
+        return engines
+
+    async def storage_settings(self) -> dict:
+        """
+        Reports the active storage profile, including the pragma values the writer connection actually has
+        :return:
+        """
+        pragmas = {}
+        async with self.engine.connect() as conn:
+            for name in ("journal_mode", "synchronous", "cache_size", "mmap_size", "busy_timeout"):
+                pragmas[name] = (await conn.execute(text(f"PRAGMA {name}"))).scalar()
+        return {
+            "profile": self.profile.name,
+            "split": self.profile.split,
+            "readers": self.profile.readers,
+            "pragmas": pragmas,
+        }
+
     async def get_session(self) -> AsyncGenerator[AsyncSession, None]:
         """
         Yields a session
@@ -64,17 +219,20 @@ async def get_session(self) -> AsyncGenerator[AsyncSession, None]:
                 await session.close()
 
     @staticmethod
-    async def insert(session: AsyncSession, model: Base):
+    async def insert(session: AsyncSession, model: Base, before_commit: Optional[commit_hook] = None):
         """
         Inserts a model into the database
         :param session:
         :param model:
+        :param before_commit: Optional coroutine function run after the flush, in the same transaction as the insert
         :return:
         """
         try:
             session.add(model)
             await session.flush()
             model_id = model.id
+            if before_commit is not None:
+                await before_commit(session)
             await session.commit()
             return model_id
         except IntegrityError:
@@ -88,18 +246,31 @@ async def insert(session: AsyncSession, model: Base):
             raise DatabaseError(f"Exception encountered whilst executing: {e}")
 
     @staticmethod
-    async def update(session: AsyncSession, model: Type[Base], identifier: int, data: dict):
+    async def update(
+        session: AsyncSession,
+        model: Type[Base],
+        identifier: int,
+        data: dict,
+        before_commit: Optional[commit_hook] = None,
+    ):
         """
         Updates a row in the database
         :param data:
         :param session:
         :param model:
         :param identifier:
+        :param before_commit: Optional coroutine function run in the same transaction, only if a row was updated
         :return:
+        :raises NoResultFound: If there is no such row (so the caller can tell a deleted one from one that never was)
         """
         try:
             statement = update(model).where(model.id == identifier).values(data)
-            await session.execute(statement)
+            executed = await session.execute(statement)
+            if not executed.rowcount:
+                raise NoResultFound(f"No {model.__tablename__} row with id {identifier}")
+            written_tables(session).add(row_key(model.__tablename__, identifier))
+            if before_commit is not None:
+                await before_commit(session)
             await session.commit()
         except IntegrityError:
             await session.rollback()
@@ -138,6 +309,45 @@ async def retrieve_by_field(session: AsyncSession, model: base_type, field, iden
         executed = await session.execute(statement)
         return executed.scalar_one_or_none()
 
+    @staticmethod
+    def columns(model: base_type, *names: str) -> Select:
+        """
+        Statement selecting only the named columns of a model's table
+        :param model:
+        :param names: Attribute names, e.g. "id", "username"
+        :return:
+        """
+        return select(*(getattr(model, name) for name in names))
+
+    @staticmethod
+    async def project(session: AsyncSession, statement: Select, name: str = "Projection") -> list[tuple]:
+        """
+        Runs a column statement, returning its rows as named tuples (fields named after the selected columns).
+        Rows are plain immutable tuples - unlike ORM objects they aren't tracked by the session's identity map and have
+        no per-instance state or __dict__, which makes them several times cheaper to build for pages that only need a
+        few columns.
+        :param session:
+        :param statement: A select of columns (e.g. from columns()), not of entities
+        :param name: Class name of the rows
+        :return:
+        """
+        executed = await session.execute(statement)
+        make = projection_type(name, tuple(executed.keys()))._make
+        return [make(row) for row in executed.all()]
+
+    @staticmethod
+    async def project_one(session: AsyncSession, statement: Select, name: str = "Projection") -> Optional[tuple]:
+        """
+        Like project(), for at most one row (use-case: lookup by a UNIQUE column)
+        :param session:
+        :param statement:
+        :param name:
+        :return: The row, or None if there isn't one
+        """
+        executed = await session.execute(statement.limit(1))
+        row = executed.first()
+        return None if row is None else projection_type(name, tuple(executed.keys()))._make(row)
+
     @staticmethod
     async def dump_all(session: AsyncSession, model: base_type) -> Sequence[Base]:
         """
@@ -150,6 +360,138 @@ async def dump_all(session: AsyncSession, model: base_type) -> Sequence[Base]:
         executed = await session.execute(statement)
         return executed.scalars().all()
 
+    @staticmethod
+    async def paginate(
+        session: AsyncSession,
+        statement: Select,
+        order: Sequence,
+        cursor: Optional[str] = None,
+        limit: int = PAGE_SIZE,
+        descending: bool = False,
+    ) -> Page:
+        """
+        Fetches one page of a statement's rows, continuing after the cursor's position (keyset pagination).
+        Unlike OFFSET, the database seeks straight to the cursor through an index on the sort columns, so every page
+        costs the same no matter how far into the table it is.
+        :param session:
+        :param statement: The rows to page through - must select every column in order
+        :param order: Sort columns, ending in a unique one (usually id) so the order is total
+        :param cursor: The previous page's next_cursor, or None for the first page
+        :param limit: Rows per page
+        :param descending: Whether to sort in descending order
+        :return:
+        """
+        if cursor is not None:
+            key = tuple_(*order)
+            values = tuple_(*decode_cursor(cursor, order))
+            statement = statement.where(key < values if descending else key > values)
+        statement = statement.order_by(*(column.desc() if descending else column for column in order))
+        # One extra row tells whether there's another page without a separate COUNT
+        rows = await Database.project(session, statement.limit(limit + 1), "PageRow")
+        if len(rows) <= limit:
+            return Page(rows, None)
+        rows = rows[:limit]
+        return Page(rows, encode_cursor([getattr(rows[-1], column.key) for column in order]))
+
+    @staticmethod
+    def game_plays_statement() -> Select:
+        """
+        Statement for the number of matches played of each game, most played first
+        :return:
+        """
+        return (
+            select(Game.name, func.count(Match.game_id).label("matches"))
+            .join(Match, Match.game_id == Game.id)
+            .group_by(Game.name)
+            .order_by(func.count(Match.game_id).desc())
+        )
+
+    @staticmethod
+    def games_statement() -> Select:
+        """
+        Statement for games, as rows rather than ORM objects
+        :return:
+        """
+        return Database.columns(Game, "id", "name", "description")
+
+    @staticmethod
+    def matches_statement() -> Select:
+        """
+        Statement for matches with their game and players (a match's two players are its winner and loser)
+        :return:
+        """
+        winner = aliased(User)
+        loser = aliased(User)
+        return (
+            select(
+                Match.id,
+                Game.name.label("game"),
+                winner.username.label("winner"),
+                loser.username.label("loser"),
+                Match.played_at,
+                Match.created_at,
+            )
+            .join(Game, Game.id == Match.game_id)
+            .outerjoin(MatchResult, MatchResult.match_id == Match.id)
+            .outerjoin(winner, winner.id == MatchResult.won_id)
+            .outerjoin(loser, loser.id == MatchResult.lost_id)
+        )
+
+    @staticmethod
+    def filter_matches(
+        statement: Select,
+        game_id: Optional[int] = None,
+        player_id: Optional[int] = None,
+        played_from: Optional[date] = None,
+        played_to: Optional[date] = None,
+    ) -> Select:
+        """
+        Limits a statement selecting from matches to the matches meeting the given conditions
+        :param statement:
+        :param game_id: Only matches of this game
+        :param player_id: Only matches this user played in
+        :param played_from: Only matches played on or after this day
+        :param played_to: Only matches played on or before this day
+        :return:
+        """
+        if game_id is not None:
+            statement = statement.where(Match.game_id == game_id)
+        if player_id is not None:
+            statement = statement.where(
+                exists().where(MatchPlayers.match_id == Match.id, MatchPlayers.player_id == player_id)
+            )
+        if played_from is not None:
+            statement = statement.where(Match.played_at >= datetime.combine(played_from, datetime.min.time()))
+        if played_to is not None:
+            statement = statement.where(
+                Match.played_at < datetime.combine(played_to + timedelta(days=1), datetime.min.time())
+            )
+        return statement
+
+    @staticmethod
+    async def list_matches(
+        session: AsyncSession,
+        cursor: Optional[str] = None,
+        limit: int = PAGE_SIZE,
+        game_id: Optional[int] = None,
+        player_id: Optional[int] = None,
+        played_from: Optional[date] = None,
+        played_to: Optional[date] = None,
+    ) -> Page:
+        """
+        Lists matches, most recently played first, one page at a time
+        :param session:
+        :param cursor: The previous page's next_cursor, or None for the first page
+        :param limit: Matches per page
+        :param game_id: Only matches of this game
+        :param player_id: Only matches this user played in
+        :param played_from: Only matches played on or after this day
+        :param played_to: Only matches played on or before this day
+        :return:
+        """
+        statement = Database.filter_matches(Database.matches_statement(), game_id, player_id, played_from, played_to)
+        return await Database.paginate(session, statement, [Match.played_at, Match.id], cursor, limit, descending=True)
+
     @staticmethod
     async def dump_by_field_descending(session: AsyncSession, field, label, limit: Optional[int] = None):
         """
@@ -167,17 +509,29 @@ async def dump_by_field_descending(session: AsyncSession, field, label, limit: O
         return executed.all()
 
     @staticmethod
-    async def remove_record(session: AsyncSession, model: base_type, identifier: int):
+    async def remove_record(
+        session: AsyncSession, model: base_type, identifier: int, before_commit: Optional[commit_hook] = None
+    ):
         """
-        Removes a record from the database
+        Removes a record from the database, leaving a tombstone in its place - only the row itself is deleted here,
+        and its dependents are left for the background purge (see utils.Purger), so a delete is quick however much
+        depends on the row
         :param session:
         :param model:
         :param identifier:
+        :param before_commit: Optional coroutine function run in the same transaction, only if a row was removed
         :return:
         """
         try:
             statement = delete(model).where(model.id == identifier)
-            await session.execute(statement)
+            executed = await session.execute(statement)
+            if executed.rowcount:
+                written_tables(session).add(row_key(model.__tablename__, identifier))
+                session.add(
+                    Tombstone(table_name=model.__tablename__, row_id=identifier, deleted_at=datetime.now(tz=UTC))
+                )
+                if before_commit is not None:
+                    await before_commit(session)
             await session.commit()
         except SQLAlchemyError:
             await session.rollback()
@@ -189,17 +543,174 @@ async def remove_record(session: AsyncSession, model: base_type, identifier: int
     @staticmethod
     async def has_existed(session: AsyncSession, model: base_type, identifier: int) -> bool:
         """
-        Checks if a record has existed in the database, relying on the auto-incrementing primary key.
-        There are various flaws with this method/implementation, but they are tolerable considering the method is
-        only used to determine whether a response is 404 Not Found or 410 Gone
+        Checks if a record existed and was deleted, from its tombstone - used to decide between 404 Not Found and
+        410 Gone, with one lookup on the tombstones' unique index
         :param identifier:
         :param session:
         :param model:
         :return:
         """
-        statement = select(func.max(model.id))
-        executed = await session.execute(statement)
-        return executed.scalar() >= identifier
+        executed = await session.execute(Database.tombstone_statement(model, identifier))
+        return bool(executed.scalar())
+
+    @staticmethod
+    def tombstone_statement(model: base_type, identifier: int) -> Select:
+        return select(exists().where(Tombstone.table_name == model.__tablename__, Tombstone.row_id == identifier))
+
+
+class WriteBatcher(object):
+    """
+    Opt-in group commit for inserts (DTS_WRITE_BATCHING=1).
+    Inserts from concurrent requests are collected for up to MAX_DELAY_MS, or until MAX_SIZE are waiting, and then
+    committed in one transaction, so they share one fsync instead of paying for one each. A batch is first flushed all
+    at once; if anything in it fails, it's retried with every insert (and its before_commit hook) in its own savepoint,
+    so a conflicting insert raises IntegrityError for its caller only and the rest of the batch still commits.
+    Batches use their own single-connection engine, since savepoints need different driver transaction handling to the
+    rest of the app.
+    """
+
+    ENABLED = env_bool("WRITE_BATCHING", False)
+    MAX_DELAY_MS = env_int("WRITE_BATCH_DELAY_MS", 5)
+    MAX_SIZE = env_int("WRITE_BATCH_SIZE", 64)
+
+    def __init__(self, url: str, profile: StorageProfile, max_delay_ms: int = MAX_DELAY_MS, max_size: int = MAX_SIZE):
+        """
+        Batcher initialization
+        :param url: Database URL
+        :param profile: Storage profile whose pragmas the batch connection uses
+        :param max_delay_ms: How long the first insert of a batch waits for others to join it
+        :param max_size: Batch size that commits straight away
+        """
+        self.engine: AsyncEngine = create_async_engine(
+            url, poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0
+        )
+        apply_pragmas(self.engine.sync_engine, profile.pragmas)
+        enable_savepoints(self.engine.sync_engine)
+        self.BatchSession: async_sessionmaker = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.max_delay: float = max_delay_ms / 1000
+        self.max_size: int = max_size
+        self.batches: int = 0
+        self.inserts: int = 0
+        self.fallbacks: int = 0  # batches that had to be retried one insert at a time
+        self._pending: list[tuple[Base, Optional[commit_hook], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._commits: set[asyncio.Task] = set()
+        self._lock = asyncio.Lock()  # one batch commits at a time - the next one fills up in the meantime
+
+    async def insert(self, model: Base, before_commit: Optional[commit_hook] = None):
+        """
+        Queues a model for insertion and waits for its batch to commit
+        :param model: A new (transient) model instance
+        :param before_commit: Optional coroutine function run in the insert's savepoint, given the batch session
+        :return: The new row's id
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((model, before_commit, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._commit(batch))
+            self._commits.add(task)
+            task.add_done_callback(self._commits.discard)
+
+    @staticmethod
+    async def _insert_together(session: AsyncSession, batch: list) -> list:
+        """
+        Inserts the whole batch in one savepoint and one flush, which lets SQLAlchemy send each table's rows as a
+        single multi-row statement. Any failure rolls the savepoint back and is left to _insert_separately.
+        """
+        async with session.begin_nested():
+            session.add_all([model for model, _, _ in batch])
+            await session.flush()
+            for _, before_commit, _ in batch:
+                if before_commit is not None:
+                    await before_commit(session)
+        return [(future, model.id, None) for model, _, future in batch]
+
+    @staticmethod
+    async def _insert_separately(session: AsyncSession, batch: list) -> list:
+        """
+        Inserts each model of the batch in its own savepoint, so a failing insert only takes itself out of the batch
+        """
+        outcomes = []
+        for model, before_commit, future in batch:
+            try:
+                async with session.begin_nested():
+                    session.add(model)
+                    await session.flush()
+                    if before_commit is not None:
+                        await before_commit(session)
+                outcomes.append((future, model.id, None))
+            except SQLAlchemyError as e:  # including IntegrityError, passed on as-is
+                outcomes.append((future, None, e))
+            except Exception as e:
+                outcomes.append((future, None, DatabaseError(f"Exception encountered whilst executing: {e}")))
+        return outcomes
+
+    async def _commit(self, batch: list[tuple[Base, Optional[commit_hook], asyncio.Future]]) -> None:
+        async with self._lock:
+            try:
+                async with self.BatchSession() as session:
+                    try:
+                        outcomes = await self._insert_together(session, batch)
+                    except Exception:
+                        self.fallbacks += 1
+                        outcomes = await self._insert_separately(session, batch)
+                    await session.commit()
+            except Exception as e:
+                # The commit itself failed, so nothing in the batch was written
+                outcomes = [(future, None, e) for _, _, future in batch]
+        self.batches += 1
+        self.inserts += len(batch)
+        for future, model_id, error in outcomes:
+            if future.done():  # the caller went away
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(model_id)
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "inserts": self.inserts, "fallbacks": self.fallbacks}
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the batcher's counts in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_write_batch"
+        lines = [
+            f"# HELP {name}es_total Insert batches committed.",
+            f"# TYPE {name}es_total counter",
+            f"{name}es_total {self.batches}",
+            f"# HELP {name}_inserts_total Inserts committed in batches.",
+            f"# TYPE {name}_inserts_total counter",
+            f"{name}_inserts_total {self.inserts}",
+            f"# HELP {name}_fallbacks_total Batches retried one insert at a time after one of their inserts failed.",
+            f"# TYPE {name}_fallbacks_total counter",
+            f"{name}_fallbacks_total {self.fallbacks}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    async def close(self) -> None:
+        """
+        Commits whatever is still waiting, then closes the batch connection
+        :return:
+        """
+        self._flush()
+        if self._commits:
+            await asyncio.gather(*self._commits, return_exceptions=True)
+        await self.engine.dispose()
 
 
 class DatabaseError(Exception):
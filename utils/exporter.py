@@ -0,0 +1,73 @@
+"""
+Streaming data exports.
+
+Each export is one SELECT whose result is streamed from the database (AsyncSession.stream with yield_per), encoded a
+batch of rows at a time and handed to the client as it's produced, so memory use depends on the batch size rather than
+the number of rows. Matches are exported with the same game/winner/loser/played_at columns the bulk import reads, so an
+export can be imported into another database.
+"""
+import csv
+import io
+import json
+from collections.abc import AsyncIterator, Sequence
+from typing import Callable
+
+from sqlalchemy import Select
+
+from models import Game, Match
+from utils.config import env_int
+from utils.db_utils import Database
+from utils.leaderboard import Leaderboard
+
+
+def plain(value):
+    """
+    Converts values JSON and CSV can't represent directly - dates and times become ISO 8601 strings
+    :param value:
+    :return:
+    """
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+class Exporter(object):
+    """
+    Encodes streamed query results as NDJSON or CSV.
+    """
+
+    BATCH_SIZE = env_int("EXPORT_BATCH_SIZE", 1000)  # rows fetched from the database and encoded at a time
+    DATASETS: dict[str, Callable[[], Select]] = {
+        "matches": lambda: Database.matches_statement().order_by(Match.id),
+        "games": lambda: Database.games_statement().order_by(Game.id),
+        "leaderboard": Leaderboard.ranking,
+    }
+    MEDIA_TYPES: dict[str, str] = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+    @staticmethod
+    def encode_ndjson(columns: Sequence[str], rows: Sequence[tuple]) -> str:
+        return "".join(json.dumps(dict(zip(columns, row)), default=plain) + "\n" for row in rows)
+
+    @staticmethod
+    def encode_csv(columns: Sequence[str], rows: Sequence[tuple]) -> str:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(map(plain, row) for row in rows)
+        return buffer.getvalue()
+
+    @classmethod
+    async def stream(cls, db: Database, dataset: str, format: str) -> AsyncIterator[str]:
+        """
+        Streams a dataset in the given format. The generator opens its own session, since it runs after the route
+        handler (and its request-scoped session) has returned
+        :param db:
+        :param dataset: A key of DATASETS
+        :param format: A key of MEDIA_TYPES
+        :return:
+        """
+        encode = cls.encode_csv if format == "csv" else cls.encode_ndjson
+        statement = cls.DATASETS[dataset]().execution_options(yield_per=cls.BATCH_SIZE)
+        async with db.LocalSession() as session:
+            result = await session.stream(statement)
+            columns = list(result.keys())
+            if format == "csv":
+                yield cls.encode_csv([], [columns])  # header line
+            async for rows in result.partitions():
+                yield encode(columns, rows)
@@ -0,0 +1,190 @@
+"""
+Password hashing off the event loop.
+
+Argon2 is deliberately slow (tens of milliseconds per hash), so running it inside an async route stalls every other
+request on the worker. HashingPool runs it on a small thread or process pool instead, and rejects work straight away
+once too much is waiting, so a burst of logins gets fast 503s instead of a growing queue.
+"""
+import asyncio
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from passlib.context import CryptContext
+
+from utils.config import env_int, env_str
+
+pwd_context = CryptContext(schemes=["argon2"], deprecated="auto")
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_and_update(password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+    """
+    Verifies a password, also returning a new hash if the stored one uses outdated parameters (or None)
+    :param password:
+    :param hashed_password:
+    :return:
+    """
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def timed_call(function: Callable, *args) -> tuple:
+    """
+    Runs a function in the worker and measures how long it took there (excluding time spent queued)
+    :param function:
+    :param args:
+    :return: The function's result and its runtime in seconds
+    """
+    started = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - started
+
+
+class HashingPoolFull(Exception):
+    """
+    Raised when the hashing pool already has as much work waiting as it's allowed to.
+    """
+
+    def __init__(self, message: str) -> None:
+        """
+        Initialization logic for HashingPoolFull object
+        :param message:
+        """
+        self.message = message
+
+
+class HashingPool(object):
+    """
+    Bounded pool for password hashing.
+    argon2-cffi releases the GIL while hashing, so threads (the default) scale across cores; processes are available
+    for deployments that would rather isolate the CPU work completely.
+    """
+
+    WORKERS = env_int("HASH_WORKERS", 2)
+    MAX_PENDING = env_int("HASH_MAX_PENDING", 16)  # running + queued operations before rejecting
+    KIND = env_str("HASH_POOL", "thread")  # "thread" or "process"
+
+    def __init__(self, workers: int = WORKERS, max_pending: int = MAX_PENDING, kind: str = KIND):
+        """
+        Pool initialization - the executor itself is created on first use
+        :param workers:
+        :param max_pending:
+        :param kind: "thread" or "process"
+        """
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown hashing pool kind: {kind}")
+        self.workers: int = workers
+        self.max_pending: int = max_pending
+        self.kind: str = kind
+        self.pending: int = 0
+        self.rejected: int = 0
+        self.timings: dict[str, dict] = {}
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hashing")
+        return self._executor
+
+    def _record(self, operation: str, runtime: float, waited: float) -> None:
+        timing = self.timings.setdefault(
+            operation, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "total_wait_seconds": 0.0}
+        )
+        timing["count"] += 1
+        timing["total_seconds"] += runtime
+        timing["max_seconds"] = max(timing["max_seconds"], runtime)
+        timing["total_wait_seconds"] += waited
+
+    async def run(self, operation: str, function: Callable, *args):
+        """
+        Runs a hashing function on the pool
+        :param operation: Name the latency is recorded under
+        :param function: A module-level function (so it can be sent to a process pool)
+        :param args:
+        :return: The function's result
+        """
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HashingPoolFull(f"{self.pending} hashing operations already pending")
+        self.pending += 1
+        submitted = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result, runtime = await loop.run_in_executor(self._get_executor(), timed_call, function, *args)
+        finally:
+            self.pending -= 1
+        self._record(operation, runtime, time.perf_counter() - submitted - runtime)
+        return result
+
+    def stats(self) -> dict:
+        """
+        Reports the pool's configuration, load and per-operation latency
+        :return:
+        """
+        return {
+            "kind": self.kind,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "rejected": self.rejected,
+            "operations": {
+                operation: {
+                    **timing,
+                    "mean_seconds": timing["total_seconds"] / timing["count"],
+                    "mean_wait_seconds": timing["total_wait_seconds"] / timing["count"],
+                }
+                for operation, timing in self.timings.items()
+            },
+        }
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the pool's load and per-operation latency in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_hashing"
+        lines = [
+            f"# HELP {name}_duration_seconds Time hashing operations took on the pool, by operation.",
+            f"# TYPE {name}_duration_seconds summary",
+        ]
+        for operation, timing in self.timings.items():
+            lines.append(f'{name}_duration_seconds_sum{{operation="{operation}"}} {timing["total_seconds"]}')
+            lines.append(f'{name}_duration_seconds_count{{operation="{operation}"}} {timing["count"]}')
+        lines += [
+            f"# HELP {name}_duration_seconds_max Longest a hashing operation has taken on the pool, by operation.",
+            f"# TYPE {name}_duration_seconds_max gauge",
+            *(
+                f'{name}_duration_seconds_max{{operation="{operation}"}} {timing["max_seconds"]}'
+                for operation, timing in self.timings.items()
+            ),
+            f"# HELP {name}_wait_seconds Time hashing operations spent queued for the pool, by operation.",
+            f"# TYPE {name}_wait_seconds summary",
+        ]
+        for operation, timing in self.timings.items():
+            lines.append(f'{name}_wait_seconds_sum{{operation="{operation}"}} {timing["total_wait_seconds"]}')
+            lines.append(f'{name}_wait_seconds_count{{operation="{operation}"}} {timing["count"]}')
+        lines += [
+            f"# HELP {name}_pending Hashing operations running or queued right now.",
+            f"# TYPE {name}_pending gauge",
+            f"{name}_pending {self.pending}",
+            f"# HELP {name}_rejected_total Hashing operations rejected because the pool was full.",
+            f"# TYPE {name}_rejected_total counter",
+            f"{name}_rejected_total {self.rejected}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def shutdown(self) -> None:
+        """
+        Stops the executor (it's recreated if the pool is used again)
+        :return:
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,288 @@
+"""
+Bulk match import.
+
+Matches are read from an uploaded CSV or JSON Lines body as it streams in, one line at a time, and written in chunks:
+every chunk resolves its usernames and games with one IN query each (remembered for the rest of the import), then
+inserts its matches, players, results and read model updates with executemany in one transaction. Memory use depends
+on the chunk size, not the size of the upload. Rows that can't be imported are reported back by row number instead of
+failing the import. Imported matches can land anywhere in a game's history, so the affected games' ratings are replayed:
+each chunk marks its games stale for the scheduled ratings job, or - with no scheduler to run it - the import replays
+them itself once every chunk is in.
+"""
+import codecs
+import csv
+import json
+from collections import Counter
+from collections.abc import AsyncIterable, AsyncIterator
+from datetime import UTC, datetime
+from typing import Optional
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import Game, Match, MatchPlayers, MatchResult, User
+from utils.db_utils import Database
+from utils.leaderboard import Leaderboard
+from utils.ratings import Ratings
+from utils.scheduler import Scheduler
+from utils.stats import Stats
+
+FIELDS = ("game", "winner", "loser", "played_at")
+MAX_LINE_LENGTH = 65536
+
+
+class ImportFormatError(Exception):
+    """
+    Raised when an upload can't be read at all (as opposed to a single bad row, which is reported and skipped).
+    """
+
+    def __init__(self, message: str) -> None:
+        """
+        Initialization logic for ImportFormatError object
+        :param message:
+        """
+        self.message = message
+
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[str]:
+    """
+    Splits a stream of UTF-8 bytes into lines without reading the whole stream first
+    :param chunks:
+    :return:
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        if len(buffer) > MAX_LINE_LENGTH:
+            raise ImportFormatError(f"Line longer than {MAX_LINE_LENGTH} characters")
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def parse_records(chunks: AsyncIterable[bytes], kind: str) -> AsyncIterator[tuple[int, dict | str]]:
+    """
+    Parses an upload into records, one per line.
+    CSV needs a header line naming the columns (game, winner, loser and optionally played_at); quoted values can't
+    contain line breaks. JSON Lines needs one object per line with the same keys.
+    :param chunks: The raw upload
+    :param kind: "csv" or "jsonl"
+    :return: Row numbers (counted from 1, excluding a CSV header) with either the record or why it couldn't be parsed
+    """
+    if kind not in ("csv", "jsonl"):
+        raise ImportFormatError(f"Unknown import format {kind!r} (expected csv or jsonl)")
+    header = None
+    row = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        if kind == "csv" and header is None:
+            header = [name.strip().lower() for name in next(csv.reader([line]))]
+            missing = {"game", "winner", "loser"} - set(header)
+            if missing:
+                raise ImportFormatError(f"CSV header is missing {', '.join(sorted(missing))}")
+            continue
+        row += 1
+        if kind == "csv":
+            values = next(csv.reader([line]))
+            if len(values) != len(header):
+                yield row, f"expected {len(header)} values, found {len(values)}"
+                continue
+            yield row, dict(zip(header, values))
+        else:
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield row, f"invalid JSON: {e}"
+                continue
+            yield row, record if isinstance(record, dict) else "expected a JSON object"
+
+
+class MatchImporter(object):
+    """
+    Imports parsed match records in chunks, keeping a per-import cache of resolved usernames and games.
+    Each chunk is its own transaction (leaderboard included), so a long import doesn't hold the write lock throughout.
+    """
+
+    CHUNK_SIZE = 500
+    MAX_REPORTED_ERRORS = 1000  # further errors are counted but not listed
+
+    def __init__(self, db: Database, creator_id: int):
+        """
+        Importer initialization
+        :param db:
+        :param creator_id: The user the matches are recorded as created by
+        """
+        self.db: Database = db
+        self.creator_id: int = creator_id
+        self.imported: int = 0
+        self.failed: int = 0
+        self.errors: list[dict] = []
+        self._user_ids: dict[str, Optional[int]] = {}
+        self._game_ids: dict[str, Optional[int]] = {}
+        self._affected_games: set[int] = set()
+        self._pending: list[tuple[int, dict]] = []
+
+    def _fail(self, row: int, message: str) -> None:
+        self.failed += 1
+        if len(self.errors) < self.MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row, "error": message})
+
+    async def run(self, records: AsyncIterable[tuple[int, dict | str]]) -> dict:
+        """
+        Imports every record and reports the outcome
+        :param records: Output of parse_records
+        :return: Counts of imported and failed rows, and the errors for (up to MAX_REPORTED_ERRORS of) the failed ones
+        """
+        try:
+            async for row, record in records:
+                if isinstance(record, str):
+                    self._fail(row, record)
+                    continue
+                self._pending.append((row, record))
+                if len(self._pending) >= self.CHUNK_SIZE:
+                    await self._flush()
+        finally:
+            # Rows read before an unreadable line are still imported, and ratings are brought up to date either way
+            await self._flush()
+            # Replaying whole histories would hold the write lock for the rest of this request, so it's left to the
+            # scheduled ratings job (the chunks marked their games stale) - unless there is no scheduler to run it
+            if self._affected_games and not Scheduler.ENABLED:
+                async with self.db.LocalSession() as session:
+                    await Ratings.recompute(session, self._affected_games)
+                    await session.commit()
+        return {
+            "imported": self.imported,
+            "failed": self.failed,
+            "errors": self.errors,
+            "errors_truncated": self.failed > len(self.errors),
+        }
+
+    async def _resolve(self, session, names: set[str], games: set[str]) -> None:
+        """
+        Looks up usernames and games this import hasn't seen yet, with one IN query each
+        """
+        names = names - self._user_ids.keys()
+        if names:
+            found = await session.execute(select(User.username, User.id).where(User.username.in_(names)))
+            self._user_ids.update(dict.fromkeys(names))
+            self._user_ids.update(found.tuples().all())
+        games = games - self._game_ids.keys()
+        if games:
+            # Games can be given by name or by id - a value made of digits can be both a game's name and another
+            # game's id, and then the name wins, whatever order the rows come back in
+            ids = {int(game) for game in games if game.isascii() and game.isdigit()}
+            found = (
+                await session.execute(select(Game.name, Game.id).where(Game.name.in_(games) | Game.id.in_(ids)))
+            ).tuples()
+            by_name, by_id = {}, {}
+            for name, game_id in found:
+                if name in games:
+                    by_name[name] = game_id
+                if str(game_id) in games:
+                    by_id[str(game_id)] = game_id
+            self._game_ids.update(dict.fromkeys(games))
+            self._game_ids.update(by_id)
+            self._game_ids.update(by_name)
+
+    def _validate(self, row: int, record: dict) -> Optional[tuple[int, int, int, datetime]]:
+        values = {field: str(record.get(field) or "").strip() for field in FIELDS}
+        for field in ("game", "winner", "loser"):
+            if not values[field]:
+                self._fail(row, f"{field} is missing")
+                return None
+        game_id = self._game_ids.get(values["game"])
+        winner_id = self._user_ids.get(values["winner"])
+        loser_id = self._user_ids.get(values["loser"])
+        if game_id is None:
+            self._fail(row, f"unknown game {values['game']!r}")
+        elif winner_id is None:
+            self._fail(row, f"unknown winner {values['winner']!r}")
+        elif loser_id is None:
+            self._fail(row, f"unknown loser {values['loser']!r}")
+        elif winner_id == loser_id:
+            self._fail(row, "winner and loser are the same user")
+        else:
+            try:
+                played_at = datetime.fromisoformat(values["played_at"]) if values["played_at"] else None
+            except ValueError:
+                self._fail(row, f"played_at {values['played_at']!r} isn't an ISO 8601 date/time")
+                return None
+            if played_at is not None and played_at.tzinfo is not None:
+                played_at = played_at.astimezone(UTC)
+            return game_id, winner_id, loser_id, played_at or datetime.now(tz=UTC)
+        return None
+
+    async def _flush(self) -> None:
+        """
+        Writes the pending chunk in one transaction
+        """
+        chunk, self._pending = self._pending, []
+        if not chunk:
+            return None
+        async with self.db.LocalSession() as session:
+            await self._resolve(
+                session,
+                {str(record.get(field) or "").strip() for _, record in chunk for field in ("winner", "loser")},
+                {str(record.get("game") or "").strip() for _, record in chunk},
+            )
+            valid = []
+            for row, record in chunk:
+                match = self._validate(row, record)
+                if match is not None:
+                    valid.append((row, match))
+            if not valid:
+                return None
+            created_at = datetime.now(tz=UTC)
+            try:
+                match_ids = (
+                    await session.scalars(
+                        insert(Match).returning(Match.id, sort_by_parameter_order=True),
+                        [
+                            {
+                                "game_id": game_id,
+                                "creator_id": self.creator_id,
+                                "played_at": played_at,
+                                "created_at": created_at,
+                            }
+                            for _, (game_id, _, _, played_at) in valid
+                        ],
+                    )
+                ).all()
+                matches = [(match_id, match) for match_id, (_, match) in zip(match_ids, valid)]
+                await session.execute(
+                    insert(MatchPlayers),
+                    [
+                        {"match_id": match_id, "player_id": player_id}
+                        for match_id, (_, winner_id, loser_id, _) in matches
+                        for player_id in (winner_id, loser_id)
+                    ],
+                )
+                await session.execute(
+                    insert(MatchResult),
+                    [
+                        {"match_id": match_id, "won_id": winner_id, "lost_id": loser_id}
+                        for match_id, (_, winner_id, loser_id, _) in matches
+                    ],
+                )
+                await Leaderboard.record_wins(session, Counter(winner_id for _, (_, winner_id, _, _) in valid))
+                await Stats.record_matches(
+                    session, [(winner_id, loser_id, played_at) for _, (_, winner_id, loser_id, played_at) in valid]
+                )
+                if Scheduler.ENABLED:
+                    await Ratings.mark_stale(session, {game_id for _, (game_id, _, _, _) in valid})
+                await session.commit()
+            except SQLAlchemyError as e:
+                await session.rollback()
+                # The driver's own message (e.g. which constraint failed) without the statement and parameters
+                reason = getattr(e, "orig", None) or e.__class__.__name__
+                for row, _ in valid:
+                    self._fail(row, f"database error: {reason}")
+                return None
+        self.imported += len(valid)
+        self._affected_games.update(game_id for _, (game_id, _, _, _) in valid)
@@ -0,0 +1,171 @@
+"""
+Leaderboard read model.
+
+Win counts are kept in the leaderboard table and adjusted in the same transaction as the match write that changes
+them, so the leaderboard page is a single indexed read instead of a group-by over matchresults plus a username lookup
+per row. rebuild() recomputes the whole table from matchresults if it ever drifts (see manage.py).
+"""
+from typing import Iterable, Optional
+
+from sqlalchemy import Select, delete, exists, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import LeaderboardEntry, Match, MatchResult, User
+from utils.db_utils import Database
+
+
+class Leaderboard(object):
+    """
+    Maintains and reads the leaderboard table.
+    Methods that write don't commit - they are staged into the caller's transaction (usually through the
+    before_commit hook of a Database write method), except for rebuild() which is a standalone operation.
+    """
+
+    @staticmethod
+    async def record_win(session: AsyncSession, user_id: int, amount: int = 1) -> None:
+        """
+        Adds to (or, with a negative amount, takes from) a user's win count, creating their entry if needed
+        :param session:
+        :param user_id:
+        :param amount:
+        :return:
+        """
+        statement = (
+            insert(LeaderboardEntry)
+            .values(user_id=user_id, wins=amount)
+            .on_conflict_do_update(
+                index_elements=[LeaderboardEntry.user_id], set_={"wins": LeaderboardEntry.wins + amount}
+            )
+        )
+        await session.execute(statement)
+
+    @staticmethod
+    async def record_wins(session: AsyncSession, wins: dict[int, int]) -> None:
+        """
+        Adds many users' wins at once (one executemany) - used by bulk imports
+        :param session:
+        :param wins: Wins to add, by user id
+        :return:
+        """
+        if not wins:
+            return None
+        table = LeaderboardEntry.__table__
+        upsert = insert(table)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[table.c.user_id], set_={"wins": table.c.wins + upsert.excluded.wins}
+        )
+        await session.execute(upsert, [{"user_id": user_id, "wins": amount} for user_id, amount in wins.items()])
+
+    @staticmethod
+    async def forget_match(session: AsyncSession, match_id: int) -> None:
+        """
+        Takes a deleted match's win away from its winner.
+        The match result row is left behind when a match is deleted, so the winner is looked up from it.
+        :param session:
+        :param match_id:
+        :return:
+        """
+        winner = select(MatchResult.won_id).where(MatchResult.match_id == match_id).scalar_subquery()
+        statement = (
+            update(LeaderboardEntry).where(LeaderboardEntry.user_id == winner).values(wins=LeaderboardEntry.wins - 1)
+        )
+        await session.execute(statement)
+
+    @classmethod
+    async def refresh_match(cls, session: AsyncSession, match_id: int) -> None:
+        """
+        Recounts the wins of a match's winner from matchresults - used after a match has been edited
+        :param session:
+        :param match_id:
+        :return:
+        """
+        winners = (await session.execute(select(MatchResult.won_id).where(MatchResult.match_id == match_id))).scalars()
+        await cls.refresh_users(session, winners.all())
+
+    @staticmethod
+    async def refresh_users(session: AsyncSession, user_ids: Iterable[int]) -> None:
+        """
+        Recounts the wins of the given users from matchresults, ignoring results whose match no longer exists
+        :param session:
+        :param user_ids:
+        :return:
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return None
+        counts = Leaderboard.counts_statement().where(MatchResult.won_id.in_(user_ids))
+        await session.execute(delete(LeaderboardEntry).where(LeaderboardEntry.user_id.in_(user_ids)))
+        await session.execute(insert(LeaderboardEntry).from_select(["user_id", "wins"], counts))
+
+    @staticmethod
+    async def rebuild(session: AsyncSession) -> None:
+        """
+        Recomputes the whole leaderboard from matchresults and commits
+        :param session:
+        :return:
+        """
+        counts = Leaderboard.counts_statement()
+        await session.execute(delete(LeaderboardEntry))
+        await session.execute(insert(LeaderboardEntry).from_select(["user_id", "wins"], counts))
+        await session.commit()
+
+    @staticmethod
+    async def needs_seeding(session: AsyncSession) -> bool:
+        """
+        Checks whether the leaderboard is empty while there are results to count (e.g. a database created before the
+        leaderboard table existed)
+        :param session:
+        :return:
+        """
+        statement = select(~exists(select(LeaderboardEntry.id)) & exists(select(MatchResult.id)))
+        return bool((await session.execute(statement)).scalar())
+
+    @staticmethod
+    def counts_statement() -> Select:
+        """
+        Statement for the number of wins of each user, from matchresults (ignoring results of deleted matches)
+        :return:
+        """
+        return (
+            select(MatchResult.won_id, func.count(MatchResult.id))
+            .join(Match, Match.id == MatchResult.match_id)
+            .group_by(MatchResult.won_id)
+        )
+
+    @staticmethod
+    async def wins(session: AsyncSession, user_id: int) -> int:
+        """
+        Reads a user's win count (0 if they have no entry)
+        :param session:
+        :param user_id:
+        :return:
+        """
+        wins = await session.scalar(select(LeaderboardEntry.wins).where(LeaderboardEntry.user_id == user_id))
+        return wins or 0
+
+    @staticmethod
+    def ranking() -> Select:
+        """
+        Statement for the leaderboard in descending order of wins, as rows with user and wins columns
+        :return:
+        """
+        return (
+            select(User.username.label("user"), LeaderboardEntry.wins)
+            .join(User, User.id == LeaderboardEntry.user_id)
+            .where(LeaderboardEntry.wins > 0)
+            .order_by(LeaderboardEntry.wins.desc(), LeaderboardEntry.user_id)
+        )
+
+    @staticmethod
+    async def top(session: AsyncSession, limit: Optional[int] = None) -> list[tuple]:
+        """
+        Reads the leaderboard in descending order of wins, as named tuples of user and wins
+        :param session:
+        :param limit: Optional limit of entries to fetch
+        :return:
+        """
+        statement = Leaderboard.ranking()
+        if limit is not None:
+            statement = statement.limit(limit)
+        return await Database.project(session, statement, "LeaderboardRow")
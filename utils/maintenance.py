@@ -0,0 +1,72 @@
+"""
+Database maintenance, run as scheduled jobs (see utils.scheduler) rather than in requests.
+
+- ANALYZE refreshes the statistics the query planner picks indexes with. It reads every index, so it's run at night,
+  with analysis_limit bounding how much of each it reads.
+- PRAGMA optimize re-analyzes just the tables whose statistics look out of date, cheaply enough to run hourly.
+- An incremental vacuum hands a bounded number of free pages back to the file system, a small transaction at a time, so
+  the file shrinks after bulk deletes (e.g. the purge) without a full VACUUM locking the database. It only applies to
+  databases with auto_vacuum=INCREMENTAL (see the production storage profile).
+These run on the writer connection, since reads may be on read-only connections.
+"""
+from sqlalchemy import text
+
+from utils.config import env_float, env_int, env_str
+from utils.db_utils import Database
+
+
+class Maintenance(object):
+    """
+    SQLite maintenance operations and when the app schedules them.
+    """
+
+    ANALYZE_CRON = env_str("ANALYZE_CRON", "17 3 * * *")  # minute hour day month weekday, in local time
+    ANALYZE_LIMIT = env_int("ANALYZE_LIMIT", 1000)  # rows sampled per index - 0 reads them all
+    OPTIMIZE_INTERVAL = env_float("OPTIMIZE_INTERVAL", 3600)
+    VACUUM_INTERVAL = env_float("VACUUM_INTERVAL", 600)
+    VACUUM_PAGES = env_int("VACUUM_PAGES", 1000)  # pages freed per run at most
+    PREWARM_INTERVAL = env_float("PREWARM_INTERVAL", 60)  # seconds between re-rendering the busiest pages
+
+    @classmethod
+    async def analyze(cls, db: Database, limit: int = ANALYZE_LIMIT) -> None:
+        """
+        Refreshes the query planner's statistics for every table
+        :param db:
+        :param limit: Rows sampled per index (0 for no limit)
+        :return:
+        """
+        async with db.engine.connect() as connection:
+            await connection.exec_driver_sql(f"PRAGMA analysis_limit = {int(limit)}")
+            await connection.exec_driver_sql("ANALYZE")
+            await connection.commit()
+
+    @staticmethod
+    async def optimize(db: Database) -> None:
+        """
+        Re-analyzes tables whose statistics are likely out of date - SQLite before 3.46 ignores the 0x10000 bit and
+        only considers the tables this connection has queried
+        :param db:
+        :return:
+        """
+        async with db.engine.connect() as connection:
+            await connection.exec_driver_sql("PRAGMA optimize = 0x10002")
+            await connection.commit()
+
+    @staticmethod
+    async def incremental_vacuum(db: Database, pages: int = VACUUM_PAGES) -> int:
+        """
+        Frees up to a number of unused pages, if the database is in incremental auto-vacuum mode
+        :param db:
+        :param pages:
+        :return: The number of pages freed
+        """
+        async with db.engine.connect() as connection:
+            if (await connection.execute(text("PRAGMA auto_vacuum"))).scalar() != 2:  # 2 is INCREMENTAL
+                return 0
+            free = (await connection.execute(text("PRAGMA freelist_count"))).scalar()
+            if not free:
+                return 0
+            # The pragma frees one page per step, and a plain execute only steps once - a script runs it to the end
+            raw = await connection.get_raw_connection()
+            await raw.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+            return free - (await connection.execute(text("PRAGMA freelist_count"))).scalar()
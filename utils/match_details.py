@@ -0,0 +1,135 @@
+"""
+Match detail read model.
+
+A match page needs the match, its game, its players and its result. MatchDetails reads all of that in one query into an
+immutable MatchDetail and keeps it in memory by match id, so a match page shared with a whole class is queried once.
+Each entry is stored with the row versions (see utils.versions) of its match, its game and its players, and a read that
+finds any of them changed since treats the entry as a miss - with shared versions that covers writes made by other
+workers too. A match's players and result are only written along with the match itself (created together, purged once
+it's deleted), so its own row's version covers them. Other matches being played, or other users and games being edited,
+don't touch an entry, so the cache keeps answering while a tournament is writing new matches.
+"""
+import json
+from collections import namedtuple
+from typing import Optional
+
+from sqlalchemy import Select, func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from models import Game, Match, MatchPlayers, MatchResult, User
+from utils.cache import TTLCache
+from utils.config import env_float, env_int
+from utils.versions import data_versions, row_key
+
+MatchDetail = namedtuple(
+    "MatchDetail", ("id", "game_id", "game", "played_at", "player_ids", "players", "winner_id", "winner", "loser")
+)
+
+
+class MatchDetails(object):
+    """
+    Reads and caches match details.
+    """
+
+    CACHE_SIZE = env_int("MATCH_CACHE_SIZE", 1024)
+    CACHE_TTL = env_float("MATCH_CACHE_TTL", 300)  # seconds
+    cache = TTLCache(CACHE_SIZE, CACHE_TTL)  # match id -> (row versions, detail)
+
+    @staticmethod
+    def rows(detail: MatchDetail) -> tuple[str, ...]:
+        """
+        The rows a match's details are read from, as row version keys
+        :param detail:
+        :return:
+        """
+        return (
+            row_key(Match.__tablename__, detail.id),
+            row_key(Game.__tablename__, detail.game_id),
+            *(row_key(User.__tablename__, player_id) for player_id in detail.player_ids),
+        )
+
+    @staticmethod
+    def statement(match_id: int) -> Select:
+        """
+        Statement for one match's details - the players come back as a JSON array of [id, username] pairs
+        :param match_id:
+        :return:
+        """
+        winner = aliased(User)
+        loser = aliased(User)
+        players = (
+            select(func.json_group_array(func.json_array(User.id, User.username)))
+            .select_from(MatchPlayers)
+            .join(User, User.id == MatchPlayers.player_id)
+            .where(MatchPlayers.match_id == Match.id)
+            .scalar_subquery()
+        )
+        return (
+            select(
+                Match.id,
+                Match.game_id,
+                Game.name.label("game"),
+                Match.played_at,
+                players.label("players"),
+                MatchResult.won_id,
+                winner.username.label("winner"),
+                loser.username.label("loser"),
+            )
+            .join(Game, Game.id == Match.game_id)
+            .outerjoin(MatchResult, MatchResult.match_id == Match.id)
+            .outerjoin(winner, winner.id == MatchResult.won_id)
+            .outerjoin(loser, loser.id == MatchResult.lost_id)
+            .where(Match.id == match_id)
+        )
+
+    @classmethod
+    async def load(cls, session: AsyncSession, match_id: int) -> Optional[MatchDetail]:
+        """
+        Reads a match's details from the database
+        :param session:
+        :param match_id:
+        :return: None if there's no such match (or its game no longer exists)
+        """
+        row = (await session.execute(cls.statement(match_id))).first()
+        if row is None:
+            return None
+        players = sorted(json.loads(row.players), key=lambda player: player[1])
+        return MatchDetail(
+            id=row.id,
+            game_id=row.game_id,
+            game=row.game,
+            played_at=row.played_at,
+            player_ids=tuple(player[0] for player in players),
+            players=tuple(player[1] for player in players),
+            winner_id=row.won_id,
+            winner=row.winner,
+            loser=row.loser,
+        )
+
+    @classmethod
+    async def get(cls, session: AsyncSession, match_id: int) -> Optional[MatchDetail]:
+        """
+        Gets a match's details, from the cache if possible
+        :param session:
+        :param match_id:
+        :return: None if there's no such match
+        """
+        cached = cls.cache.get(match_id)
+        if cached is not None:
+            if cached[0] == data_versions.get(*cls.rows(cached[1])):
+                return cached[1]
+            cls.cache.reject(match_id)
+        # Read before the query - the game's and players' rows are only known after it, so if any game or user changed
+        # while it ran, the details just read may predate their versions and aren't cached (as in Auth's user cache)
+        match_version = data_versions.get(row_key(Match.__tablename__, match_id))
+        table_versions = data_versions.get(Game.__tablename__, User.__tablename__)
+        detail = await cls.load(session, match_id)
+        if detail is not None and data_versions.get(Game.__tablename__, User.__tablename__) == table_versions:
+            # The match's own version from before the query - if it moved meanwhile, the entry is already behind
+            cls.cache.set(match_id, (match_version + data_versions.get(*cls.rows(detail)[1:]), detail))
+        return detail
+
+    @classmethod
+    def forget(cls, match_id: int) -> None:
+        cls.cache.pop(match_id)
@@ -0,0 +1,222 @@
+"""
+Request and SQL instrumentation.
+
+MetricsMiddleware times every HTTP request and, through a context variable, collects the SQL statements run while
+handling it: SQLAlchemy engine events count each statement, its time and the rows it returned. When the request
+finishes, the numbers are added to per-route totals and a latency histogram, which /metrics serves in the Prometheus
+text format. A streamed response (no Content-Length, e.g. /events or an export) lasts as long as the client keeps
+reading, so its latency is the time until the response started instead. Optionally a Server-Timing header reports a request's own numbers to the browser's developer tools.
+
+The hot path is a couple of perf_counter() calls and dict updates per statement and per request, so it's cheap enough
+to leave on. With metrics turned off (DTS_METRICS=0) the middleware still times requests for Metrics' listeners - the
+Sentry sampler raises the rates of failing and slow routes from them - but nothing is totalled.
+"""
+import time
+from bisect import bisect_left
+from collections.abc import Callable
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import Engine, event
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.config import env_bool
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # request latency buckets, in seconds
+
+
+class RequestStats(object):
+    """
+    SQL totals for the request being handled.
+    """
+
+    __slots__ = ("queries", "db_seconds", "rows")
+
+    def __init__(self):
+        self.queries: int = 0
+        self.db_seconds: float = 0.0
+        self.rows: int = 0
+
+
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+
+
+class RouteStats(object):
+    """
+    Totals and latency histogram for one route and method.
+    """
+
+    __slots__ = ("buckets", "count", "seconds", "statuses", "queries", "db_seconds", "rows")
+
+    def __init__(self):
+        self.buckets: list[int] = [0] * (len(BUCKETS) + 1)  # the last one is +Inf
+        self.count: int = 0
+        self.seconds: float = 0.0
+        self.statuses: dict[int, int] = {}
+        self.queries: int = 0
+        self.db_seconds: float = 0.0
+        self.rows: int = 0
+
+
+class Metrics(object):
+    """
+    Collects request and SQL metrics and renders them for Prometheus.
+    """
+
+    ENABLED = env_bool("METRICS", True)
+    SERVER_TIMING = env_bool("SERVER_TIMING", False)  # adds a Server-Timing header to every response
+
+    def __init__(self, prefix: str = "dts", enabled: bool = ENABLED):
+        """
+        Metrics initialization
+        :param prefix: Prepended to every metric name
+        :param enabled: Whether requests are totalled - listeners are called either way
+        """
+        self.prefix: str = prefix
+        self.enabled: bool = enabled
+        self.routes: dict[tuple[str, str], RouteStats] = {}
+        # Called with the method, route, status code and latency of every finished request (e.g. TraceSampler.observe)
+        self.listeners: list[Callable[[str, str, int, float], None]] = []
+
+    @staticmethod
+    def instrument(engine: Engine) -> None:
+        """
+        Counts the statements an engine runs against the current request
+        :param engine: The synchronous engine (AsyncEngine.sync_engine)
+        :return:
+        """
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def start_timer(connection, cursor, statement, parameters, context, executemany):
+            context._query_started = time.perf_counter()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def stop_timer(connection, cursor, statement, parameters, context, executemany):
+            stats = current_request.get()
+            if stats is None:
+                return None
+            stats.queries += 1
+            stats.db_seconds += time.perf_counter() - context._query_started
+            # The aiosqlite adapter fetches a (non-streamed) result's rows as part of executing it; for writes,
+            # rowcount is the number of rows changed
+            rows = getattr(cursor, "_rows", None)
+            stats.rows += len(rows) if rows else max(cursor.rowcount, 0)
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float, stats: RequestStats) -> None:
+        """
+        Adds a finished request to its route's totals
+        :param method:
+        :param route: The route's path template, e.g. /match/{match_id}
+        :param status_code:
+        :param seconds: The request's latency
+        :param stats: The request's SQL totals
+        :return:
+        """
+        if self.enabled:
+            route_stats = self.routes.get((method, route))
+            if route_stats is None:
+                route_stats = self.routes[(method, route)] = RouteStats()
+            route_stats.buckets[bisect_left(BUCKETS, seconds)] += 1
+            route_stats.count += 1
+            route_stats.seconds += seconds
+            route_stats.statuses[status_code] = route_stats.statuses.get(status_code, 0) + 1
+            route_stats.queries += stats.queries
+            route_stats.db_seconds += stats.db_seconds
+            route_stats.rows += stats.rows
+        for listener in self.listeners:
+            listener(method, route, status_code, seconds)
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format
+        :return:
+        """
+        name = self.prefix
+        lines = [
+            f"# HELP {name}_http_request_duration_seconds Request latency by route.",
+            f"# TYPE {name}_http_request_duration_seconds histogram",
+        ]
+        for (method, route), stats in self.routes.items():
+            labels = f'method="{method}",route="{route}"'
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), stats.buckets):
+                cumulative += count
+                lines.append(f'{name}_http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_http_request_duration_seconds_sum{{{labels}}} {stats.seconds}")
+            lines.append(f"{name}_http_request_duration_seconds_count{{{labels}}} {stats.count}")
+        counters = (
+            ("db_queries_total", "SQL statements run while handling requests, by route.", "queries"),
+            ("db_query_seconds_total", "Time spent running SQL statements, by route.", "db_seconds"),
+            ("db_rows_total", "Rows returned or changed by SQL statements, by route.", "rows"),
+        )
+        for metric, description, attribute in counters:
+            lines.append(f"# HELP {name}_{metric} {description}")
+            lines.append(f"# TYPE {name}_{metric} counter")
+            for (method, route), stats in self.routes.items():
+                lines.append(f'{name}_{metric}{{method="{method}",route="{route}"}} {getattr(stats, attribute)}')
+        lines.append(f"# HELP {name}_http_requests_total Requests by route and response status.")
+        lines.append(f"# TYPE {name}_http_requests_total counter")
+        for (method, route), stats in self.routes.items():
+            for status_code, count in sorted(stats.statuses.items()):
+                lines.append(
+                    f'{name}_http_requests_total{{method="{method}",route="{route}",status="{status_code}"}} {count}'
+                )
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware(object):
+    """
+    ASGI middleware timing requests and collecting their SQL totals (a plain ASGI middleware rather than a
+    BaseHTTPMiddleware, which would add a task and a body copy to every request).
+    """
+
+    def __init__(self, app: ASGIApp, metrics: Metrics, server_timing: bool = Metrics.SERVER_TIMING):
+        """
+        Middleware initialization
+        :param app:
+        :param metrics: Where finished requests are recorded
+        :param server_timing: Whether to add a Server-Timing header to responses (only when metrics are enabled, as
+            the SQL totals are only collected then)
+        """
+        self.app: ASGIApp = app
+        self.metrics: Metrics = metrics
+        self.server_timing: bool = server_timing and metrics.enabled
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return None
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status_code = 500  # if the app fails before responding
+        responded: Optional[float] = None  # when a streamed response started
+
+        async def send_with_timing(message: Message) -> None:
+            nonlocal status_code, responded
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if not any(name.lower() == b"content-length" for name, _ in message.get("headers", [])):
+                    responded = time.perf_counter()
+                if self.server_timing:
+                    # Durations are in milliseconds; the time so far, since the body may still be streaming
+                    timing = (
+                        f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.queries} queries, {stats.rows} rows", '
+                        f"total;dur={(time.perf_counter() - started) * 1000:.2f}"
+                    )
+                    message["headers"] = [*message.get("headers", []), (b"server-timing", timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            # FastAPI puts the matched route in the scope; anything else (static files, 404s) is grouped together
+            route = scope.get("route")
+            self.metrics.observe(
+                scope["method"],
+                route.path if route is not None else "other",
+                status_code,
+                (responded if responded is not None else time.perf_counter()) - started,
+                stats,
+            )
@@ -0,0 +1,263 @@
+"""
+Schema versioning.
+
+The schema version is kept in SQLite's user_version header field. A new database gets every table and index straight
+from the models and is stamped with the latest version; an existing one has each migration it's missing applied in
+order, so data.db files from older versions are upgraded in place when the app starts. Migrations are written to be
+safe to re-run (CREATE ... IF NOT EXISTS and the like), in case a database was part-upgraded by an older version.
+
+To change the schema, change the models and append a migration that brings an existing database to match - never edit
+or reorder migrations that have already shipped.
+
+A fingerprint of the models' DDL is stored alongside the version, so a worker starting against an up-to-date database
+reads two values and is done - it doesn't inspect tables or take the write lock. When there's work to do, the upgrade
+runs in one IMMEDIATE transaction, so workers starting together wait for the first rather than racing it, and then find
+nothing left to do. A database at the latest version whose fingerprint doesn't match (the models changed without a
+migration) gets any missing tables and indexes created, and a warning logged.
+"""
+import hashlib
+import logging
+from collections.abc import Callable
+from functools import lru_cache
+from typing import Optional
+
+from sqlalchemy import Connection, inspect
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from models import Base
+from utils.stats import Stats
+
+type migration = Callable[[Connection], None]  # type alias for a migration step
+
+logger = logging.getLogger("dts.schema")
+
+
+class SchemaError(Exception):
+    """
+    Raised when the database's schema can't be brought up to date, e.g. it's newer than this version of the app.
+    """
+
+    def __init__(self, message: str) -> None:
+        """
+        Initialization logic for SchemaError object
+        :param message:
+        """
+        self.message = message
+
+
+def create_tables(*names: str) -> migration:
+    """
+    Migration step creating tables (with their indexes) that don't exist yet, as the models currently define them
+    :param names:
+    :return:
+    """
+
+    def step(connection: Connection) -> None:
+        Base.metadata.create_all(connection, tables=[Base.metadata.tables[name] for name in names])
+
+    return step
+
+
+def create_indexes(*names: str) -> migration:
+    """
+    Migration step creating any of the models' indexes on the given tables that don't exist yet
+    :param names:
+    :return:
+    """
+
+    def step(connection: Connection) -> None:
+        for name in names:
+            for index in Base.metadata.tables[name].indexes:
+                index.create(connection, checkfirst=True)
+
+    return step
+
+
+def create_user_stats(connection: Connection) -> None:
+    """
+    Migration step adding the user_stats read model, filled from the existing matches
+    :param connection:
+    :return:
+    """
+    create_tables("user_stats")(connection)
+    for statement in Stats.rebuild_statements():
+        connection.execute(statement)
+
+
+def create_tombstones(connection: Connection) -> None:
+    """
+    Migration step adding the tombstones table, with a pending tombstone for each row that was hard-deleted before it
+    but left dependents behind (found from those dependents), so the purge clears up after older versions too
+    :param connection:
+    :return:
+    """
+    create_tables("tombstones")(connection)
+    orphans = {
+        "matches": [("matchplayers", "match_id"), ("matchresults", "match_id")],
+        "games": [("matches", "game_id"), ("ratings", "game_id")],
+        "users": [("leaderboard", "user_id"), ("ratings", "user_id"), ("user_stats", "id")],
+    }
+    for table, dependents in orphans.items():
+        for dependent, column in dependents:
+            connection.exec_driver_sql(
+                f"INSERT OR IGNORE INTO tombstones (table_name, row_id, deleted_at) "
+                f"SELECT DISTINCT '{table}', {column}, CURRENT_TIMESTAMP FROM {dependent} "
+                f"WHERE {column} NOT IN (SELECT id FROM {table})"
+            )
+
+
+def rebuild_autoincrement(*names: str) -> migration:
+    """
+    Migration step rebuilding tables as the models define them with AUTOINCREMENT (SQLite can't add it to a table in
+    place), keeping their rows, and starting their id sequence after any id a tombstone records, so no id is used twice
+    :param names:
+    :return:
+    """
+
+    def step(connection: Connection) -> None:
+        for name in names:
+            ddl = connection.exec_driver_sql(
+                "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)
+            ).scalar()
+            if "AUTOINCREMENT" not in ddl.upper():
+                table = Base.metadata.tables[name]
+                # The new table is created under another name and renamed once the old one is gone (the foreign keys
+                # of other tables name the table, so they point at the new one then)
+                create = str(CreateTable(table).compile(dialect=connection.dialect))
+                connection.exec_driver_sql(create.replace(f"CREATE TABLE {name} ", f"CREATE TABLE {name}_rebuild ", 1))
+                existing = {column["name"] for column in inspect(connection).get_columns(name)}
+                columns = ", ".join(column.name for column in table.columns if column.name in existing)
+                connection.exec_driver_sql(f"INSERT INTO {name}_rebuild ({columns}) SELECT {columns} FROM {name}")
+                connection.exec_driver_sql(f"DROP TABLE {name}")
+                connection.exec_driver_sql(f"ALTER TABLE {name}_rebuild RENAME TO {name}")
+                create_indexes(name)(connection)
+            connection.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = ?", (name,))
+            connection.exec_driver_sql(
+                f"INSERT INTO sqlite_sequence (name, seq) SELECT ?, max("
+                f"coalesce((SELECT max(id) FROM {name}), 0), "
+                f"coalesce((SELECT max(row_id) FROM tombstones WHERE table_name = ?), 0))",
+                (name, name),
+            )
+
+    return step
+
+
+class SchemaManager(object):
+    """
+    Applies schema migrations and tracks the schema version.
+    """
+
+    # Migration n (counting from 1) upgrades a database from version n - 1 to version n
+    MIGRATIONS: list[tuple[str, migration]] = [
+        (
+            "tables created before schema versioning",
+            create_tables("users", "games", "matches", "matchplayers", "matchresults", "leaderboard", "ratings"),
+        ),
+        (
+            "indexes for match lookups by game, player, result and date",
+            create_indexes("matches", "matchplayers", "matchresults"),
+        ),
+        ("per-user stats read model", create_user_stats),
+        ("tombstones for deleted records", create_tombstones),
+        ("leases for scheduled jobs", create_tables("job_leases")),
+        ("games waiting for their ratings to be replayed", create_tables("stale_ratings")),
+        ("ids of deleted games, users and matches never reused", rebuild_autoincrement("games", "users", "matches")),
+    ]
+    LATEST = len(MIGRATIONS)
+
+    @staticmethod
+    def get_version(connection: Connection) -> int:
+        return connection.exec_driver_sql("PRAGMA user_version").scalar_one()
+
+    @staticmethod
+    def set_version(connection: Connection, version: int) -> None:
+        connection.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def fingerprint() -> str:
+        """
+        Hash of the DDL the models compile to - it changes whenever a table, column, constraint or index does
+        :return:
+        """
+        dialect = sqlite.dialect()
+        ddl = []
+        for table in Base.metadata.sorted_tables:
+            ddl.append(str(CreateTable(table).compile(dialect=dialect)))
+            for index in sorted(table.indexes, key=lambda index: index.name):
+                ddl.append(str(CreateIndex(index).compile(dialect=dialect)))
+        return hashlib.blake2b("\n".join(ddl).encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def get_fingerprint(connection: Connection) -> Optional[str]:
+        exists = connection.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_info'"
+        ).scalar()
+        if not exists:
+            return None
+        return connection.exec_driver_sql("SELECT value FROM schema_info WHERE name = 'fingerprint'").scalar()
+
+    @staticmethod
+    def set_fingerprint(connection: Connection, fingerprint: str) -> None:
+        # Kept outside the models, like user_version - it describes them rather than being part of them
+        connection.exec_driver_sql(
+            "CREATE TABLE IF NOT EXISTS schema_info (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        connection.exec_driver_sql(
+            "INSERT OR REPLACE INTO schema_info (name, value) VALUES ('fingerprint', ?)", (fingerprint,)
+        )
+
+    @classmethod
+    def is_current(cls, connection: Connection) -> bool:
+        """
+        Checks the schema's version and fingerprint, raising if the database is newer than the app
+        :param connection:
+        :return: Whether there's nothing to do
+        """
+        version = cls.get_version(connection)
+        if version > cls.LATEST:
+            raise SchemaError(f"Database schema version {version} is newer than this app supports ({cls.LATEST})")
+        return version == cls.LATEST and cls.get_fingerprint(connection) == cls.fingerprint()
+
+    @classmethod
+    def upgrade_sync(cls, connection: Connection) -> tuple[int, int]:
+        """
+        Brings the database's schema up to date
+        :param connection: Not yet in a database transaction (the sqlite3 driver only begins one on the first write)
+        :return: The versions before and after
+        """
+        if cls.is_current(connection):
+            return cls.LATEST, cls.LATEST
+        # Takes the write lock for the whole upgrade, then looks again - another worker may have just done it
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        if cls.is_current(connection):
+            return cls.LATEST, cls.LATEST
+        version = cls.get_version(connection)
+        if version == 0 and not inspect(connection).get_table_names():
+            # A brand-new database - nothing to migrate, so everything is created as the models define it
+            Base.metadata.create_all(connection)
+        elif version == cls.LATEST:
+            # Up to date by version, but the models don't match the last schema this app recorded - either it was
+            # recorded before fingerprints were, or a model changed without a migration
+            if cls.get_fingerprint(connection) is not None:
+                logger.warning("The models have changed without a migration - creating any missing tables and indexes")
+            Base.metadata.create_all(connection)
+        else:
+            for number, (_, step) in enumerate(cls.MIGRATIONS[version:], start=version + 1):
+                step(connection)
+                cls.set_version(connection, number)
+        cls.set_version(connection, cls.LATEST)
+        cls.set_fingerprint(connection, cls.fingerprint())
+        return version, cls.LATEST
+
+    @classmethod
+    async def upgrade(cls, engine: AsyncEngine) -> tuple[int, int]:
+        """
+        Brings the database's schema up to date
+        :param engine: The writer engine
+        :return: The versions before and after
+        """
+        async with engine.begin() as connection:
+            return await connection.run_sync(cls.upgrade_sync)
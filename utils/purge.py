@@ -0,0 +1,165 @@
+"""
+Background purge of deleted records' dependents.
+
+Deleting a record removes only its own row and leaves a tombstone (models.Tombstone) in the same transaction, so a
+delete is one quick write however much depends on the row. The Purger then works through the pending tombstones,
+oldest first, deleting what was left behind:
+- a match's players and result
+- a game's matches (with their players and results), then its ratings - the players of those matches have their
+  leaderboard wins and stats recounted as each batch goes
+- a user's leaderboard entry, stats and ratings (the matches they played stay, for the other players' histories)
+Each batch of at most BATCH_SIZE rows is its own short transaction, with a pause between batches, so the purge never
+holds SQLite's write lock for long and requests' writes get in between. A tombstone is marked purged once nothing is
+left, and kept - it's what tells a 410 Gone from a 404 Not Found. The app runs the purge as a scheduled job (see
+utils.scheduler), in one worker at a time.
+"""
+import asyncio
+from datetime import UTC, datetime
+
+from sqlalchemy import Select, delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Game, LeaderboardEntry, Match, MatchPlayers, MatchResult, Rating, Tombstone, User, UserStats
+from utils.config import env_float, env_int
+from utils.db_utils import Database
+from utils.leaderboard import Leaderboard
+from utils.stats import Stats
+
+
+class Purger(object):
+    """
+    Deletes tombstoned records' dependents in small batches.
+    """
+
+    BATCH_SIZE = env_int("PURGE_BATCH_SIZE", 500)  # rows deleted per transaction
+    INTERVAL = env_float("PURGE_INTERVAL", 30)  # seconds between runs (see the app's scheduled jobs)
+    PAUSE = 0.01  # seconds between batches, so other writers get the lock
+
+    def __init__(self, batch_size: int = BATCH_SIZE, pause: float = PAUSE):
+        """
+        Purger initialization
+        :param batch_size:
+        :param pause:
+        """
+        self.batch_size: int = batch_size
+        self.pause: float = pause
+        self.purged: dict[str, int] = {"matches": 0, "games": 0, "users": 0}
+        self.batches: int = 0
+
+    @staticmethod
+    def pending_statement(limit: int) -> Select:
+        # Served by the partial index of unpurged tombstones, in deletion order
+        return select(Tombstone).where(Tombstone.purged_at.is_(None)).order_by(Tombstone.deleted_at).limit(limit)
+
+    async def pending(self, session: AsyncSession) -> list[Tombstone]:
+        return list(await session.scalars(self.pending_statement(self.batch_size)))
+
+    async def purge_match(self, session: AsyncSession, match_id: int) -> bool:
+        """
+        Deletes a match's players and result
+        :param session:
+        :param match_id:
+        :return: Whether the match is fully purged (always, as a match has at most a few dependent rows)
+        """
+        await session.execute(delete(MatchPlayers).where(MatchPlayers.match_id == match_id))
+        await session.execute(delete(MatchResult).where(MatchResult.match_id == match_id))
+        return True
+
+    async def purge_game(self, session: AsyncSession, game_id: int) -> bool:
+        """
+        Deletes a batch of a game's matches with their players and results, recounting their players' wins and stats,
+        then the game's ratings once no matches are left
+        :param session:
+        :param game_id:
+        :return: Whether the game is fully purged
+        """
+        match_ids = list(await session.scalars(select(Match.id).where(Match.game_id == game_id).limit(self.batch_size)))
+        if not match_ids:
+            await session.execute(delete(Rating).where(Rating.game_id == game_id))
+            return True
+        players = set(await session.scalars(select(MatchPlayers.player_id).where(MatchPlayers.match_id.in_(match_ids))))
+        await session.execute(delete(MatchPlayers).where(MatchPlayers.match_id.in_(match_ids)))
+        await session.execute(delete(MatchResult).where(MatchResult.match_id.in_(match_ids)))
+        await session.execute(delete(Match).where(Match.id.in_(match_ids)))
+        await Leaderboard.refresh_users(session, players)
+        await Stats.refresh_users(session, players)
+        return False
+
+    async def purge_user(self, session: AsyncSession, user_id: int) -> bool:
+        """
+        Deletes a user's read model rows - their matches are kept
+        :param session:
+        :param user_id:
+        :return: Whether the user is fully purged (always)
+        """
+        await session.execute(delete(LeaderboardEntry).where(LeaderboardEntry.user_id == user_id))
+        await session.execute(delete(UserStats).where(UserStats.id == user_id))
+        await session.execute(delete(Rating).where(Rating.user_id == user_id))
+        return True
+
+    async def purge(self, session: AsyncSession, table_name: str, row_id: int) -> bool:
+        """
+        Runs one batch of a deleted record's purge
+        :param session:
+        :param table_name: The deleted record's table
+        :param row_id: The deleted record's id
+        :return: Whether there's nothing left to purge for it
+        """
+        purgers = {
+            Match.__tablename__: self.purge_match,
+            Game.__tablename__: self.purge_game,
+            User.__tablename__: self.purge_user,
+        }
+        purger = purgers.get(table_name)
+        return True if purger is None else await purger(session, row_id)
+
+    async def run_once(self, db: Database) -> int:
+        """
+        Purges every pending tombstone, one batch per transaction
+        :param db:
+        :return: The number of tombstones purged
+        """
+        done = 0
+        while True:
+            async with db.LocalSession() as session:
+                tombstones = [
+                    (tombstone.id, tombstone.table_name, tombstone.row_id) for tombstone in await self.pending(session)
+                ]
+            if not tombstones:
+                return done
+            for identifier, table_name, row_id in tombstones:
+                finished = False
+                while not finished:
+                    async with db.LocalSession() as session:
+                        finished = await self.purge(session, table_name, row_id)
+                        if finished:
+                            await session.execute(
+                                update(Tombstone)
+                                .where(Tombstone.id == identifier)
+                                .values(purged_at=datetime.now(tz=UTC))
+                            )
+                        await session.commit()
+                    self.batches += 1
+                    await asyncio.sleep(self.pause)
+                self.purged[table_name] = self.purged.get(table_name, 0) + 1
+                done += 1
+
+    def stats(self) -> dict:
+        return {"purged": dict(self.purged), "batches": self.batches}
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the purge's progress in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_purge"
+        lines = [
+            f"# HELP {name}_records_total Deleted records whose dependents were purged, by table.",
+            f"# TYPE {name}_records_total counter",
+            *(f'{name}_records_total{{table="{table}"}} {count}' for table, count in self.purged.items()),
+            f"# HELP {name}_batches_total Purge transactions committed.",
+            f"# TYPE {name}_batches_total counter",
+            f"{name}_batches_total {self.batches}",
+        ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,88 @@
+"""
+Query plan checks.
+
+Asks SQLite how it would run the queries behind the busiest pages and match writes (EXPLAIN QUERY PLAN), and reports any
+that don't use the indexes they were written for - e.g. after a model or query change, or on a database whose migrations
+didn't run. Run it with `python manage.py check-indexes`.
+"""
+from sqlalchemy import Connection, Select
+
+from models import Match, MatchResult, User
+from utils.db_utils import Database
+from utils.leaderboard import Leaderboard
+from utils.purge import Purger
+from utils.ratings import Ratings
+from utils.stats import Stats
+
+
+def query_plan(connection: Connection, statement: Select) -> list[str]:
+    """
+    Gets SQLite's plan for a statement (the detail column of EXPLAIN QUERY PLAN)
+    :param connection:
+    :param statement: A select whose parameters can be rendered inline
+    :return:
+    """
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")]
+
+
+def hot_queries() -> dict[str, tuple[Select, set[str]]]:
+    """
+    The queries run on busy pages and match writes, with the indexes each is expected to use
+    :return:
+    """
+    newest_first = (Match.played_at.desc(), Match.id.desc())
+    return {
+        "stats: recount a user's matches": (
+            Stats.totals_statement().where(User.id == 1),
+            {
+                "ix_matchplayers_player_id_match_id",
+                "ix_matchresults_won_id_match_id",
+                "ix_matchresults_lost_id_match_id",
+            },
+        ),
+        "home: matches per game": (Database.game_plays_statement(), {"ix_matches_game_id_played_at"}),
+        "matches page": (
+            Database.filter_matches(Database.matches_statement()).order_by(*newest_first).limit(50),
+            {"ix_matches_played_at"},
+        ),
+        "matches page: by game": (
+            Database.filter_matches(Database.matches_statement(), game_id=1).order_by(*newest_first).limit(50),
+            {"ix_matches_game_id_played_at"},
+        ),
+        "matches page: by player": (
+            Database.filter_matches(Database.matches_statement(), player_id=1).order_by(*newest_first).limit(50),
+            {"ix_matches_played_at"},  # and either matchplayers index for the EXISTS, which the full scan check covers
+        ),
+        "leaderboard: recount users' wins": (
+            Leaderboard.counts_statement().where(MatchResult.won_id.in_([1, 2])),
+            {"ix_matchresults_won_id_match_id"},
+        ),
+        "leaderboard: page": (Leaderboard.ranking(), {"ix_leaderboard_wins_user_id"}),
+        "ratings: replay a game": (Ratings.history_statement([1]), {"ix_matches_game_id_played_at"}),
+        "410 check: tombstone lookup": (
+            Database.tombstone_statement(Match, 1),
+            {"sqlite_autoindex_tombstones_1"},  # the table_name, row_id unique constraint
+        ),
+        "purge: pending tombstones": (Purger.pending_statement(500), {"ix_tombstones_pending"}),
+    }
+
+
+def check_query_plans(connection: Connection) -> dict[str, tuple[list[str], set[str]]]:
+    """
+    Checks each hot query's plan uses the indexes it's expected to, and doesn't scan any table without an index
+    :param connection:
+    :return: The plan and problems of every query, by name (an empty set means the query is fine)
+    """
+    results = {}
+    for name, (statement, indexes) in hot_queries().items():
+        plan = query_plan(connection, statement)
+        used = " ".join(plan)
+        problems = {f"{index} unused" for index in indexes if f"INDEX {index}" not in used}
+        problems.update(
+            f"full scan of {line.split()[1]}"
+            for line in plan
+            if line.startswith("SCAN ") and " USING " not in line and line != "SCAN CONSTANT ROW"  # no table
+        )
+        results[name] = (plan, problems)
+    return results
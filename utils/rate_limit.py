@@ -0,0 +1,241 @@
+"""
+Admission control for logging in.
+
+Every login attempt costs a database lookup and an Argon2 verification, so a burst of logins at the start of a lesson or
+a credential-stuffing script can keep every worker's CPU busy. LoginLimiter decides whether an attempt may go ahead
+before any of that work starts:
+- a token bucket per client IP, generous enough for a whole class logging in from behind one school address
+- a token bucket per username, which slows down guessing one account's password from many addresses
+- a cap on how many verifications run at once, so logins can't take over the whole hashing pool
+A rejected attempt costs a couple of dictionary lookups and becomes a 429 with a Retry-After header.
+
+The buckets are kept in least-recently-used order and the least recently used are dropped past a maximum count, so
+memory stays bounded however many addresses or usernames are tried. A dropped bucket comes back full, which is what an
+idle bucket would have refilled to anyway. Limits are per process: with several workers, each enforces its own.
+"""
+import math
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Optional
+
+from utils.config import env_bool, env_float, env_int
+
+
+class RateLimited(Exception):
+    """
+    Raised when a login attempt isn't admitted.
+    """
+
+    def __init__(self, message: str, retry_after: float) -> None:
+        """
+        Initialization logic for RateLimited object
+        :param message:
+        :param retry_after: Seconds until an attempt could be admitted
+        """
+        self.message = message
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    """
+    Tokens left in one bucket, as of the last time it was refilled.
+    """
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens: float = tokens
+        self.updated: float = updated
+
+
+class TokenBuckets(object):
+    """
+    Token buckets by key, bounded to a maximum count in least-recently-used order.
+    Buckets refill continuously at `rate` tokens a second up to `burst`; a new bucket starts full.
+    """
+
+    def __init__(self, burst: float, rate: float, maxsize: int):
+        """
+        Buckets initialization
+        :param burst: Capacity of a bucket - how many attempts can be made at once
+        :param rate: Tokens added per second - the sustained rate of attempts
+        :param maxsize: The maximum number of buckets kept - the least recently used are dropped past this
+        """
+        self.burst: float = burst
+        self.rate: float = rate
+        self.maxsize: int = maxsize
+        self.evicted: int = 0
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def bucket(self, key: str, now: float) -> TokenBucket:
+        """
+        Gets a key's bucket refilled up to now, marking it as recently used
+        :param key:
+        :param now: time.monotonic()
+        :return:
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.burst, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+                self.evicted += 1
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def wait(self, bucket: TokenBucket) -> float:
+        """
+        How long until a bucket has a whole token
+        :param bucket: Refilled up to now
+        :return: Seconds - 0 if it has one now
+        """
+        if bucket.tokens >= 1:
+            return 0.0
+        if self.rate <= 0:
+            return math.inf
+        return (1 - bucket.tokens) / self.rate
+
+
+class LoginLimiter(object):
+    """
+    Decides whether a login attempt may verify a password.
+    """
+
+    ENABLED = env_bool("LOGIN_RATE_LIMIT", True)
+    IP_BURST = env_float("LOGIN_IP_BURST", 60)  # a class logging in at once from behind one address
+    IP_RATE = env_float("LOGIN_IP_RATE", 1)  # attempts per second
+    USER_BURST = env_float("LOGIN_USER_BURST", 5)
+    USER_RATE = env_float("LOGIN_USER_RATE", 0.1)  # attempts per second - one every 10 seconds
+    MAX_BUCKETS = env_int("LOGIN_MAX_BUCKETS", 10000)  # of each kind
+    MAX_VERIFYING = env_int("LOGIN_MAX_VERIFYING", 4)  # logins checking a password at once
+    KEY_LENGTH = 128  # longer usernames share a bucket with others starting the same way
+
+    def __init__(
+        self,
+        enabled: bool = ENABLED,
+        ip_burst: float = IP_BURST,
+        ip_rate: float = IP_RATE,
+        user_burst: float = USER_BURST,
+        user_rate: float = USER_RATE,
+        max_buckets: int = MAX_BUCKETS,
+        max_verifying: int = MAX_VERIFYING,
+    ):
+        """
+        Limiter initialization
+        :param enabled: If False every attempt is admitted (the counts are still kept)
+        :param ip_burst:
+        :param ip_rate:
+        :param user_burst:
+        :param user_rate:
+        :param max_buckets:
+        :param max_verifying:
+        """
+        self.enabled: bool = enabled
+        self.ips: TokenBuckets = TokenBuckets(ip_burst, ip_rate, max_buckets)
+        self.usernames: TokenBuckets = TokenBuckets(user_burst, user_rate, max_buckets)
+        self.max_verifying: int = max_verifying
+        self.verifying: int = 0
+        self.admitted: int = 0
+        self.rejected: dict[str, int] = {"ip": 0, "username": 0, "concurrency": 0}
+
+    def reject(self, reason: str, retry_after: float) -> RateLimited:
+        self.rejected[reason] += 1
+        return RateLimited(f"Too many login attempts ({reason})", retry_after)
+
+    def admit(self, ip: Optional[str], username: str) -> None:
+        """
+        Admits an attempt, taking a token from its IP's and its username's buckets and a verification slot - call
+        release() once the password has been checked
+        :param ip: The client's address (None if unknown, e.g. in tests - then only the username is limited)
+        :param username: As submitted
+        :return:
+        :raises RateLimited: If either bucket is empty or too many verifications are running
+        """
+        if not self.enabled:
+            self.verifying += 1
+            self.admitted += 1
+            return
+        if self.verifying >= self.max_verifying:
+            raise self.reject("concurrency", 1)
+        now = time.monotonic()
+        ip_bucket = self.ips.bucket(ip, now) if ip is not None else None
+        if ip_bucket is not None and ip_bucket.tokens < 1:
+            raise self.reject("ip", self.ips.wait(ip_bucket))
+        username_bucket = self.usernames.bucket(username[: self.KEY_LENGTH], now)
+        if username_bucket.tokens < 1:
+            raise self.reject("username", self.usernames.wait(username_bucket))
+        # Tokens are only taken once both buckets allow the attempt, so a rejection doesn't use up the other one
+        if ip_bucket is not None:
+            ip_bucket.tokens -= 1
+        username_bucket.tokens -= 1
+        self.verifying += 1
+        self.admitted += 1
+
+    def release(self) -> None:
+        self.verifying -= 1
+
+    @contextmanager
+    def attempt(self, ip: Optional[str], username: str) -> Iterator[None]:
+        """
+        Admits an attempt for the duration of the block
+        :param ip:
+        :param username:
+        :return:
+        :raises RateLimited:
+        """
+        self.admit(ip, username)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @staticmethod
+    def retry_after(exc: RateLimited) -> str:
+        # Retry-After takes whole seconds
+        return str(max(1, math.ceil(min(exc.retry_after, 86400))))
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "verifying": self.verifying,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "ip_buckets": len(self.ips),
+            "username_buckets": len(self.usernames),
+            "evicted": self.ips.evicted + self.usernames.evicted,
+        }
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the limiter's counts in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_login"
+        lines = [
+            f"# HELP {name}_admitted_total Login attempts admitted to password verification.",
+            f"# TYPE {name}_admitted_total counter",
+            f"{name}_admitted_total {self.admitted}",
+            f"# HELP {name}_rejected_total Login attempts rejected before verification, by reason.",
+            f"# TYPE {name}_rejected_total counter",
+            *(f'{name}_rejected_total{{reason="{reason}"}} {count}' for reason, count in self.rejected.items()),
+            f"# HELP {name}_verifying Login attempts verifying a password right now.",
+            f"# TYPE {name}_verifying gauge",
+            f"{name}_verifying {self.verifying}",
+            f"# HELP {name}_buckets Token buckets kept, by kind.",
+            f"# TYPE {name}_buckets gauge",
+            f'{name}_buckets{{kind="ip"}} {len(self.ips)}',
+            f'{name}_buckets{{kind="username"}} {len(self.usernames)}',
+            f"# HELP {name}_buckets_evicted_total Least recently used token buckets dropped to bound memory.",
+            f"# TYPE {name}_buckets_evicted_total counter",
+            f"{name}_buckets_evicted_total {self.ips.evicted + self.usernames.evicted}",
+        ]
+        return "\n".join(lines) + "\n"
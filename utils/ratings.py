@@ -0,0 +1,321 @@
+"""
+Elo ratings per user, per game.
+
+A new match updates its two players' ratings in O(1), in the same transaction as the match insert. Anything that
+changes history (an edited or deleted match, or new rating parameters) is handled by recompute(), which replays the
+match history in played_at order. The replay loads the history as NumPy arrays rather than ORM objects, maps every
+(game, user) pair to a dense index, and runs the Elo recurrence over plain lists, so a million matches take seconds.
+
+An edited or deleted match only marks its games as stale (mark_stale), in the request's transaction, and a scheduled
+job replays them (refresh_stale). The replay reads the history and runs the recurrence without holding the write lock,
+then swaps the game's ratings in a short transaction - unless the game changed meanwhile, in which case it's replayed
+again. So a game with a long history never holds up other writes, and its ratings catch up a few seconds after an edit.
+"""
+import logging
+
+from collections.abc import Iterable
+from itertools import chain
+from typing import Optional, Sequence
+
+import numpy as np
+from sqlalchemy import Connection, Row, Select, delete, func, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+
+from models import Match, MatchResult, Rating, StaleRating, User
+from utils.config import env_float
+from utils.db_utils import Database
+
+logger = logging.getLogger("dts.ratings")
+
+
+def replay(
+    game_ids: np.ndarray,
+    won_ids: np.ndarray,
+    lost_ids: np.ndarray,
+    initial: float,
+    k_factor: float,
+    scale: float,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Replays match results (already in played order) and returns the final ratings.
+    Each Elo update depends on the ratings the previous matches produced, so the recurrence itself is sequential, but
+    everything around it (pair indexing, match counts, unpacking the result) is vectorized.
+    :param game_ids: Game of each match
+    :param won_ids: Winner of each match
+    :param lost_ids: Loser of each match
+    :param initial: Rating a user starts a game on
+    :param k_factor: Maximum rating change per match
+    :param scale: Rating difference at which the stronger player is expected to win 10:1
+    :return: Game ids, user ids, ratings and match counts - one entry per (game, user) pair
+    """
+    count = len(game_ids)
+    games = np.asarray(game_ids, dtype=np.int64)
+    # (game, user) pairs packed into one integer each so np.unique can index them without a structured sort
+    keys = np.concatenate(
+        [(games << 32) | np.asarray(won_ids, np.int64), (games << 32) | np.asarray(lost_ids, np.int64)]
+    )
+    pairs, inverse = np.unique(keys, return_inverse=True)
+    winners = inverse[:count].tolist()
+    losers = inverse[count:].tolist()
+
+    ratings = [float(initial)] * len(pairs)
+    for winner, loser in zip(winners, losers):
+        won_rating = ratings[winner]
+        lost_rating = ratings[loser]
+        change = k_factor / (1.0 + 10.0 ** ((won_rating - lost_rating) / scale))
+        ratings[winner] = won_rating + change
+        ratings[loser] = lost_rating - change
+
+    matches = np.bincount(inverse, minlength=len(pairs))
+    return pairs >> 32, pairs & 0xFFFFFFFF, np.asarray(ratings), matches
+
+
+def fetch_history(connection: Connection, statement: Select) -> np.ndarray:
+    """
+    Runs a select of integer columns straight on the DBAPI cursor and returns the rows as a 2D array.
+    Going around SQLAlchemy's result processing matters here - building a million Row objects takes several times
+    longer than the query itself.
+    :param connection: A synchronous connection (this is meant to be called through AsyncConnection.run_sync)
+    :param statement: A select whose parameters are all integers, which are rendered inline
+    :return:
+    """
+    compiled = statement.compile(connection, compile_kwargs={"literal_binds": True})
+    cursor = connection.connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(str(compiled))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    width = len(statement.selected_columns)
+    return np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=len(rows) * width).reshape(-1, width)
+
+
+class Ratings(object):
+    """
+    Maintains and reads the ratings table.
+    Nothing here commits - writes are staged into the caller's transaction (usually through the before_commit hook
+    of a Database write method).
+    """
+
+    INITIAL_RATING = 1500.0
+    K_FACTOR = 32.0
+    SCALE = 400.0
+    REFRESH_INTERVAL = env_float("RATINGS_REFRESH_INTERVAL", 5)  # seconds between replays of stale games
+    REFRESH_ATTEMPTS = 3  # optimistic replays of a stale game before it's replayed holding the write lock
+
+    @classmethod
+    def exchange(cls, won_rating: float, lost_rating: float) -> float:
+        """
+        Calculates how many points the winner takes from the loser
+        :param won_rating:
+        :param lost_rating:
+        :return:
+        """
+        return cls.K_FACTOR / (1.0 + 10.0 ** ((won_rating - lost_rating) / cls.SCALE))
+
+    @classmethod
+    async def record_result(cls, session: AsyncSession, game_id: int, won_id: int, lost_id: int) -> None:
+        """
+        Applies a new match result to both players' ratings for the game
+        :param session:
+        :param game_id:
+        :param won_id:
+        :param lost_id:
+        :return:
+        """
+        statement = select(Rating.user_id, Rating.rating).where(
+            Rating.game_id == game_id, Rating.user_id.in_((won_id, lost_id))
+        )
+        current = dict((await session.execute(statement)).tuples().all())
+        won_rating = current.get(won_id, cls.INITIAL_RATING)
+        lost_rating = current.get(lost_id, cls.INITIAL_RATING)
+        change = cls.exchange(won_rating, lost_rating)
+
+        table = Rating.__table__
+        upsert = insert(table)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[table.c.user_id, table.c.game_id],
+            set_={"rating": upsert.excluded.rating, "matches": table.c.matches + 1},
+        )
+        await session.execute(
+            upsert,
+            [
+                {"user_id": won_id, "game_id": game_id, "rating": won_rating + change, "matches": 1},
+                {"user_id": lost_id, "game_id": game_id, "rating": lost_rating - change, "matches": 1},
+            ],
+        )
+
+    @staticmethod
+    def history_statement(game_ids: Optional[Sequence[int]] = None) -> Select:
+        """
+        Statement for the results to replay, in the order the matches were played
+        :param game_ids: Optional games to limit the history to
+        :return:
+        """
+        history = (
+            select(Match.game_id, MatchResult.won_id, MatchResult.lost_id)
+            .join(Match, Match.id == MatchResult.match_id)
+            .order_by(Match.played_at, Match.id)
+        )
+        if game_ids is not None:
+            history = history.where(Match.game_id.in_(game_ids))
+        return history
+
+    @classmethod
+    async def recompute(
+        cls,
+        session: AsyncSession,
+        game_ids: Optional[Iterable[int]] = None,
+        initial: Optional[float] = None,
+        k_factor: Optional[float] = None,
+        scale: Optional[float] = None,
+    ) -> int:
+        """
+        Replaces ratings with a replay of the match history, ignoring results whose match no longer exists
+        :param session:
+        :param game_ids: Optional games to recompute (all games if not given)
+        :param initial: Optional override of INITIAL_RATING
+        :param k_factor: Optional override of K_FACTOR
+        :param scale: Optional override of SCALE
+        :return: The number of matches replayed
+        """
+        clear = delete(Rating)
+        if game_ids is not None:
+            game_ids = list(game_ids)
+            if not game_ids:
+                return 0
+            clear = clear.where(Rating.game_id.in_(game_ids))
+        history = cls.history_statement(game_ids)
+
+        # Clearing first puts the whole recompute on one (writer) connection, which then sees any uncommitted change
+        await session.execute(clear)
+        connection = await session.connection()
+        rows = await connection.run_sync(fetch_history, history)
+        await cls.write(connection, cls.replay_rows(rows, initial, k_factor, scale))
+        return len(rows)
+
+    @classmethod
+    def replay_rows(
+        cls,
+        rows: np.ndarray,
+        initial: Optional[float] = None,
+        k_factor: Optional[float] = None,
+        scale: Optional[float] = None,
+    ) -> list[tuple]:
+        """
+        Replays history rows from fetch_history into rating rows
+        :param rows:
+        :param initial: Optional override of INITIAL_RATING
+        :param k_factor: Optional override of K_FACTOR
+        :param scale: Optional override of SCALE
+        :return: (game_id, user_id, rating, matches) tuples
+        """
+        if not len(rows):
+            return []
+        games, users, ratings, matches = replay(
+            rows[:, 0],
+            rows[:, 1],
+            rows[:, 2],
+            cls.INITIAL_RATING if initial is None else initial,
+            cls.K_FACTOR if k_factor is None else k_factor,
+            cls.SCALE if scale is None else scale,
+        )
+        return list(zip(games.tolist(), users.tolist(), ratings.tolist(), matches.tolist()))
+
+    @staticmethod
+    async def write(connection: AsyncConnection, rows: list[tuple]) -> None:
+        # Plain tuples through the driver's executemany, for the same reason as fetch_history
+        if rows:
+            await connection.exec_driver_sql(
+                "INSERT INTO ratings (game_id, user_id, rating, matches) VALUES (?, ?, ?, ?)", rows
+            )
+
+    @staticmethod
+    async def mark_stale(session: AsyncSession, game_ids: Iterable[int]) -> None:
+        """
+        Marks games as needing their ratings replayed, for refresh_stale() to pick up
+        :param session:
+        :param game_ids:
+        :return:
+        """
+        game_ids = list(game_ids)
+        if not game_ids:
+            return None
+        table = StaleRating.__table__
+        upsert = insert(table).on_conflict_do_update(
+            index_elements=[table.c.game_id], set_={"requests": table.c.requests + 1}
+        )
+        await session.execute(upsert, [{"game_id": game_id, "requests": 1} for game_id in game_ids])
+
+    @classmethod
+    async def refresh_game(cls, db: Database, game_id: int, requests: int) -> bool:
+        """
+        Replays one stale game without holding the write lock, then swaps its ratings in if it hasn't changed since
+        :param db:
+        :param game_id:
+        :param requests: The game's request count when it was picked up
+        :return: Whether the ratings were swapped in (False if the game changed meanwhile)
+        """
+        last_match = select(func.max(Match.id)).where(Match.game_id == game_id)
+        async with db.read_engine.connect() as connection:
+            seen = (await connection.execute(last_match)).scalar()
+            rows = cls.replay_rows(await connection.run_sync(fetch_history, cls.history_statement([game_id])))
+        async with db.LocalSession() as session:
+            # Deleting the mark first takes the write lock, so nothing can change between the checks and the swap
+            unmarked = await session.execute(
+                delete(StaleRating).where(StaleRating.game_id == game_id, StaleRating.requests == requests)
+            )
+            if not unmarked.rowcount or (await session.execute(last_match)).scalar() != seen:
+                await session.rollback()
+                return False
+            await session.execute(delete(Rating).where(Rating.game_id == game_id))
+            await cls.write(await session.connection(), rows)
+            await session.commit()
+        return True
+
+    @classmethod
+    async def refresh_stale(cls, db: Database) -> int:
+        """
+        Replays the ratings of every game marked stale - one game at a time, each swapped in its own short transaction
+        :param db:
+        :return: The number of games replayed
+        """
+        async with db.LocalSession() as session:
+            stale = (await session.execute(select(StaleRating.game_id, StaleRating.requests))).tuples().all()
+        for game_id, requests in stale:
+            for _ in range(cls.REFRESH_ATTEMPTS):
+                if await cls.refresh_game(db, game_id, requests):
+                    break
+                async with db.LocalSession() as session:
+                    requests = await session.scalar(select(StaleRating.requests).where(StaleRating.game_id == game_id))
+                if requests is None:
+                    break  # replayed by another worker
+            else:
+                # The game keeps changing - replayed with the write lock held, so it can't change underneath
+                logger.info("Replaying the ratings of busy game %s in one transaction", game_id)
+                async with db.LocalSession() as session:
+                    await session.execute(delete(StaleRating).where(StaleRating.game_id == game_id))
+                    await cls.recompute(session, [game_id])
+                    await session.commit()
+        return len(stale)
+
+    @staticmethod
+    async def top(session: AsyncSession, game_id: int, limit: Optional[int] = None) -> Sequence[Row]:
+        """
+        Reads a game's ratings in descending order, as rows with user, rating and matches attributes
+        :param session:
+        :param game_id:
+        :param limit: Optional limit of entries to fetch
+        :return:
+        """
+        statement = (
+            select(User.username.label("user"), Rating.rating, Rating.matches)
+            .join(User, User.id == Rating.user_id)
+            .where(Rating.game_id == game_id)
+            .order_by(Rating.rating.desc())
+        )
+        if limit is not None:
+            statement = statement.limit(limit)
+        executed = await session.execute(statement)
+        return executed.all()
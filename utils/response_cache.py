@@ -0,0 +1,180 @@
+"""
+Versioned response and fragment caching with conditional GET.
+
+A cache key names what's being produced (a template or query), the versions of the tables it's built from (see
+utils.versions) and whatever else it depends on (the user's role, the query string). Since a write bumps the versions,
+entries never need invalidating - a changed table just means a new key, and the old entry ages out of the LRU.
+
+The ETag of a response is a hash of its key, so it can be checked before anything is queried or rendered: a client
+sending a matching If-None-Match gets a 304 with no body at all.
+
+Given a SharedCache, entries are also kept there for the other workers - an entry missing from this process's LRU is
+looked up in the shared cache before it's produced again.
+
+Versions only cover the writes other workers make when they're shared (DTS_SHARED_CACHE). Otherwise a worker can't
+tell that another one has written, so keys also carry the current LOCAL_TTL-second window of the clock: bodies and
+ETags are then at most that stale with several workers. A single worker sees every write, so it can set
+DTS_RESPONSE_CACHE_LOCAL_TTL to 0 and rely on the versions alone.
+"""
+import hashlib
+import time
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any, Optional
+
+from fastapi import Request, Response, status
+
+from utils.cache import TTLCache
+from utils.config import env_float, env_int
+from utils.shared_cache import SharedCache
+from utils.versions import DataVersions, data_versions
+
+
+class ResponseCache(object):
+    """
+    Cache of rendered pages and query results, keyed on table versions.
+    """
+
+    SIZE = env_int("RESPONSE_CACHE_SIZE", 256)
+    TTL = env_float("RESPONSE_CACHE_TTL", 3600)  # only frees memory - versions keep entries from going stale
+    LOCAL_TTL = env_float("RESPONSE_CACHE_LOCAL_TTL", 5)  # seconds an entry is trusted while versions aren't shared
+
+    def __init__(
+        self,
+        versions: DataVersions = data_versions,
+        maxsize: int = SIZE,
+        ttl: float = TTL,
+        shared: Optional[SharedCache] = None,
+        local_ttl: float = LOCAL_TTL,
+    ):
+        """
+        Cache initialization
+        :param versions: The table versions keys are built from
+        :param maxsize:
+        :param ttl:
+        :param shared: Optional cache shared with other workers (which should share the versions too)
+        :param local_ttl: How long keys last while the versions are only this process's (0 for as long as they do)
+        """
+        self.versions: DataVersions = versions
+        self.local_ttl: float = local_ttl
+        self.entries: TTLCache = TTLCache(maxsize, ttl)
+        self.shared: Optional[SharedCache] = shared
+        self.not_modified: int = 0
+
+    def key(self, name: str, tables: tuple[str, ...], *extra: Hashable) -> tuple:
+        """
+        Builds a cache key
+        :param name: What's being cached, e.g. a template name
+        :param tables: The tables it's built from
+        :param extra: Anything else the result depends on
+        :return:
+        """
+        if self.versions.shared is None and self.local_ttl > 0:
+            # The wall clock's window, rather than this process's own clock, so every worker's ETags agree
+            return name, self.versions.get(*tables), int(time.time() // self.local_ttl), *extra
+        return name, self.versions.get(*tables), *extra
+
+    @staticmethod
+    def etag(key: tuple) -> str:
+        # Weak, since the same key could in principle render to different bytes (e.g. after a deploy)
+        return f'W/"{hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()}"'
+
+    @staticmethod
+    def is_fresh(request: Request, etag: str) -> bool:
+        """
+        Checks whether the client already has the response, by its If-None-Match header (weak comparison)
+        :param request:
+        :param etag:
+        :return:
+        """
+        header = request.headers.get("if-none-match")
+        if header is None:
+            return False
+        tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+        return "*" in tags or etag.removeprefix("W/") in tags
+
+    def lookup(self, key: tuple) -> Any:
+        """
+        Gets an entry from this process's LRU, or failing that from the shared cache
+        :param key:
+        :return: None if neither has it
+        """
+        value = self.entries.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.entries.set(key, value)
+        return value
+
+    def store(self, key: tuple, value: Any) -> None:
+        self.entries.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value, self.entries.ttl)
+
+    async def fragment(self, key: tuple, produce: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Gets a cached value (e.g. query results), producing and caching it if there's no entry for the key
+        :param key: From key()
+        :param produce: Coroutine function making the value
+        :return:
+        """
+        value = self.lookup(key)
+        if value is None:
+            value = await produce()
+            self.store(key, value)
+        return value
+
+    async def respond(
+        self,
+        request: Request,
+        key: tuple,
+        render: Callable[[], Awaitable[Response]],
+        cache_body: bool = True,
+        cache_control: str = "private, no-cache",
+    ) -> Response:
+        """
+        Answers a GET from the cache: a 304 if the client's copy is current, otherwise the cached or freshly rendered
+        response, with its ETag
+        :param request:
+        :param key: From key() - it must capture everything the response depends on
+        :param render: Coroutine function making the response (only successful responses are cached)
+        :param cache_body: Whether to keep the rendered body - off for pages with per-user content, which still get
+                           an ETag (their key should then include the user)
+        :param cache_control: Cache-Control header - no-cache has clients revalidate (cheaply) on every use
+        :return:
+        """
+        etag = self.etag(key)
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Vary": "Cookie"}
+        if self.is_fresh(request, etag):
+            self.not_modified += 1
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        if cache_body:
+            cached = self.lookup(key)
+            if cached is not None:
+                body, media_type = cached
+                return Response(content=body, media_type=media_type, headers=headers)
+        response = await render()
+        if cache_body and response.status_code == status.HTTP_200_OK:
+            self.store(key, (response.body, response.media_type))
+        response.headers.update(headers)
+        return response
+
+    def stats(self) -> dict:
+        stats = {**self.entries.stats(), "not_modified": self.not_modified}
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the cache's counters, and the shared cache's if there is one, in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_page_not_modified_total"
+        lines = [
+            f"# HELP {name} Conditional requests answered with 304 Not Modified.",
+            f"# TYPE {name} counter",
+            f"{name} {self.not_modified}",
+        ]
+        rendered = self.entries.render("page", "rendered pages and query results", prefix) + "\n".join(lines) + "\n"
+        return rendered if self.shared is None else rendered + self.shared.render(prefix)
@@ -0,0 +1,206 @@
+"""
+Adaptive Sentry sampling.
+
+Tracing and profiling every request costs a noticeable share of CPU under load, so TraceSampler decides per request
+instead (it's passed to sentry_sdk.init as traces_sampler and profiles_sampler):
+- each route has a base rate (DTS_SENTRY_TRACES_RATE, overridden per route by DTS_SENTRY_ROUTE_RATES, e.g.
+  "GET /leaderboard=0.01,POST /token=0");
+- a route that recently failed (5xx) or was slow is sampled at the error or slow rate for a while, so problems are
+  traced when they're happening - fed by the metrics middleware's per-request observations;
+- while the request rate is above DTS_SENTRY_MAX_RPS, every rate is capped at the small DTS_SENTRY_TARGET_RATE.
+Its effective rate (the mean of the rates it handed out) and the throughput it saw are reported at /metrics.
+
+With DTS_SENTRY_STUB set, events go to StubTransport, which keeps them in memory instead of sending them - for working
+and testing offline.
+"""
+import time
+from collections import Counter, deque
+from typing import Any, Optional
+
+from sentry_sdk.envelope import Envelope
+from sentry_sdk.transport import Transport
+from starlette.routing import BaseRoute, Match
+
+from utils.config import env_bool, env_float, env_str
+
+
+def parse_rates(value: str) -> dict[str, float]:
+    """
+    Parses per-route rates, e.g. "GET /leaderboard=0.01,POST /token=0"
+    :param value:
+    :return: Rates by "METHOD /route/{template}"
+    """
+    rates = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        route, _, rate = item.rpartition("=")
+        rates[" ".join(route.split())] = float(rate)
+    return rates
+
+
+class TraceSampler(object):
+    """
+    Decides which requests Sentry traces and profiles.
+    """
+
+    TRACES_RATE = env_float("SENTRY_TRACES_RATE", 0.1)  # base rate for routes without their own
+    ROUTE_RATES = parse_rates(env_str("SENTRY_ROUTE_RATES", ""))
+    ERROR_RATE = env_float("SENTRY_ERROR_RATE", 1.0)  # error events, and traces of routes that recently failed
+    SLOW_RATE = env_float("SENTRY_SLOW_RATE", 0.5)  # traces of routes that were recently slow
+    SLOW_MS = env_float("SENTRY_SLOW_MS", 500)
+    HOLD_SECONDS = env_float("SENTRY_HOLD_SECONDS", 60)  # how long a failure or slow request raises a route's rate
+    MAX_RPS = env_float("SENTRY_MAX_RPS", 50)  # above this request rate, sampling drops to TARGET_RATE
+    TARGET_RATE = env_float("SENTRY_TARGET_RATE", 0.01)
+    PROFILES_RATE = env_float("SENTRY_PROFILES_RATE", 1.0)  # share of traced requests that are also profiled
+    STUB_TRANSPORT = env_bool("SENTRY_STUB", False)
+    # Probing every library Sentry can integrate with imports them all (httpx, redis...) - the app only needs its own
+    AUTO_INTEGRATIONS = env_bool("SENTRY_AUTO_INTEGRATIONS", False)
+
+    def __init__(self, routes: Optional[list[BaseRoute]] = None):
+        """
+        Sampler initialization
+        :param routes: The app's routes (app.routes), to tell which route a request is for
+        """
+        self.routes: list[BaseRoute] = routes if routes is not None else []
+        self.raised_until: dict[str, tuple[float, float]] = {}  # route -> (raised rate, until when)
+        self.window_start: float = time.monotonic()
+        self.window_requests: int = 0
+        self.window_rate_sum: float = 0.0
+        self.throughput: float = 0.0  # requests per second over the last full second
+        self.effective_rate: float = 0.0  # mean rate over the last full second
+        self.decisions: int = 0
+        self.rate_sum: float = 0.0
+
+    def route_of(self, scope: dict) -> str:
+        """
+        Names the route a request is for, e.g. "GET /match/{match_id}" (the path itself if no route matches)
+        :param scope: The request's ASGI scope
+        :return:
+        """
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return f"{scope.get('method')} {getattr(route, 'path', scope.get('path'))}"
+        return f"{scope.get('method')} {scope.get('path')}"
+
+    def observe(self, method: str, route: str, status_code: int, seconds: float) -> None:
+        """
+        Raises a route's rate for a while after it fails or is slow - called for every finished request
+        :param method:
+        :param route: The route's path template
+        :param status_code:
+        :param seconds: The request's latency
+        :return:
+        """
+        if status_code >= 500:
+            rate = self.ERROR_RATE
+        elif seconds * 1000 >= self.SLOW_MS:
+            rate = self.SLOW_RATE
+        else:
+            return None
+        key = f"{method} {route}"
+        current, until = self.raised_until.get(key, (0.0, 0.0))
+        now = time.monotonic()
+        # A failure's higher rate isn't lowered by a slow request while it lasts
+        if until < now or rate >= current:
+            self.raised_until[key] = (rate, now + self.HOLD_SECONDS)
+
+    def rate_for(self, route: str, now: float) -> float:
+        """
+        Works out the rate for a request to a route
+        :param route: From route_of()
+        :param now: time.monotonic()
+        :return:
+        """
+        rate = self.ROUTE_RATES.get(route, self.TRACES_RATE)
+        raised, until = self.raised_until.get(route, (0.0, 0.0))
+        if until >= now:
+            rate = max(rate, raised)
+        if self.throughput > self.MAX_RPS:
+            rate = min(rate, self.TARGET_RATE)
+        return rate
+
+    def traces_sampler(self, sampling_context: dict[str, Any]) -> float:
+        """
+        Sentry's traces_sampler - called as each transaction starts
+        :param sampling_context:
+        :return: The probability of tracing it
+        """
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            self.throughput = self.window_requests / elapsed
+            self.effective_rate = self.window_rate_sum / self.window_requests if self.window_requests else 0.0
+            self.window_start, self.window_requests, self.window_rate_sum = now, 0, 0.0
+        parent_sampled = sampling_context.get("parent_sampled")
+        scope = sampling_context.get("asgi_scope")
+        if parent_sampled is not None:
+            # Part of a trace started elsewhere - follow its decision
+            rate = 1.0 if parent_sampled else 0.0
+        elif scope is not None and scope.get("type") == "http":
+            rate = self.rate_for(self.route_of(scope), now)
+        else:
+            rate = self.TRACES_RATE
+        self.window_requests += 1
+        self.window_rate_sum += rate
+        self.decisions += 1
+        self.rate_sum += rate
+        return rate
+
+    def profiles_sampler(self, sampling_context: dict[str, Any]) -> float:
+        """
+        Sentry's profiles_sampler - only called for transactions that are being traced
+        :param sampling_context:
+        :return: The probability of profiling it
+        """
+        return 0.0 if self.throughput > self.MAX_RPS else self.PROFILES_RATE
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the sampler's state in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_sentry"
+        lines = [
+            f"# HELP {name}_effective_sample_rate Mean traces sample rate over the last second.",
+            f"# TYPE {name}_effective_sample_rate gauge",
+            f"{name}_effective_sample_rate {self.effective_rate}",
+            f"# HELP {name}_throughput_rps Requests per second over the last second, as seen by the sampler.",
+            f"# TYPE {name}_throughput_rps gauge",
+            f"{name}_throughput_rps {self.throughput}",
+            f"# HELP {name}_sampling_decisions_total Transactions the sampler has decided on.",
+            f"# TYPE {name}_sampling_decisions_total counter",
+            f"{name}_sampling_decisions_total {self.decisions}",
+            f"# HELP {name}_sample_rate_sum Sum of the rates handed out (divide by the decisions for the mean).",
+            f"# TYPE {name}_sample_rate_sum counter",
+            f"{name}_sample_rate_sum {self.rate_sum}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+class StubTransport(Transport):
+    """
+    Sentry transport keeping what would be sent in memory, e.g. for tests or working offline.
+    """
+
+    def __init__(self, options: Optional[dict] = None, maxlen: int = 1000):
+        """
+        Transport initialization
+        :param options: Sentry's client options
+        :param maxlen: How many envelopes and events to keep
+        """
+        super().__init__(options)
+        self.envelopes: deque[Envelope] = deque(maxlen=maxlen)
+        self.events: deque[dict] = deque(maxlen=maxlen)
+        self.counts: Counter = Counter()  # by item type - "event", "transaction", "profile"...
+
+    def capture_event(self, event: dict) -> None:
+        self.events.append(event)
+        self.counts["event"] += 1
+
+    def capture_envelope(self, envelope: Envelope) -> None:
+        self.envelopes.append(envelope)
+        for item in envelope.items:
+            self.counts[item.type] += 1
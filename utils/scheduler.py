@@ -0,0 +1,355 @@
+"""
+Background jobs.
+
+The Scheduler runs maintenance work on the event loop of each worker, away from the request paths: every job has its
+own task that sleeps until the job is next due, runs it, and works out the next time. A job is due either every
+`interval` seconds or at the times a cron expression (minute hour day-of-month month day-of-week) matches, each delayed
+by a random `jitter` so workers started together don't all wake at once.
+
+With several workers, an exclusive job is run by one of them each time: before running, a worker claims the job's
+lease row (models.JobLease) with one upsert that only succeeds if the lease has expired or is already its own. The
+lease is held until around when the job is next due, so the other workers skip that run. A worker that dies holding a
+lease just delays the job until the lease expires. Jobs that only touch the worker's own memory aren't exclusive.
+
+Each job's runs, failures, skips and durations are served at /metrics. stop() stops jobs from starting, gives running
+ones a grace period to finish, cancels whatever is left, and hands back the worker's leases.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import update
+from sqlalchemy.dialects.sqlite import insert
+
+from models import JobLease
+from utils.config import env_bool, env_float
+from utils.db_utils import Database
+
+type job_function = Callable[[], Awaitable[object]]  # type alias for the coroutine function a job runs
+
+logger = logging.getLogger("dts.scheduler")
+
+
+class CronSchedule(object):
+    """
+    Five-field cron expression - minute, hour, day of month, month, day of week (0 or 7 is Sunday) - where each field
+    is `*`, a number, a range `a-b`, a step `*/n` or `a-b/n`, or a comma-separated list of those. As in cron, when both
+    the day of month and day of week are restricted, a day matching either matches.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        """
+        Parses the expression
+        :param expression:
+        :raises ValueError: If it isn't a valid five-field expression
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression {expression!r} should have 5 fields, not {len(fields)}")
+        self.expression: str = expression
+        parsed = [self.parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays: set[int] = {day % 7 for day in weekdays}
+        self.any_day: bool = fields[2] == "*"
+        self.any_weekday: bool = fields[4] == "*"
+
+    @staticmethod
+    def parse(field: str, low: int, high: int) -> set[int]:
+        values = set()
+        for part in field.split(","):
+            spread, _, step = part.partition("/")
+            if spread == "*":
+                start, end = low, high
+            elif "-" in spread:
+                start, end = (int(value) for value in spread.split("-", 1))
+            else:
+                start = end = int(spread)
+                if step:
+                    end = high
+            if not low <= start <= end <= high or (step and int(step) < 1):
+                raise ValueError(f"Cron field {field!r} is outside {low}-{high}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def day_matches(self, moment: datetime) -> bool:
+        weekday = moment.isoweekday() % 7  # Sunday is 0
+        if self.any_day or self.any_weekday:
+            return moment.day in self.days and weekday in self.weekdays
+        return moment.day in self.days or weekday in self.weekdays
+
+    def next_after(self, moment: datetime) -> datetime:
+        """
+        The first matching minute after a moment, skipping whole months, days and hours that can't match
+        :param moment:
+        :return:
+        :raises ValueError: If nothing matches within the next five years (e.g. the 31st of February)
+        """
+        candidate = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while candidate <= limit:
+            if candidate.month not in self.months:
+                candidate = (candidate.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(candidate):
+                candidate = candidate.replace(hour=0, minute=0) + timedelta(days=1)
+            elif candidate.hour not in self.hours:
+                candidate = candidate.replace(minute=0) + timedelta(hours=1)
+            elif candidate.minute not in self.minutes:
+                candidate += timedelta(minutes=1)
+            else:
+                return candidate
+        raise ValueError(f"Cron expression {self.expression!r} never matches")
+
+
+class Job(object):
+    """
+    A function run on a schedule, with its run counts and timings.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        function: job_function,
+        interval: Optional[float] = None,
+        cron: Optional[str] = None,
+        jitter: float = 0,
+        exclusive: bool = True,
+        timeout: Optional[float] = None,
+    ):
+        """
+        Job initialization - give exactly one of interval and cron
+        :param name: Unique, and used as the lease's name and the metrics' label
+        :param function: Coroutine function taking no arguments
+        :param interval: Seconds between runs, the first one interval after the scheduler starts
+        :param cron: Cron expression of when to run, in local time
+        :param jitter: Up to this many seconds are added to each wait at random
+        :param exclusive: Whether only one worker should run each run (through the lease), rather than every worker
+        :param timeout: Optional limit in seconds on one run, after which it's cancelled
+        """
+        if (interval is None) == (cron is None):
+            raise ValueError(f"Job {name!r} needs either an interval or a cron expression")
+        self.name: str = name
+        self.function: job_function = function
+        self.interval: Optional[float] = interval
+        self.cron: Optional[CronSchedule] = CronSchedule(cron) if cron is not None else None
+        self.jitter: float = jitter
+        self.exclusive: bool = exclusive
+        self.timeout: Optional[float] = timeout
+        self.running: bool = False
+        self.outcomes: dict[str, int] = {"ok": 0, "failed": 0, "timeout": 0, "skipped": 0}
+        self.seconds: float = 0.0  # total time spent running
+        self.last_seconds: Optional[float] = None
+        self.last_success: Optional[float] = None  # Unix time
+
+    def next_delay(self) -> float:
+        """
+        Seconds from now until the job is next due, jitter included
+        :return:
+        """
+        if self.cron is not None:
+            now = datetime.now()
+            delay = (self.cron.next_after(now) - now).total_seconds()
+        else:
+            delay = self.interval
+        return delay + random.uniform(0, self.jitter)
+
+    def lease_seconds(self, delay: float) -> float:
+        # Held until a little before the next run is due (so the same run isn't done twice by workers whose jitter
+        # differs), or for as long as a run may take
+        return max(delay * 0.9, self.timeout or 0)
+
+
+class Scheduler(object):
+    """
+    Runs jobs in the background of a worker.
+    """
+
+    ENABLED = env_bool("SCHEDULER", True)
+    GRACE = env_float("SCHEDULER_GRACE", 10)  # seconds running jobs get to finish on shutdown
+
+    def __init__(self, grace: float = GRACE):
+        """
+        Scheduler initialization
+        :param grace:
+        """
+        self.grace: float = grace
+        self.jobs: dict[str, Job] = {}
+        # Identifies this worker as a lease holder - unique even where process ids are reused, e.g. across containers
+        self.owner: str = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._db: Optional[Database] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+
+    def add(self, job: Job) -> Job:
+        if job.name in self.jobs:
+            raise ValueError(f"There is already a job called {job.name!r}")
+        self.jobs[job.name] = job
+        return job
+
+    async def claim(self, job: Job, seconds: float) -> bool:
+        """
+        Takes or renews a job's lease
+        :param job:
+        :param seconds: How long to hold it
+        :return: Whether this worker holds it now
+        """
+        now = time.time()
+        statement = (
+            insert(JobLease)
+            .values(name=job.name, owner=self.owner, expires_at=now + seconds)
+            .on_conflict_do_update(
+                index_elements=[JobLease.name],
+                set_={"owner": self.owner, "expires_at": now + seconds},
+                where=(JobLease.expires_at <= now) | (JobLease.owner == self.owner),
+            )
+        )
+        async with self._db.LocalSession() as session:
+            executed = await session.execute(statement)
+            await session.commit()
+        return executed.rowcount > 0
+
+    async def release(self) -> None:
+        """
+        Hands back every lease this worker holds, so another worker can run those jobs without waiting for them to
+        expire
+        :return:
+        """
+        async with self._db.LocalSession() as session:
+            await session.execute(update(JobLease).where(JobLease.owner == self.owner).values(expires_at=0))
+            await session.commit()
+
+    async def run(self, job: Job) -> None:
+        """
+        Runs a job once, recording the outcome
+        :param job:
+        :return:
+        """
+        job.running = True
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(job.function(), job.timeout)
+        except asyncio.TimeoutError:
+            job.outcomes["timeout"] += 1
+            logger.warning("Job %s timed out after %ss", job.name, job.timeout)
+        except Exception:
+            job.outcomes["failed"] += 1
+            logger.exception("Job %s failed", job.name)
+        else:
+            job.outcomes["ok"] += 1
+            job.last_success = time.time()
+        finally:
+            job.running = False
+            job.last_seconds = time.perf_counter() - started
+            job.seconds += job.last_seconds
+
+    async def loop(self, job: Job) -> None:
+        """
+        Runs a job whenever it's due, until the scheduler stops
+        :param job:
+        :return:
+        """
+        while not self._stopping.is_set():
+            delay = job.next_delay()
+            try:
+                await asyncio.wait_for(self._stopping.wait(), delay)
+                return  # stopping
+            except asyncio.TimeoutError:
+                pass
+            if job.exclusive:
+                try:
+                    claimed = await self.claim(job, job.lease_seconds(job.next_delay()))
+                except Exception:
+                    # e.g. the database is locked for longer than the busy timeout - this run is skipped
+                    logger.exception("Couldn't claim the lease of job %s", job.name)
+                    claimed = False
+                if not claimed:
+                    job.outcomes["skipped"] += 1
+                    continue
+            await self.run(job)
+
+    def start(self, db: Database) -> None:
+        """
+        Starts every job's loop on the running event loop
+        :param db: Where the leases are kept
+        :return:
+        """
+        if self._tasks:
+            return None
+        self._db = db
+        self._stopping = asyncio.Event()
+        self._tasks = [asyncio.create_task(self.loop(job), name=f"job {job.name}") for job in self.jobs.values()]
+
+    async def stop(self) -> None:
+        """
+        Stops starting jobs, waits up to the grace period for running ones, cancels the rest and releases the leases
+        :return:
+        """
+        if not self._tasks:
+            return None
+        self._stopping.set()
+        done, pending = await asyncio.wait(self._tasks, timeout=self.grace)
+        for task in pending:
+            logger.warning("Cancelling %s, still running after %ss", task.get_name(), self.grace)
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        self._tasks = []
+        try:
+            await self.release()
+        except Exception:
+            logger.exception("Couldn't release the job leases")
+
+    def stats(self) -> dict:
+        return {
+            name: {"outcomes": dict(job.outcomes), "seconds": job.seconds, "running": job.running}
+            for name, job in self.jobs.items()
+        }
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders every job's counts and timings in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_job"
+        lines = [
+            f"# HELP {name}_runs_total Scheduled job runs by outcome (skipped when another worker held the lease).",
+            f"# TYPE {name}_runs_total counter",
+        ]
+        for job in self.jobs.values():
+            lines += [f'{name}_runs_total{{job="{job.name}",outcome="{o}"}} {n}' for o, n in job.outcomes.items()]
+        lines += [
+            f"# HELP {name}_duration_seconds Time spent running each scheduled job.",
+            f"# TYPE {name}_duration_seconds summary",
+        ]
+        for job in self.jobs.values():
+            runs = job.outcomes["ok"] + job.outcomes["failed"] + job.outcomes["timeout"]
+            lines.append(f'{name}_duration_seconds_sum{{job="{job.name}"}} {job.seconds}')
+            lines.append(f'{name}_duration_seconds_count{{job="{job.name}"}} {runs}')
+        lines += [
+            f"# HELP {name}_last_duration_seconds How long each job's latest run took.",
+            f"# TYPE {name}_last_duration_seconds gauge",
+            *(
+                f'{name}_last_duration_seconds{{job="{job.name}"}} {job.last_seconds}'
+                for job in self.jobs.values()
+                if job.last_seconds is not None
+            ),
+            f"# HELP {name}_last_success_timestamp_seconds When each job last ran successfully in this worker.",
+            f"# TYPE {name}_last_success_timestamp_seconds gauge",
+            *(
+                f'{name}_last_success_timestamp_seconds{{job="{job.name}"}} {job.last_success}'
+                for job in self.jobs.values()
+                if job.last_success is not None
+            ),
+            f"# HELP {name}_running Whether each job is running right now.",
+            f"# TYPE {name}_running gauge",
+            *(f'{name}_running{{job="{job.name}"}} {int(job.running)}' for job in self.jobs.values()),
+        ]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,251 @@
+"""
+Caching shared by every worker process on a host.
+
+With several uvicorn workers, each has its own copy of every in-process cache, filled separately and - since data
+versions (utils.versions) were per process - invalidated only by its own writes. Setting DTS_SHARED_CACHE to a file path
+shares both across the workers, with no service to run:
+- SharedCounters keeps the table versions in a small memory-mapped file. Reading a version is a read from shared memory,
+  so a write committed by one worker changes the cache keys of every other worker straight away. Bumps take an
+  exclusive file lock, so concurrent writers don't lose increments.
+- SharedCache is a SQLite file of pickled values by key. ResponseCache puts what it caches there too, so a page rendered
+  by one worker is served from the cache by the others. Keys carry the table versions, so entries never need
+  invalidating; the oldest are pruned past a maximum count.
+The cache only holds what the app itself wrote, and failing to read or write it (e.g. while another worker holds the
+lock) just counts as a miss.
+
+Versions change through the app's sessions (and the manage.py commands, which use the same setting), and every table's
+version is bumped when a process connects to the database, so a data.db replaced while the app was stopped isn't
+served from the cache of the old one.
+"""
+import hashlib
+import io
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import time
+import zlib
+from collections.abc import Hashable, Iterable
+from functools import lru_cache
+from typing import Any, Optional
+
+from utils.config import env_float, env_int, env_str
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class SharedCounters(object):
+    """
+    Named counters in a memory-mapped file, readable and incrementable from any process.
+    Each name hashes to one of SLOTS aligned 8-byte counters - two names sharing a slot just bump each other.
+    """
+
+    SLOTS = 512
+
+    def __init__(self, path: str):
+        """
+        Opens (creating if necessary) the counters file
+        :param path:
+        """
+        if fcntl is None:
+            raise RuntimeError("Shared counters need fcntl file locks, which this platform doesn't have")
+        self.path: str = path
+        self._fd: int = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = self.SLOTS * 8
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < size:
+                os.ftruncate(self._fd, size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map: mmap.mmap = mmap.mmap(self._fd, size)
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def offset(cls, name: str) -> int:
+        return zlib.crc32(name.encode()) % cls.SLOTS * 8
+
+    def get(self, name: str) -> int:
+        return struct.unpack_from("<Q", self._map, self.offset(name))[0]
+
+    def add(self, names: Iterable[str]) -> None:
+        """
+        Increments the names' counters by one (once per slot)
+        :param names:
+        :return:
+        """
+        offsets = {self.offset(name) for name in names}
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            for offset in offsets:
+                struct.pack_into("<Q", self._map, offset, struct.unpack_from("<Q", self._map, offset)[0] + 1)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+
+class CachePickler(pickle.Pickler):
+    """
+    Pickler that also handles classes made at runtime which say how to recreate themselves (projection rows' classes).
+    """
+
+    def reducer_override(self, obj: Any) -> Any:
+        if isinstance(obj, type) and "_class_reduce" in obj.__dict__:
+            return obj._class_reduce
+        return NotImplemented
+
+
+class SharedCache(object):
+    """
+    Key-value cache in a SQLite file shared by the worker processes.
+    """
+
+    PATH = env_str("SHARED_CACHE", "")  # empty turns shared caching off
+    SIZE = env_int("SHARED_CACHE_SIZE", 4096)
+    TTL = env_float("SHARED_CACHE_TTL", 3600)
+    TIMEOUT = 0.05  # seconds to wait for another worker's write before giving up
+    PRUNE_EVERY = 256  # writes between prunes
+
+    def __init__(self, path: str = PATH, maxsize: int = SIZE, ttl: float = TTL, prune_every: int = PRUNE_EVERY):
+        """
+        Opens (creating if necessary) the cache file
+        :param path:
+        :param maxsize: The maximum number of entries - the ones expiring soonest are pruned past this
+        :param ttl: Default lifetime of an entry, in seconds
+        :param prune_every: Writes between prunes - 0 leaves pruning to the caller (the app schedules it)
+        """
+        self.path: str = path
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.prune_every: int = prune_every
+        self.hits: int = 0
+        self.misses: int = 0
+        self.writes: int = 0
+        self.errors: int = 0
+        # Autocommit - every statement is its own short transaction. The connection is made where the app is imported
+        # but used on the event loop's thread (only ever one at a time)
+        self._connection: sqlite3.Connection = sqlite3.connect(
+            path, timeout=self.TIMEOUT, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        # Losing the cache in a crash only costs misses
+        self._connection.execute("PRAGMA synchronous = OFF")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, expires REAL NOT NULL, value BLOB NOT NULL) "
+            "WITHOUT ROWID"
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)")
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return bool(cls.PATH)
+
+    @classmethod
+    def versions_path(cls) -> str:
+        return f"{cls.PATH}.versions"
+
+    @staticmethod
+    def digest(key: Hashable) -> bytes:
+        # Keys are tuples of strings and numbers, whose repr is the same in every process
+        return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        buffer = io.BytesIO()
+        CachePickler(buffer, pickle.HIGHEST_PROTOCOL).dump(value)
+        return buffer.getvalue()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Gets a live entry
+        :param key:
+        :param default: Returned (and counted as a miss) if there is no live entry
+        :return:
+        """
+        try:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND expires > ?", (self.digest(key), time.time())
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            row = None
+        if row is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """
+        Adds or replaces an entry - values that can't be pickled aren't shared
+        :param key:
+        :param value:
+        :param ttl: Optional lifetime for this entry, in seconds (defaults to the cache's ttl)
+        :return:
+        """
+        try:
+            data = self.dumps(value)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, expires, value) VALUES (?, ?, ?)",
+                (self.digest(key), time.time() + (self.ttl if ttl is None else ttl), data),
+            )
+        except (sqlite3.Error, pickle.PicklingError, TypeError, AttributeError):
+            self.errors += 1
+            return
+        self.writes += 1
+        if self.prune_every and self.writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self) -> None:
+        """
+        Deletes expired entries, then the entries expiring soonest past the maximum count
+        :return:
+        """
+        try:
+            self._connection.execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+            self._connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY expires LIMIT "
+                "max(0, (SELECT count(*) FROM entries) - ?))",
+                (self.maxsize,),
+            )
+        except sqlite3.Error:
+            self.errors += 1
+
+    def clear(self) -> None:
+        self._connection.execute("DELETE FROM entries")
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "writes": self.writes, "errors": self.errors}
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders this worker's use of the shared cache in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_shared_cache"
+        lines = [
+            f"# HELP {name}_hits_total Lookups answered from the cache shared between workers.",
+            f"# TYPE {name}_hits_total counter",
+            f"{name}_hits_total {self.hits}",
+            f"# HELP {name}_misses_total Lookups the cache shared between workers couldn't answer.",
+            f"# TYPE {name}_misses_total counter",
+            f"{name}_misses_total {self.misses}",
+            f"# HELP {name}_writes_total Entries written to the cache shared between workers.",
+            f"# TYPE {name}_writes_total counter",
+            f"{name}_writes_total {self.writes}",
+            f"# HELP {name}_errors_total Reads and writes of the shared cache that failed (and were skipped).",
+            f"# TYPE {name}_errors_total counter",
+            f"{name}_errors_total {self.errors}",
+        ]
+        return "\n".join(lines) + "\n"
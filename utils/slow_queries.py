@@ -0,0 +1,167 @@
+"""
+Slow query log.
+
+When DTS_SLOW_QUERY_MS is set, every statement taking longer than that is recorded with its (redacted) parameters, the
+route of the request that ran it and SQLite's EXPLAIN QUERY PLAN for it, captured on the same connection straight away.
+Entries go to a size-rotated file of JSON lines and to a ring buffer of the most recent ones, shown to teachers at
+/slow_queries.
+
+Parameters are redacted to their type (and length, for text), apart from numbers, booleans and NULLs, so passwords,
+emails and tokens never reach the log but the shape of the values is still visible.
+"""
+import json
+import logging
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import UTC, datetime
+from logging.handlers import RotatingFileHandler
+from typing import Any, Optional
+
+from sqlalchemy import Engine, event
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from utils.config import env_float, env_int, env_str
+
+current_scope: ContextVar[Optional[Scope]] = ContextVar("current_scope", default=None)
+EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+def redact(value: Any) -> Any:
+    """
+    Replaces a parameter value with a description of it, unless it's a number, boolean or NULL
+    :param value:
+    :return:
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (str, bytes)):
+        return f"<{type(value).__name__} len={len(value)}>"
+    return f"<{type(value).__name__}>"
+
+
+def explain(dbapi_connection, statement: str, parameters) -> list[str]:
+    """
+    Gets SQLite's query plan for a statement that has just run, on the connection that ran it
+    :param dbapi_connection:
+    :param statement:
+    :param parameters: The statement's parameters (the first set, for an executemany)
+    :return: The detail column of each plan row
+    """
+    if not statement.lstrip().upper().startswith(EXPLAINABLE):
+        return []
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    except Exception as e:
+        return [f"unavailable: {e}"]
+    finally:
+        cursor.close()
+
+
+class SlowQueryMiddleware(object):
+    """
+    ASGI middleware making the current request's scope (and so, once routed, its route) available to the slow query log.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app: ASGIApp = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return None
+        token = current_scope.set(scope)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_scope.reset(token)
+
+
+class SlowQueryLog(object):
+    """
+    Records statements slower than a threshold.
+    """
+
+    THRESHOLD_MS = env_float("SLOW_QUERY_MS", 0)  # 0 turns the log off
+    FILE = env_str("SLOW_QUERY_FILE", "slow_queries.log")
+    FILE_SIZE = env_int("SLOW_QUERY_FILE_SIZE", 1048576)  # bytes before the file is rotated
+    FILE_BACKUPS = env_int("SLOW_QUERY_FILE_BACKUPS", 3)
+    BUFFER_SIZE = env_int("SLOW_QUERY_BUFFER", 200)  # entries kept in memory
+
+    def __init__(self, threshold_ms: float = THRESHOLD_MS, file: Optional[str] = FILE, buffer_size: int = BUFFER_SIZE):
+        """
+        Log initialization
+        :param threshold_ms: Statements taking longer than this (in milliseconds) are logged
+        :param file: Path of the log file, or None to keep entries in memory only
+        :param buffer_size: How many of the most recent entries to keep in memory
+        """
+        self.threshold: float = threshold_ms / 1000
+        self.entries: deque[dict] = deque(maxlen=buffer_size)
+        self.logger: logging.Logger = logging.getLogger("dts.slow_queries")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if file and not self.logger.handlers:
+            self.logger.addHandler(RotatingFileHandler(file, maxBytes=self.FILE_SIZE, backupCount=self.FILE_BACKUPS))
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return cls.THRESHOLD_MS > 0
+
+    def attach(self, engine: Engine) -> None:
+        """
+        Times the statements an engine runs
+        :param engine: The synchronous engine (AsyncEngine.sync_engine)
+        :return:
+        """
+
+        @event.listens_for(engine, "before_cursor_execute")
+        def start_timer(connection, cursor, statement, parameters, context, executemany):
+            context._slow_query_started = time.perf_counter()
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def check_duration(connection, cursor, statement, parameters, context, executemany):
+            seconds = time.perf_counter() - context._slow_query_started
+            if seconds >= self.threshold:
+                first = parameters[0] if executemany and parameters else parameters
+                plan = explain(connection.connection.dbapi_connection, statement, first)
+                self.record(statement, first, seconds, plan, executemany)
+
+    def record(self, statement: str, parameters, seconds: float, plan: list[str], executemany: bool) -> None:
+        """
+        Adds an entry to the buffer and the file
+        :param statement:
+        :param parameters:
+        :param seconds:
+        :param plan:
+        :param executemany:
+        :return:
+        """
+        scope = current_scope.get()
+        route = None
+        if scope is not None:
+            matched = scope.get("route")
+            route = f"{scope.get('method')} {matched.path if matched is not None else scope.get('path')}"
+        if isinstance(parameters, dict):
+            redacted = {name: redact(value) for name, value in parameters.items()}
+        else:
+            redacted = [redact(value) for value in parameters or ()]
+        entry = {
+            "time": datetime.now(tz=UTC).isoformat(),
+            "duration_ms": round(seconds * 1000, 3),
+            "route": route,
+            "statement": statement,
+            "parameters": redacted,
+            "executemany": executemany,
+            "plan": plan,
+        }
+        self.entries.append(entry)
+        self.logger.info(json.dumps(entry))
+
+    def recent(self) -> list[dict]:
+        """
+        The buffered entries, newest first
+        :return:
+        """
+        return list(reversed(self.entries))
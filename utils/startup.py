@@ -0,0 +1,167 @@
+"""
+Worker startup timing and warm-up.
+
+StartupTimer records how long each phase of starting a worker took - from the process starting (where the platform says
+when that was) through the imports, Sentry, the database connection and the optional warm-up - so slow restarts can be
+tracked down. The timings are logged once the worker is ready and served at /metrics.
+
+A new worker otherwise pays for compiling each template and preparing each statement on the first request that uses it,
+and starts with empty caches. With DTS_WARM_UP on, the app does that work before the worker accepts traffic, so a
+rolling restart doesn't show up as a latency spike.
+"""
+import os
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Optional
+
+from jinja2 import Environment
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.types import ASGIApp
+
+from utils.config import env_bool
+
+
+def process_age() -> Optional[float]:
+    """
+    How long ago this process started, from /proc (so Linux only)
+    :return: Seconds, or None where that isn't available
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # The command name (field 2) may contain spaces, so fields are counted from after its closing bracket
+            fields = file.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+
+
+class StartupTimer(object):
+    """
+    Durations of the phases of starting a worker.
+    """
+
+    WARM_UP = env_bool("WARM_UP", False)
+
+    def __init__(self):
+        """
+        Timer initialization - the first mark() is timed from the process starting if that's known, otherwise from here
+        """
+        now = time.perf_counter()
+        age = process_age()
+        self.started: float = now - age if age is not None else now
+        self.last: float = self.started
+        self.phases: dict[str, float] = {}
+        self.total: Optional[float] = None
+
+    def mark(self, name: str) -> None:
+        """
+        Records the time since the previous mark (or phase) as a phase
+        :param name:
+        :return:
+        """
+        now = time.perf_counter()
+        self.phases[name] = now - self.last
+        self.last = now
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """
+        Records the time the block takes as a phase
+        :param name:
+        :return:
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.last = time.perf_counter()
+            self.phases[name] = self.last - started
+
+    def ready(self) -> str:
+        """
+        Marks the worker as ready for traffic
+        :return: A summary of the timings, for the log
+        """
+        self.total = time.perf_counter() - self.started
+        phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.phases.items())
+        return f"ready {self.total:.2f}s after the process started ({phases})"
+
+    def render(self, prefix: str = "dts") -> str:
+        """
+        Renders the timings in the Prometheus text exposition format
+        :param prefix: Prepended to every metric name
+        :return:
+        """
+        name = f"{prefix}_startup"
+        lines = [
+            f"# HELP {name}_phase_seconds Time each phase of starting this worker took.",
+            f"# TYPE {name}_phase_seconds gauge",
+            *(f'{name}_phase_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in self.phases.items()),
+        ]
+        if self.total is not None:
+            lines += [
+                f"# HELP {name}_seconds Time from the process starting to this worker being ready.",
+                f"# TYPE {name}_seconds gauge",
+                f"{name}_seconds {self.total}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+def precompile_templates(environment: Environment) -> int:
+    """
+    Loads (and so compiles and caches) every template
+    :param environment: The Jinja2 environment, e.g. Jinja2Templates.env
+    :return: The number of templates
+    """
+    names = environment.list_templates()
+    for name in names:
+        environment.get_template(name)
+    return len(names)
+
+
+async def prepare_statements(session: AsyncSession, statements: list[Select]) -> None:
+    """
+    Runs read statements once, so SQLAlchemy has compiled them and the connection's driver has prepared them
+    :param session:
+    :param statements:
+    :return:
+    """
+    for statement in statements:
+        (await session.execute(statement)).all()
+
+
+async def request_page(app: ASGIApp, path: str) -> int:
+    """
+    GETs a page from the app directly (no client, no socket), as an anonymous visitor would
+    :param app:
+    :param path:
+    :return: The response's status code
+    """
+    messages = []
+
+    async def receive() -> dict:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict) -> None:
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"warm-up")],
+        "client": None,
+        "server": None,
+    }
+    await app(scope, receive, send)
+    return next(message["status"] for message in messages if message["type"] == "http.response.start")
@@ -0,0 +1,183 @@
+"""
+Per-user statistics read model.
+
+Each user's plays, wins, losses and last played time are kept in the user_stats table and adjusted in the same
+transaction as the match write that changes them, so the home page reads one row by primary key instead of counting
+matchplayers and matchresults on every load. Per-game play counts are already kept by the ratings table. check() and
+rebuild() compare against and recompute from the source tables (see manage.py).
+"""
+from datetime import datetime
+from typing import Iterable, Optional, Sequence
+
+from sqlalchemy import Row, Select, delete, func, or_, select
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from models import Match, MatchPlayers, MatchResult, User, UserStats
+
+
+class Stats(object):
+    """
+    Maintains and reads the user_stats table.
+    Methods that write don't commit - they are staged into the caller's transaction (usually through the
+    before_commit hook of a Database write method), except for rebuild() which is a standalone operation.
+    """
+
+    @staticmethod
+    async def get(session: AsyncSession, user_id: int) -> Optional[UserStats]:
+        """
+        Reads a user's stats (None if they've never played)
+        :param session:
+        :param user_id:
+        :return:
+        """
+        return await session.get(UserStats, user_id)
+
+    @staticmethod
+    async def record_matches(session: AsyncSession, results: Iterable[tuple[int, int, datetime]]) -> None:
+        """
+        Adds new matches to their players' stats, creating rows as needed, with one executemany
+        :param session:
+        :param results: The winner's id, loser's id and played time of each match
+        :return:
+        """
+        totals: dict[int, dict] = {}
+        for won_id, lost_id, played_at in results:
+            # Stored times have no timezone (aware ones are in UTC), so they're compared the same way
+            played_at = played_at.replace(tzinfo=None)
+            for user_id, won in ((won_id, 1), (lost_id, 0)):
+                entry = totals.setdefault(
+                    user_id, {"id": user_id, "plays": 0, "wins": 0, "losses": 0, "last_played_at": played_at}
+                )
+                entry["plays"] += 1
+                entry["wins"] += won
+                entry["losses"] += 1 - won
+                entry["last_played_at"] = max(entry["last_played_at"], played_at)
+        if not totals:
+            return None
+        table = UserStats.__table__
+        upsert = insert(table)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[table.c.id],
+            set_={
+                "plays": table.c.plays + upsert.excluded.plays,
+                "wins": table.c.wins + upsert.excluded.wins,
+                "losses": table.c.losses + upsert.excluded.losses,
+                # SQLite's two-argument max() is NULL if either argument is
+                "last_played_at": func.max(
+                    func.coalesce(table.c.last_played_at, upsert.excluded.last_played_at),
+                    upsert.excluded.last_played_at,
+                ),
+            },
+        )
+        await session.execute(upsert, list(totals.values()))
+
+    @classmethod
+    async def record_match(cls, session: AsyncSession, won_id: int, lost_id: int, played_at: datetime) -> None:
+        """
+        Adds a new match to its players' stats
+        :param session:
+        :param won_id:
+        :param lost_id:
+        :param played_at:
+        :return:
+        """
+        await cls.record_matches(session, [(won_id, lost_id, played_at)])
+
+    @staticmethod
+    def totals_statement() -> Select:
+        """
+        Statement recomputing every user's stats from the source tables (ignoring rows of deleted matches)
+        :return:
+        """
+        played = select(MatchPlayers.match_id).join(Match, Match.id == MatchPlayers.match_id)
+        plays = played.with_only_columns(func.count(MatchPlayers.id)).where(MatchPlayers.player_id == User.id)
+        last_played_at = played.with_only_columns(func.max(Match.played_at)).where(MatchPlayers.player_id == User.id)
+        results = select(func.count(MatchResult.id)).join(Match, Match.id == MatchResult.match_id)
+        return select(
+            User.id,
+            plays.scalar_subquery().label("plays"),
+            results.where(MatchResult.won_id == User.id).scalar_subquery().label("wins"),
+            results.where(MatchResult.lost_id == User.id).scalar_subquery().label("losses"),
+            last_played_at.scalar_subquery().label("last_played_at"),
+        )
+
+    @classmethod
+    async def refresh_users(cls, session: AsyncSession, user_ids: Iterable[int]) -> None:
+        """
+        Recomputes the given users' stats from the source tables
+        :param session:
+        :param user_ids:
+        :return:
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return None
+        totals = cls.totals_statement().where(User.id.in_(user_ids))
+        await session.execute(delete(UserStats).where(UserStats.id.in_(user_ids)))
+        await session.execute(insert(UserStats).from_select(list(totals.selected_columns.keys()), totals))
+
+    @classmethod
+    async def refresh_match(cls, session: AsyncSession, match_id: int) -> None:
+        """
+        Recomputes the stats of a match's players - used after a match has been edited or deleted.
+        The match's player rows are left behind when a match is deleted, so the players are looked up from them.
+        :param session:
+        :param match_id:
+        :return:
+        """
+        players = await session.scalars(select(MatchPlayers.player_id).where(MatchPlayers.match_id == match_id))
+        await cls.refresh_users(session, set(players))
+
+    @classmethod
+    def rebuild_statements(cls) -> list:
+        """
+        Statements replacing the whole table with stats recomputed from the source tables, in order
+        :return:
+        """
+        totals = cls.totals_statement()
+        return [delete(UserStats), insert(UserStats).from_select(list(totals.selected_columns.keys()), totals)]
+
+    @classmethod
+    async def rebuild(cls, session: AsyncSession) -> None:
+        """
+        Recomputes the whole table from the source tables and commits
+        :param session:
+        :return:
+        """
+        for statement in cls.rebuild_statements():
+            await session.execute(statement)
+        await session.commit()
+
+    @classmethod
+    async def check(cls, session: AsyncSession) -> Sequence[Row]:
+        """
+        Finds users whose stored stats don't match the source tables (a missing row counts as all zeroes)
+        :param session:
+        :return: Rows of the user id with the stored and expected values
+        """
+        expected = cls.totals_statement().subquery()
+        statement = (
+            select(
+                expected.c.id,
+                UserStats.plays,
+                expected.c.plays.label("expected_plays"),
+                UserStats.wins,
+                expected.c.wins.label("expected_wins"),
+                UserStats.losses,
+                expected.c.losses.label("expected_losses"),
+                UserStats.last_played_at,
+                expected.c.last_played_at.label("expected_last_played_at"),
+            )
+            .outerjoin(UserStats, UserStats.id == expected.c.id)
+            .where(
+                or_(
+                    func.coalesce(UserStats.plays, 0) != expected.c.plays,
+                    func.coalesce(UserStats.wins, 0) != expected.c.wins,
+                    func.coalesce(UserStats.losses, 0) != expected.c.losses,
+                    UserStats.last_played_at.is_distinct_from(expected.c.last_played_at),
+                )
+            )
+            .order_by(expected.c.id)
+        )
+        return (await session.execute(statement)).all()
@@ -0,0 +1,156 @@
+"""
+SQLite storage profiles.
+
+A profile decides the pragmas set on every new connection and whether reads and writes share one connection pool.
+With a split, writes go to a single writer connection, since SQLite only allows one writer at a time anyway, and
+reads go to a pool of read-only connections. A statement only counts as a read if it's a SELECT (a select() or a text()
+starting with SELECT) - flushes, INSERT/UPDATE/DELETE and anything else (DDL, ANALYZE, PRAGMAs) go to the writer. In WAL mode those
+readers don't block the writer, and the writer doesn't block them.
+
+The profile is chosen with the DTS_DB_PROFILE environment variable.
+"""
+from typing import Any, Optional
+
+from sqlalchemy import CompoundSelect, Engine, Select, TextClause, event
+from sqlalchemy.orm import Session, SessionTransaction
+
+from utils.config import env_str
+
+
+class StorageProfile(object):
+    """
+    Named set of connection settings.
+    """
+
+    def __init__(self, name: str, pragmas: dict[str, Any], readers: int = 0):
+        """
+        Profile initialization
+        :param name:
+        :param pragmas: Pragmas run on every new connection, in order
+        :param readers: Size of the read-only connection pool - 0 keeps reads and writes on one pool
+        """
+        self.name: str = name
+        self.pragmas: dict[str, Any] = pragmas
+        self.readers: int = readers
+
+    @property
+    def split(self) -> bool:
+        return self.readers > 0
+
+    @property
+    def read_pragmas(self) -> dict[str, Any]:
+        """
+        Pragmas for read-only connections - the vacuum and journal modes and sync level are the writer's business
+        :return:
+        """
+        pragmas = {
+            name: value
+            for name, value in self.pragmas.items()
+            if name not in ("auto_vacuum", "journal_mode", "synchronous")
+        }
+        pragmas["query_only"] = "ON"
+        return pragmas
+
+
+PROFILES: dict[str, StorageProfile] = {
+    # SQLite's defaults and a single pool - how the app has always run, fine for development
+    "default": StorageProfile("default", {}),
+    "production": StorageProfile(
+        "production",
+        {
+            # Lets the scheduled maintenance hand freed pages back a few at a time (only takes effect on a new database,
+            # or once the file has been VACUUMed)
+            "auto_vacuum": "INCREMENTAL",
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",  # durable at checkpoints rather than every commit, which is safe under WAL
+            "cache_size": -65536,  # negative values are KiB, so 64 MiB
+            "mmap_size": 268435456,  # 256 MiB
+            "busy_timeout": 5000,  # milliseconds
+            "temp_store": "MEMORY",
+        },
+        readers=4,
+    ),
+}
+
+
+def get_profile(name: Optional[str] = None) -> StorageProfile:
+    """
+    Gets a profile by name, defaulting to the one configured in the environment
+    :param name:
+    :return:
+    """
+    name = name or env_str("DB_PROFILE", "default")
+    if name not in PROFILES:
+        raise ValueError(f"Unknown storage profile {name!r} (expected one of {', '.join(PROFILES)})")
+    return PROFILES[name]
+
+
+def apply_pragmas(engine: Engine, pragmas: dict[str, Any]) -> None:
+    """
+    Runs the given pragmas on every connection the engine opens
+    :param engine: The synchronous engine (AsyncEngine.sync_engine)
+    :param pragmas:
+    :return:
+    """
+    if not pragmas:
+        return None
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def enable_savepoints(engine: Engine) -> None:
+    """
+    Makes SAVEPOINT (Session.begin_nested) work on the engine's connections.
+    The sqlite3 driver normally delays BEGIN until the first write and manages transactions itself, which breaks
+    savepoints, so this turns that off and emits BEGIN when SQLAlchemy starts a transaction (the recipe from the
+    SQLAlchemy SQLite dialect documentation).
+    :param engine: The synchronous engine (AsyncEngine.sync_engine)
+    :return:
+    """
+
+    @event.listens_for(engine, "connect")
+    def disable_driver_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+
+class RoutingSession(Session):
+    """
+    Session that sends writes to the writer engine and reads to the reader engine (both given through session info).
+    Once a transaction has written, the rest of it stays on the writer, so it can read its own uncommitted changes.
+    """
+
+    _writing: bool = False
+
+    @staticmethod
+    def is_read(clause) -> bool:
+        """
+        Whether a statement only reads - anything that isn't known to be a SELECT might write
+        :param clause: The statement, or None when no statement is given (e.g. Session.connection())
+        :return:
+        """
+        if clause is None:
+            return True  # callers that write through the connection write through the session first
+        if isinstance(clause, TextClause):
+            return clause.text.lstrip().upper().startswith("SELECT")
+        return isinstance(clause, (Select, CompoundSelect))
+
+    def get_bind(self, mapper=None, *, clause=None, **kwargs):
+        if self._writing or self._flushing or not self.is_read(clause):
+            self._writing = True
+            return self.info["writer"]
+        return self.info["reader"]
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def release_writer(session: RoutingSession, transaction: SessionTransaction) -> None:
+    if transaction.parent is None:
+        session._writing = False
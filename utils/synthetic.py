@@ -0,0 +1,249 @@
+"""
+Synthetic data for scaling tests.
+
+SyntheticData generates users, games and matches (with their players and results) from a seed, and writes them straight
+into the tables with the sqlite3 module - executemany in large transactions rather than through the routes or the ORM,
+so millions of matches take minutes rather than hours. The same seed and settings always give the same database
+(password hashes included - their salts come from the seed).
+
+The distributions can be tuned:
+- activity skew: players are picked with Zipf-like weights (1 / rank ** skew), so a few play a lot and most rarely;
+  0 picks uniformly
+- games per term: each term only has some of the games in play, chosen per term
+- played_at spread: matches are spread over the school weeks of each term, on weekdays, at times of day normally
+  distributed around lunchtime with the given spread in hours
+Winners are decided by a hidden skill per player, so ratings and the leaderboard look like a real history.
+
+Passwords are hashed once per distinct password (user n gets password{n % hashes}) so Argon2 doesn't dominate the run.
+The read models aren't written here - rebuild them afterwards (manage.py generate does).
+"""
+import sqlite3
+from datetime import date, datetime
+from typing import Iterable, Iterator
+
+import numpy as np
+
+from utils.hashing import pwd_context
+
+FIRST_NAMES = ("Aroha", "Ben", "Chloe", "Daniel", "Emma", "Finn", "Grace", "Hemi", "Isla", "Jack", "Kiri", "Liam")
+LAST_NAMES = ("Brown", "Clark", "Smith", "Ngata", "Patel", "Walker", "Wilson", "Taylor", "Thompson", "Wang", "Young")
+HOUSES = ("red", "blue", "green", "yellow")
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"  # how SQLAlchemy stores datetimes in SQLite
+
+
+class SyntheticData(object):
+    """
+    Reproducible generator of a populated database.
+    """
+
+    CHUNK_SIZE = 100000  # matches per transaction
+
+    def __init__(
+        self,
+        users: int = 10000,
+        games: int = 100,
+        matches: int = 1000000,
+        seed: int = 0,
+        activity_skew: float = 1.0,
+        games_per_term: int = 20,
+        terms: int = 8,
+        term_weeks: int = 10,
+        first_term: date = date(2022, 2, 1),
+        played_at_spread: float = 2.0,
+        teachers: float = 0.02,
+        leaders: float = 0.05,
+        hashes: int = 1,
+    ):
+        """
+        Generator initialization
+        :param users:
+        :param games:
+        :param matches:
+        :param seed:
+        :param activity_skew: Zipf exponent of how often each player plays (0 for uniform)
+        :param games_per_term: How many games are played in each term
+        :param terms: How many terms the matches are spread over
+        :param term_weeks: Length of a term
+        :param first_term: Start of the first term (terms start 13 weeks apart, so 4 a year)
+        :param played_at_spread: Standard deviation of the time of day matches are played, in hours
+        :param teachers: Share of users that are teachers
+        :param leaders: Share of users that are student leaders
+        :param hashes: How many distinct passwords (and so Argon2 hashes) to use
+        """
+        if users < 2 or games < 1:
+            raise ValueError("at least two users and one game are needed")
+        self.users: int = users
+        self.games: int = games
+        self.matches: int = matches
+        self.seed: int = seed
+        self.activity_skew: float = activity_skew
+        self.games_per_term: int = max(1, min(games_per_term, games))
+        self.terms: int = max(1, terms)
+        self.term_weeks: int = max(1, term_weeks)
+        self.first_term: date = first_term
+        self.played_at_spread: float = played_at_spread
+        self.teachers: int = max(1, round(users * teachers))
+        self.leaders: int = round(users * leaders)
+        self.hashes: int = max(1, hashes)
+        self.rng: np.random.Generator = np.random.default_rng(seed)
+
+    def password_hashes(self) -> list[str]:
+        handler = pwd_context.handler()
+        return [handler.using(salt=self.rng.bytes(16)).hash(f"password{number}") for number in range(self.hashes)]
+
+    def user_rows(self) -> Iterator[tuple]:
+        """
+        Rows of users: ids from 1, teachers first, then leaders, then students
+        :return:
+        """
+        hashes = self.password_hashes()
+        first_names = self.rng.integers(len(FIRST_NAMES), size=self.users)
+        last_names = self.rng.integers(len(LAST_NAMES), size=self.users)
+        houses = self.rng.integers(len(HOUSES), size=self.users)
+        year_levels = self.rng.integers(9, 14, size=self.users)
+        created_at = datetime.combine(self.first_term, datetime.min.time()).strftime(DATETIME_FORMAT)
+        for number in range(self.users):
+            if number < self.teachers:
+                role, year_level = "teacher", None
+            else:
+                role = "leader" if number < self.teachers + self.leaders else "student"
+                year_level = int(year_levels[number])
+            yield (
+                number + 1,
+                f"user{number}@example.com",
+                f"user{number}",
+                hashes[number % self.hashes],
+                role,
+                FIRST_NAMES[first_names[number]],
+                LAST_NAMES[last_names[number]],
+                year_level,
+                HOUSES[houses[number]],
+                created_at,
+            )
+
+    def game_rows(self) -> Iterator[tuple]:
+        for number in range(self.games):
+            yield number + 1, f"Game {number + 1}", f"Synthetic game number {number + 1}"
+
+    def players(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Picks the two players of every match, skewed by activity
+        :return: Winner and loser user ids
+        """
+        # Only students and leaders play; who is most active is shuffled so it isn't just the lowest ids
+        first_player = self.teachers + 1
+        count = self.users - self.teachers
+        if count < 2:
+            raise ValueError("at least two users must be students or leaders")
+        weights = 1 / np.arange(1, count + 1) ** self.activity_skew
+        weights = self.rng.permutation(weights / weights.sum())
+        first = self.rng.choice(count, size=self.matches, p=weights)
+        second = self.rng.choice(count, size=self.matches, p=weights)
+        clashes = first == second
+        while clashes.any():
+            second[clashes] = self.rng.choice(count, size=int(clashes.sum()), p=weights)
+            clashes = first == second
+        # The hidden skill decides the winner (a logistic of the skill difference, like Elo)
+        skill = self.rng.normal(size=count)
+        first_wins = self.rng.random(self.matches) < 1 / (1 + np.exp(skill[second] - skill[first]))
+        winners = np.where(first_wins, first, second) + first_player
+        losers = np.where(first_wins, second, first) + first_player
+        return winners, losers
+
+    def schedule(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Picks each match's game and time, sorted by time so ids follow the order matches were played in
+        :return: Game ids and played_at times (as numpy datetimes, in microseconds)
+        """
+        terms = self.rng.integers(self.terms, size=self.matches)
+        # Each term's games, as a terms x games_per_term table
+        term_games = np.array(
+            [self.rng.choice(self.games, size=self.games_per_term, replace=False) for _ in range(self.terms)]
+        )
+        game_ids = term_games[terms, self.rng.integers(self.games_per_term, size=self.matches)] + 1
+        # Weekdays of the term's weeks, and a time of day around 12:30
+        weeks = self.rng.integers(self.term_weeks, size=self.matches)
+        weekdays = self.rng.integers(5, size=self.matches)
+        hours = np.clip(self.rng.normal(12.5, self.played_at_spread, size=self.matches), 8, 17)
+        # Terms start on the first term's weekday, 13 weeks apart
+        days = terms * 91 + weeks * 7 + weekdays
+        microseconds = (days * 86400 + hours * 3600) * 1e6
+        played_at = np.datetime64(self.first_term, "us") + microseconds.astype("timedelta64[us]")
+        order = np.argsort(played_at, kind="stable")
+        return game_ids[order], played_at[order]
+
+    def match_rows(self) -> Iterator[tuple[tuple, tuple, tuple, tuple]]:
+        """
+        Rows of every match, in order of id
+        :return: The matches, matchplayers (winner's and loser's) and matchresults rows of each match
+        """
+        winners, losers = self.players()
+        game_ids, played_at = self.schedule()
+        # Matches are recorded a little after they're played
+        delays = self.rng.exponential(2 * 3600 * 1e6, size=self.matches).astype("timedelta64[us]")
+        creators = self.rng.integers(1, self.teachers + 1, size=self.matches)
+        for index in range(self.matches):
+            match_id = index + 1
+            winner, loser = int(winners[index]), int(losers[index])
+            played = played_at[index].item()
+            created = (played_at[index] + delays[index]).item()
+            yield (
+                (
+                    match_id,
+                    int(game_ids[index]),
+                    played.strftime(DATETIME_FORMAT),
+                    int(creators[index]),
+                    created.strftime(DATETIME_FORMAT),
+                ),
+                (2 * match_id - 1, match_id, winner),
+                (2 * match_id, match_id, loser),
+                (match_id, match_id, winner, loser),
+            )
+
+    @staticmethod
+    def chunks(rows: Iterable, size: int) -> Iterator[list]:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def write(self, path: str) -> None:
+        """
+        Writes everything into an existing database with empty tables
+        :param path: The SQLite database file
+        :return:
+        """
+        connection = sqlite3.connect(path)
+        try:
+            if connection.execute("SELECT EXISTS (SELECT 1 FROM users)").fetchone()[0]:
+                raise ValueError(f"{path} already has users - generate into a new database")
+            # Nothing else is using the file, and a crash just means generating again
+            connection.execute("PRAGMA synchronous = OFF")
+            with connection:
+                connection.executemany(
+                    "INSERT INTO users "
+                    "(id, email, username, password, role, first_name, last_name, year_level, house, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    self.user_rows(),
+                )
+                connection.executemany("INSERT INTO games (id, name, description) VALUES (?, ?, ?)", self.game_rows())
+            for chunk in self.chunks(self.match_rows(), self.CHUNK_SIZE):
+                with connection:
+                    connection.executemany(
+                        "INSERT INTO matches (id, game_id, played_at, creator_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                        (row[0] for row in chunk),
+                    )
+                    connection.executemany(
+                        "INSERT INTO matchplayers (id, match_id, player_id) VALUES (?, ?, ?)",
+                        (players for row in chunk for players in (row[1], row[2])),
+                    )
+                    connection.executemany(
+                        "INSERT INTO matchresults (id, match_id, won_id, lost_id) VALUES (?, ?, ?, ?)",
+                        (row[3] for row in chunk),
+                    )
+        finally:
+            connection.close()
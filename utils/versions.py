@@ -0,0 +1,116 @@
+"""
+Per-table data versions.
+
+Every committed transaction that wrote to a table bumps that table's version, so anything derived from a set of tables
+(a cached page, a cached query result) is current exactly as long as their versions haven't changed. Tables written are
+tracked on the session - ORM flushes and INSERT/UPDATE/DELETE statements run through Session.execute, which covers
+Database.insert/update/remove_record, their before_commit hooks and the other write paths - and bumped once the
+transaction commits, so a reader that sees the new version also sees the new data. Writes that roll back aren't counted.
+
+The versions are kept per process, unless share() moves them into a file every worker maps (see utils.shared_cache).
+
+Single rows can be versioned too, under row_key(table, id), for caches of one row that shouldn't be invalidated by every
+write to its table - Database.update and remove_record bump the row they change along with its table.
+"""
+from collections.abc import Iterable
+from itertools import chain
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import ORMExecuteState, Session, SessionTransaction, UOWTransaction
+
+from utils.shared_cache import SharedCounters
+
+
+class DataVersions(object):
+    """
+    Version counters for tables, starting at 0.
+    """
+
+    def __init__(self):
+        """
+        Counters initialization
+        """
+        self._versions: dict[str, int] = {}
+        self.shared: Optional[SharedCounters] = None
+
+    def share(self, path: str) -> None:
+        """
+        Keeps the versions in a file shared with other processes from now on
+        :param path: The counters file - every process sharing the versions must use the same one
+        :return:
+        """
+        if self.shared is None or self.shared.path != path:
+            self.shared = SharedCounters(path)
+
+    def get(self, *tables: str) -> tuple[int, ...]:
+        """
+        Gets the current versions of the given tables
+        :param tables: Table names
+        :return:
+        """
+        if self.shared is not None:
+            return tuple(self.shared.get(table) for table in tables)
+        return tuple(self._versions.get(table, 0) for table in tables)
+
+    def bump(self, tables: Iterable[str]) -> None:
+        """
+        Marks tables as changed
+        :param tables: Table names
+        :return:
+        """
+        if self.shared is not None:
+            tables = list(tables)
+            self.shared.add(tables)
+            # Only remembers the names, for snapshot()
+            for table in tables:
+                self._versions.setdefault(table, 0)
+            return
+        for table in tables:
+            self._versions[table] = self._versions.get(table, 0) + 1
+
+    def snapshot(self) -> dict[str, int]:
+        if self.shared is not None:
+            return {table: self.shared.get(table) for table in self._versions}
+        return dict(self._versions)
+
+
+data_versions = DataVersions()  # shared by every session in the process
+
+
+def row_key(table: str, identifier: int) -> str:
+    # The name a single row's version is kept under
+    return f"{table}:{identifier}"
+
+
+def written_tables(session: Session) -> set[str]:
+    # Tables (and row keys) to bump once the session's transaction commits
+    return session.info.setdefault("written_tables", set())
+
+
+@event.listens_for(Session, "after_flush")
+def track_flush(session: Session, flush_context: UOWTransaction) -> None:
+    # new/dirty/deleted still hold what was just flushed at this point
+    tables = written_tables(session)
+    for instance in chain(session.new, session.dirty, session.deleted):
+        tables.add(instance.__table__.name)
+
+
+@event.listens_for(Session, "do_orm_execute")
+def track_statement(orm_execute_state: ORMExecuteState) -> None:
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        written_tables(orm_execute_state.session).add(orm_execute_state.statement.table.name)
+
+
+@event.listens_for(Session, "after_commit")
+def bump_written(session: Session) -> None:
+    tables = session.info.pop("written_tables", None)
+    if tables:
+        data_versions.bump(tables)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def forget_written(session: Session, transaction: SessionTransaction) -> None:
+    # after_commit has already bumped a committed transaction's tables, so anything left belongs to one rolled back
+    if transaction.parent is None:
+        session.info.pop("written_tables", None)